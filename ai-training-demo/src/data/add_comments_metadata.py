@@ -14,7 +14,6 @@ import ast
 import re
 from pathlib import Path
 from typing import Dict, List, Any
-from datasets import load_from_disk
 
 
 def estimate_complexity(func_node: ast.FunctionDef) -> int:
@@ -307,7 +306,9 @@ def create_experiment_dataset(
     print(f"   Output: {output_dir}")
     print()
 
-    # Load HumanEval dataset
+    # Load HumanEval dataset (imported here: `datasets` is slow to import)
+    from datasets import load_from_disk
+
     dataset = load_from_disk(input_dir)
 
     # Create output directory
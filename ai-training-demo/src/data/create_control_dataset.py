@@ -11,7 +11,6 @@ Usage:
 
 import json
 from pathlib import Path
-from datasets import load_from_disk
 
 
 def create_control_dataset(
@@ -30,7 +29,9 @@ def create_control_dataset(
     print(f"   Output: {output_dir}")
     print()
 
-    # Load HumanEval dataset
+    # Load HumanEval dataset (imported here: `datasets` is slow to import)
+    from datasets import load_from_disk
+
     dataset = load_from_disk(input_dir)
 
     # Create output directory
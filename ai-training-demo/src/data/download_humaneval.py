@@ -8,7 +8,6 @@ Usage:
 
 import os
 from pathlib import Path
-from datasets import load_dataset
 
 
 def download_humaneval(output_dir: str = "datasets/humaneval_raw"):
@@ -26,7 +25,9 @@ def download_humaneval(output_dir: str = "datasets/humaneval_raw"):
     # Create output directory
     Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    # Download dataset
+    # Download dataset (imported here: `datasets` is slow to import)
+    from datasets import load_dataset
+
     dataset = load_dataset("openai/openai_humaneval")
 
     # Save to disk
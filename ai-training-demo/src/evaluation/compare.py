@@ -11,9 +11,6 @@ from pathlib import Path
 from typing import Dict, Any
 from datetime import datetime
 
-from scipy import stats
-import numpy as np
-
 from humaneval_evaluator import evaluate_model
 from config import get_stage1_eval_config, get_stage4_eval_config
 
@@ -32,6 +29,10 @@ def compute_statistical_significance(
     Returns:
         Statistical test results
     """
+    # scipy/numpy are only needed here; keep CLI startup fast
+    from scipy import stats
+    import numpy as np
+
     # Extract pass/fail for each sample
     control_passed = [r["passed"] for r in control_results["results"]]
     experiment_passed = [r["passed"] for r in experiment_results["results"]]
@@ -113,10 +114,10 @@ def generate_comparison_report(
     # Overall metrics
     report.append("## 📊 Overall Results")
     report.append("")
-    report.append("| Model | Pass@1 | Passed | Failed | Total |")
-    report.append("|-------|--------|--------|--------|-------|")
-    report.append(f"| **Control** (no metadata) | {control_metrics['pass@1']*100:.1f}% | {control_metrics['passed']} | {control_metrics['failed']} | {control_metrics['total_samples']} |")
-    report.append(f"| **Experiment** (with metadata) | {experiment_metrics['pass@1']*100:.1f}% | {experiment_metrics['passed']} | {experiment_metrics['failed']} | {experiment_metrics['total_samples']} |")
+    report.append("| Model | Pass@1 | Passed | Failed | Timed out | Total |")
+    report.append("|-------|--------|--------|--------|-----------|-------|")
+    report.append(f"| **Control** (no metadata) | {control_metrics['pass@1']*100:.1f}% | {control_metrics['passed']} | {control_metrics['failed']} | {control_metrics.get('timeouts', 0)} | {control_metrics['total_samples']} |")
+    report.append(f"| **Experiment** (with metadata) | {experiment_metrics['pass@1']*100:.1f}% | {experiment_metrics['passed']} | {experiment_metrics['failed']} | {experiment_metrics.get('timeouts', 0)} | {experiment_metrics['total_samples']} |")
     report.append("")
 
     # Improvement
@@ -272,7 +273,12 @@ def compare_models(stage: str = "stage4"):
     control_metrics = evaluate_model(
         model_path=config.control_model_path,
         test_file=config.test_file,
-        output_file=control_output
+        output_file=control_output,
+        torch_compile=config.torch_compile,
+        batch_size=config.batch_size,
+        test_timeout=config.test_timeout,
+        test_memory_mb=config.test_memory_mb,
+        test_workers=config.test_workers
     )
     print()
 
@@ -283,7 +289,12 @@ def compare_models(stage: str = "stage4"):
     experiment_metrics = evaluate_model(
         model_path=config.experiment_model_path,
         test_file=config.test_file,
-        output_file=experiment_output
+        output_file=experiment_output,
+        torch_compile=config.torch_compile,
+        batch_size=config.batch_size,
+        test_timeout=config.test_timeout,
+        test_memory_mb=config.test_memory_mb,
+        test_workers=config.test_workers
     )
     print()
 
@@ -24,6 +24,13 @@ class EvaluationConfig:
     num_samples_per_task: int = 1  # For pass@1 (can be 10 for pass@10)
     temperature: float = 0.2  # Low temperature for deterministic generation
     max_new_tokens: int = 512
+    torch_compile: bool = False  # Compile decoding (kept only if faster)
+    batch_size: int = 8  # Prompts per generate() call (lower if decoding runs out of memory)
+
+    # Test execution (sandboxed processes, see execution.py)
+    test_timeout: float = 10.0  # Wall-clock and CPU seconds per test run
+    test_memory_mb: Optional[int] = 4096  # Address-space cap per test run
+    test_workers: Optional[int] = None  # Test runs in parallel (None = all cores)
 
     # Azure AI Evaluation SDK
     use_azure_eval: bool = True
@@ -0,0 +1,298 @@
+"""
+Sandboxed Test Execution
+
+Runs HumanEval checks (prompt + completion, then the unit tests) outside
+the evaluator process. The training pass@1 probe (training/probe.py)
+uses the same engine. Each check gets its own short-lived process, with
+up to one per core running at a time:
+
+- Fresh interpreter state and namespace per check; the process holding
+  the model never exec()s generated code
+- Wall-clock timeout (alarm in the check, kill from the parent as a
+  backstop) and a CPU-time limit (RLIMIT_CPU)
+- Address-space cap (RLIMIT_AS), so a memory blowup fails the check
+  instead of killing the evaluator
+- Runs in a temporary directory, with destructive os / shutil /
+  subprocess calls disabled (like the official harness's
+  reliability_guard). This guards against accidents, not an attacker.
+- Timeouts are their own outcome, separate from failed tests and errors
+
+On POSIX the processes are forked from a small forkserver, so each one
+starts in milliseconds and never copies the model. On Windows they are
+spawned, and only the wall-clock limit applies.
+"""
+
+import contextlib
+import io
+import math
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.connection import wait
+from typing import List, Optional, Tuple
+
+
+# Outcomes of a check
+PASSED = "passed"
+FAILED = "failed"  # A test assertion failed
+ERROR = "error"  # Syntax error, exception, missing function, crash
+TIMEOUT = "timeout"
+
+# Parent-side grace on top of the timeout before the process is killed
+KILL_GRACE_SECONDS = 1.0
+
+MAX_ERROR_CHARS = 500
+
+
+@dataclass
+class ExecutionResult:
+    """Outcome of one check"""
+
+    outcome: str
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+    @property
+    def passed(self) -> bool:
+        return self.outcome == PASSED
+
+
+class _Timeout(BaseException):
+    """Raised by the alarm; BaseException so `except Exception` in generated code can't swallow it"""
+
+
+def _on_timeout(signum, frame):
+    raise _Timeout()
+
+
+def _apply_limits(timeout: float, memory_mb: Optional[int]):
+    """Wall-clock alarm, CPU-time and address-space limits for this process"""
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    try:
+        import resource
+    except ImportError:
+        return  # Windows: the parent's wall-clock kill is the only limit
+
+    # SIGXCPU at the soft limit ends the check cleanly, SIGKILL at the hard one
+    cpu_seconds = math.ceil(timeout)
+    signal.signal(signal.SIGXCPU, _on_timeout)
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _disable_destructive_calls():
+    """Stub out calls that could damage the machine (after the limits are set)"""
+    import shutil
+    import subprocess
+
+    def disabled(*args, **kwargs):
+        raise PermissionError("Disabled in the test sandbox")
+
+    for name in (
+        "kill", "killpg", "system", "putenv", "remove", "unlink", "removedirs", "rmdir",
+        "rename", "renames", "replace", "truncate", "chmod", "fchmod", "chown", "fchown",
+        "lchown", "chroot", "setuid", "fork", "forkpty"
+    ):
+        if hasattr(os, name):
+            setattr(os, name, disabled)
+    for name in ("rmtree", "move", "chown"):
+        setattr(shutil, name, disabled)
+    subprocess.Popen = disabled
+
+
+def _execute(code: str, test_code: str, entry_point: str) -> Tuple[str, Optional[str]]:
+    """Run the code and its tests in a fresh namespace"""
+    namespace = {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            # Execute the generated code
+            exec(code, namespace)
+
+            # Check if entry point exists
+            if entry_point not in namespace:
+                return ERROR, f"Function '{entry_point}' not found in generated code"
+
+            # Execute tests
+            exec(test_code, namespace)
+
+            # Call check function
+            check_func = namespace.get("check")
+            if check_func is None:
+                return ERROR, "Test function 'check' not found"
+
+            check_func(namespace[entry_point])
+
+        # If no exception, tests passed
+        return PASSED, None
+
+    except _Timeout:
+        return TIMEOUT, "Timed out"
+    except AssertionError as e:
+        return FAILED, f"Test failed: {str(e)}"
+    except MemoryError:
+        return ERROR, "Execution error: MemoryError: memory limit exceeded"
+    except BaseException as e:
+        return ERROR, f"Execution error: {type(e).__name__}: {str(e)}"
+
+
+def _run_check(conn, code: str, test_code: str, entry_point: str, timeout: float,
+               memory_mb: Optional[int], work_dir: str):
+    """Process target: apply the sandbox, run one check, send the outcome"""
+    import builtins
+    import sys
+
+    # Generated code may patch builtins that sending the result relies on
+    saved_builtins = dict(builtins.__dict__)
+    os.chdir(work_dir)
+    sys.stdin = io.StringIO()  # input() must not block on the parent's terminal
+    _apply_limits(timeout, memory_mb)
+    _disable_destructive_calls()
+
+    try:
+        outcome, error = _execute(code, test_code, entry_point)
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _Timeout:
+        # Alarm fired just as the check finished
+        outcome, error = TIMEOUT, "Timed out"
+    builtins.__dict__.update(saved_builtins)
+    conn.send((outcome, error[:MAX_ERROR_CHARS] if error else None))
+    conn.close()
+
+
+class ExecutionEngine:
+    """Runs checks in parallel sandboxed processes, results in input order"""
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        timeout: float = 10.0,
+        memory_mb: Optional[int] = 4096
+    ):
+        """
+        Args:
+            workers: Checks running at once (None = all cores)
+            timeout: Wall-clock and CPU seconds per check
+            memory_mb: Address-space cap per check (None = no cap)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("forkserver")
+            # The server imports only this module (not __main__, the model
+            # code), under the name the caller imported it as
+            self._context.set_forkserver_preload([__name__])
+        else:
+            self._context = multiprocessing.get_context("spawn")
+
+    def run(self, checks: List[Tuple[str, str, str]]) -> List[ExecutionResult]:
+        """
+        Run checks in parallel
+
+        Args:
+            checks: (code, test_code, entry_point) per check, where code is
+                prompt + completion
+
+        Returns:
+            One ExecutionResult per check, in the same order
+        """
+        results: List[Optional[ExecutionResult]] = [None] * len(checks)
+        queued = list(range(len(checks)))[::-1]
+        running = {}  # index -> (process, connection, start time)
+
+        with tempfile.TemporaryDirectory(prefix="humaneval-exec-") as work_dir:
+            while queued or running:
+                while queued and len(running) < self.workers:
+                    index = queued.pop()
+                    receiver, sender = self._context.Pipe(duplex=False)
+                    process = self._context.Process(
+                        target=_run_check,
+                        args=(sender, *checks[index], self.timeout, self.memory_mb, work_dir),
+                        daemon=True
+                    )
+                    process.start()
+                    sender.close()
+                    running[index] = (process, receiver, time.monotonic())
+
+                next_deadline = min(start for _, _, start in running.values()) + self.timeout + KILL_GRACE_SECONDS
+                wait(
+                    [receiver for _, receiver, _ in running.values()]
+                    + [process.sentinel for process, _, _ in running.values()],
+                    timeout=max(0.0, next_deadline - time.monotonic())
+                )
+
+                for index, (process, receiver, start) in list(running.items()):
+                    result = self._poll(process, receiver, start)
+                    if result is not None:
+                        results[index] = result
+                        receiver.close()
+                        process.join()
+                        del running[index]
+
+        return results
+
+    def _poll(self, process, receiver, start: float) -> Optional[ExecutionResult]:
+        """Result of a finished (or overdue, then killed) check; None while running"""
+        elapsed = time.monotonic() - start
+        if receiver.poll():
+            try:
+                outcome, error = receiver.recv()
+            except EOFError:
+                return self._exit_result(process, elapsed)
+            if outcome == TIMEOUT:
+                error = f"Timed out after {self.timeout:g}s"
+            return ExecutionResult(outcome, error, elapsed)
+        if not process.is_alive():
+            return self._exit_result(process, elapsed)
+        if elapsed > self.timeout + KILL_GRACE_SECONDS:
+            # Stuck where the alarm can't interrupt (long C call)
+            process.kill()
+            process.join()
+            return ExecutionResult(TIMEOUT, f"Timed out after {self.timeout:g}s (killed)", elapsed)
+        return None
+
+    def _exit_result(self, process, elapsed: float) -> ExecutionResult:
+        """The process exited without sending a result"""
+        process.join()
+        exit_code = process.exitcode
+        cpu_killed = hasattr(signal, "SIGXCPU") and exit_code in (-signal.SIGXCPU, -signal.SIGKILL)
+        if cpu_killed and elapsed >= self.timeout:
+            return ExecutionResult(TIMEOUT, f"CPU time limit of {self.timeout:g}s exceeded", elapsed)
+        return ExecutionResult(ERROR, f"Execution error: process exited with code {exit_code}", elapsed)
+
+    def check(self, code: str, test_code: str, entry_point: str) -> ExecutionResult:
+        """Run a single check"""
+        return self.run([(code, test_code, entry_point)])[0]
+
+    def submit(self, checks: List[Tuple[str, str, str]]) -> Future:
+        """
+        Run checks without waiting (batches run one after another)
+
+        Only a background thread waits on the check processes, so the
+        caller (e.g. the training loop) keeps going.
+
+        Returns:
+            Future whose result is run()'s list of ExecutionResult
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="execution")
+        return self._executor.submit(self.run, checks)
+
+    def shutdown(self):
+        """Wait for submitted checks and stop the background thread"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,127 @@
+"""
+Batched HumanEval Generation
+
+One generation protocol for the evaluator and the training pass@1 probe
+(training/probe.py), so their pass@1 numbers are comparable:
+
+- Prompts are sorted by token length so each batch pads little, and
+  padded on the left so every row's new tokens start at the same position
+- Only the new tokens are decoded
+- Rows stop at the HumanEval stop sequences (top-level code after the
+  function), and completions are cut there
+
+Only the standard library is imported at module level.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+
+# Top-level code after the completed function (HumanEval harness stop sequences)
+STOP_SEQUENCES = ["\nclass", "\ndef", "\n#", "\nif", "\nprint"]
+
+# Longer prompts are truncated
+MAX_PROMPT_TOKENS = 2048
+
+
+@dataclass
+class GenerationResult:
+    """Completions of one generate_completions call"""
+
+    completions: List[str]
+    generated_tokens: int = 0  # New tokens before stop-sequence truncation
+    seconds: float = 0.0  # Time in generate()
+
+
+def truncate_completion(text: str) -> str:
+    """Cut a completion at the first top-level statement after the function"""
+    cut = min((text.find(stop) for stop in STOP_SEQUENCES if stop in text), default=len(text))
+    return text[:cut]
+
+
+def _stop_string_kwargs(tokenizer) -> Dict[str, Any]:
+    """Stop rows early at the stop sequences (transformers >= 4.39; else truncation alone)"""
+    from transformers import GenerationConfig
+
+    if not hasattr(GenerationConfig(), "stop_strings"):
+        return {}
+    return {"stop_strings": STOP_SEQUENCES, "tokenizer": tokenizer}
+
+
+def generate_completions(
+    model,
+    tokenizer,
+    prompts: List[str],
+    batch_size: int = 8,
+    max_new_tokens: int = 512,
+    temperature: float = 0.0,
+    generate_kwargs: Optional[Dict[str, Any]] = None
+) -> GenerationResult:
+    """
+    Completions for a list of prompts, batched
+
+    Args:
+        model: Causal LM (switched to eval mode for the call)
+        tokenizer: Tokenizer with a pad token
+        prompts: Prompts in task order
+        batch_size: Prompts per generate() call
+        max_new_tokens: Token limit per completion
+        temperature: Sampling temperature (0 = greedy)
+        generate_kwargs: Extra generate() arguments (e.g. a static cache)
+
+    Returns:
+        GenerationResult with completions in the order of `prompts`
+    """
+    import torch
+
+    lengths = [
+        len(tokenizer(prompt, truncation=True, max_length=MAX_PROMPT_TOKENS)["input_ids"])
+        for prompt in prompts
+    ]
+    order = sorted(range(len(prompts)), key=lengths.__getitem__)
+    result = GenerationResult(completions=[""] * len(prompts))
+    stop_kwargs = _stop_string_kwargs(tokenizer)
+    sampling = {"do_sample": True, "temperature": temperature} if temperature > 0 else {"do_sample": False}
+
+    padding_side = tokenizer.padding_side
+    was_training = model.training
+    tokenizer.padding_side = "left"
+    model.eval()
+    try:
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = tokenizer(
+                [prompts[i] for i in batch],
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=MAX_PROMPT_TOKENS,
+                return_token_type_ids=False  # generate() rejects them (Llama has no segments)
+            ).to(model.device)
+
+            batch_start = time.perf_counter()
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    use_cache=True,
+                    pad_token_id=tokenizer.pad_token_id,
+                    eos_token_id=tokenizer.eos_token_id,
+                    **sampling,
+                    **stop_kwargs,
+                    **(generate_kwargs or {})
+                )
+            result.seconds += time.perf_counter() - batch_start
+
+            # Finished rows are padded
+            new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+            result.generated_tokens += int((new_tokens != tokenizer.pad_token_id).sum())
+            for i, text in zip(batch, tokenizer.batch_decode(new_tokens, skip_special_tokens=True)):
+                result.completions[i] = truncate_completion(text)
+    finally:
+        tokenizer.padding_side = padding_side
+        if was_training:
+            model.train()
+
+    return result
@@ -4,15 +4,25 @@ HumanEval Evaluator
 Uses official HumanEval evaluation harness to compute pass@k metrics.
 """
 
+import inspect
 import json
 import os
+import time
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 from dataclasses import dataclass
 
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
+from execution import TIMEOUT, ExecutionEngine
+from generation import generate_completions
+
+# torch / transformers / peft are imported where the model is used so the
+# CLI and compare.py start without loading them
+
+# Greedy tokens generated per timing run when benchmarking torch.compile
+COMPILE_BENCH_TOKENS = 32
+
+# Smaller gains are within timing noise
+MIN_COMPILE_SPEEDUP = 1.05
 
 
 @dataclass
@@ -24,6 +34,35 @@ class HumanEvalResult:
     generated_code: str
     passed: bool
     error: Optional[str] = None
+    outcome: Optional[str] = None  # passed / failed / error / timeout (see execution.py)
+
+
+class CompiledForward:
+    """
+    Module forward that runs compiled and falls back to eager
+
+    Installed as an instance attribute so generate() calls it through
+    nn.Module.__call__ as usual. If compiling or running the compiled
+    graph raises, the error is reported once and decoding stays eager.
+    """
+
+    def __init__(self, module, mode: str = "default", dynamic: Optional[bool] = None):
+        import torch
+
+        self.eager = module.forward
+        self.compiled = torch.compile(self.eager, mode=mode, dynamic=dynamic)
+        self.error = None
+        # generate() inspects forward's parameters
+        self.__signature__ = inspect.signature(self.eager)
+
+    def __call__(self, *args, **kwargs):
+        if self.error is None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {str(e).splitlines()[0][:200] if str(e) else ''}"
+                print(f"⚠️  torch.compile failed, decoding eager: {self.error}")
+        return self.eager(*args, **kwargs)
 
 
 class HumanEvalEvaluator:
@@ -34,7 +73,13 @@ class HumanEvalEvaluator:
         model_path: str,
         base_model_name: str = "meta-llama/Meta-Llama-3-8B",
         temperature: float = 0.2,
-        max_new_tokens: int = 512
+        max_new_tokens: int = 512,
+        torch_compile: bool = False,
+        compile_mode: str = "default",
+        batch_size: int = 8,
+        test_timeout: float = 10.0,
+        test_memory_mb: Optional[int] = 4096,
+        test_workers: Optional[int] = None
     ):
         """
         Initialize evaluator
@@ -44,18 +89,33 @@ class HumanEvalEvaluator:
             base_model_name: Base model name
             temperature: Sampling temperature
             max_new_tokens: Max tokens to generate
+            torch_compile: Compile the decoding forward (kept only if faster)
+            compile_mode: torch.compile mode ("reduce-overhead" needs static shapes)
+            batch_size: Prompts per generate() call
+            test_timeout: Wall-clock and CPU seconds per test run
+            test_memory_mb: Memory cap per test run (None = no cap)
+            test_workers: Test runs in parallel (None = all cores)
         """
         self.model_path = model_path
         self.base_model_name = base_model_name
         self.temperature = temperature
         self.max_new_tokens = max_new_tokens
+        self.torch_compile = torch_compile
+        self.compile_mode = compile_mode
+        self.batch_size = batch_size
+        self.engine = ExecutionEngine(workers=test_workers, timeout=test_timeout, memory_mb=test_memory_mb)
+        self.generate_kwargs = {}
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
 
         print(f"📦 Loading model from {model_path}...")
         self.tokenizer, self.model = self._load_model()
         print("   ✅ Model loaded")
 
     def _load_model(self):
-        """Load model with LoRA adapter"""
+        """Load model with LoRA adapter, or a merged export (see training/export.py)"""
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+
         # Load tokenizer
         tokenizer = AutoTokenizer.from_pretrained(
             self.model_path,
@@ -65,20 +125,149 @@ class HumanEvalEvaluator:
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
 
-        # Load base model (8-bit for inference)
+        import torch
+
+        if not (Path(self.model_path) / "adapter_config.json").exists():
+            # Merged export: no PeftModel wrapper, no per-token LoRA matmuls.
+            # Loaded as saved (never re-quantized here), so the model evaluated
+            # is the one export.py checked against the adapter; int8/nf4
+            # exports (--quantize) carry their own quantization config
+            meta_file = Path(self.model_path) / "export_meta.json"
+            dtype = "auto"
+            if meta_file.exists():
+                with open(meta_file, "r", encoding="utf-8") as f:
+                    dtype = getattr(torch, json.load(f)["dtype"])
+            model = AutoModelForCausalLM.from_pretrained(
+                self.model_path,
+                torch_dtype=dtype,
+                device_map="auto",
+                trust_remote_code=True
+            )
+            model.eval()
+            return tokenizer, model
+
+        from peft import PeftModel
+
+        # Load base model (8-bit for inference; bitsandbytes needs CUDA)
         base_model = AutoModelForCausalLM.from_pretrained(
             self.base_model_name,
-            load_in_8bit=True,
+            load_in_8bit=torch.cuda.is_available(),
             device_map="auto",
             trust_remote_code=True
         )
 
+        # Tokenizer saved with the adapter may add vocabulary (metadata tokens);
+        # the trained rows come with the adapter (modules_to_save)
+        if len(tokenizer) > base_model.get_input_embeddings().weight.shape[0]:
+            base_model.resize_token_embeddings(len(tokenizer))
+
         # Load LoRA adapter
         model = PeftModel.from_pretrained(base_model, self.model_path)
         model.eval()
 
         return tokenizer, model
 
+    def _time_generation(self, inputs, **generate_kwargs) -> float:
+        """Seconds per new token for a fixed-length greedy generation"""
+        import torch
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.model.generate(
+                **inputs,
+                max_new_tokens=COMPILE_BENCH_TOKENS,
+                min_new_tokens=COMPILE_BENCH_TOKENS,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generate_kwargs
+            )
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / COMPILE_BENCH_TOKENS
+
+    def compile_decoding(self, prompt: str) -> bool:
+        """
+        Compile the decoding forward if it speeds up generation
+
+        Compiled decoding uses a static KV cache. A growing dynamic cache
+        changes shape every step and would recompile until dynamo gives
+        up. Prompt lengths still differ per task, so the graph is compiled
+        with dynamic shapes (one prefill graph instead of one per length).
+        Eager and compiled generation are timed on one prompt, and the
+        compiled forward is kept only if it is at least
+        MIN_COMPILE_SPEEDUP faster.
+
+        Args:
+            prompt: Prompt used for timing
+
+        Returns:
+            True if decoding now runs compiled
+        """
+        decoder = self.model.get_base_model() if hasattr(self.model, "get_base_model") else self.model
+        inputs = self.tokenizer(prompt, return_tensors="pt", return_token_type_ids=False).to(self.model.device)
+
+        print(f"⚡ torch.compile decoding (mode={self.compile_mode}, dynamic=True)...")
+        self._time_generation(inputs)
+        eager = self._time_generation(inputs)
+
+        try:
+            compiled = CompiledForward(decoder, mode=self.compile_mode, dynamic=True)
+        except Exception as e:
+            print(f"   ⚠️  Compile unsupported here, decoding eager: {type(e).__name__}: {e}")
+            print()
+            return False
+        decoder.forward = compiled
+        static_cache = {"cache_implementation": "static"}
+        first = self._time_generation(inputs, **static_cache)
+        steady = self._time_generation(inputs, **static_cache) if compiled.error is None else 0.0
+
+        if compiled.error is not None or eager < MIN_COMPILE_SPEEDUP * steady:
+            del decoder.forward
+            if compiled.error is None:
+                print(f"   ⚠️  {eager * 1000:.1f} -> {steady * 1000:.1f} ms/token is below "
+                      f"{MIN_COMPILE_SPEEDUP:.2f}x, decoding eager")
+            else:
+                print(f"   ⚠️  Compile unsupported here, decoding eager")
+            print()
+            return False
+
+        self.generate_kwargs = static_cache
+        compile_seconds = max((first - eager) * COMPILE_BENCH_TOKENS, 0.0)
+        saved = eager - steady
+        print(f"   Compile time: {compile_seconds:.1f}s")
+        print(f"   Decoding: {eager * 1000:.1f} ms/token eager -> {steady * 1000:.1f} ms/token compiled "
+              f"({eager / steady:.2f}x)")
+        print(f"   ✅ Compiled decoding kept (pays back after ~{int(compile_seconds / saved) + 1} tokens)")
+        print()
+        return True
+
+    def generate_completions(self, prompts: List[str]) -> List[str]:
+        """
+        Generate code completions for many prompts, batched
+
+        Same protocol as the training pass@1 probe (see generation.py):
+        length-sorted, left-padded batches, cut at the HumanEval stop
+        sequences.
+
+        Args:
+            prompts: Function signatures and docstrings
+
+        Returns:
+            Completions in the order of `prompts`
+        """
+        result = generate_completions(
+            self.model,
+            self.tokenizer,
+            prompts,
+            batch_size=self.batch_size,
+            max_new_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            generate_kwargs=self.generate_kwargs
+        )
+        self.generated_tokens += result.generated_tokens
+        self.generation_seconds += result.seconds
+        return result.completions
+
     def generate_completion(self, prompt: str) -> str:
         """
         Generate code completion for prompt
@@ -89,37 +278,15 @@ class HumanEvalEvaluator:
         Returns:
             Generated code completion
         """
-        # Tokenize
-        inputs = self.tokenizer(
-            prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=2048
-        ).to(self.model.device)
-
-        # Generate
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=self.max_new_tokens,
-                temperature=self.temperature,
-                do_sample=True if self.temperature > 0 else False,
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id
-            )
-
-        # Decode (remove prompt)
-        full_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        completion = full_text[len(prompt):]
-
-        return completion
+        return self.generate_completions([prompt])[0]
 
-    def evaluate_sample(self, sample: Dict[str, Any]) -> HumanEvalResult:
+    def evaluate_sample(self, sample: Dict[str, Any], generated_code: Optional[str] = None) -> HumanEvalResult:
         """
         Evaluate single HumanEval sample
 
         Args:
             sample: HumanEval sample dict
+            generated_code: Completion generated in a batch (None = generate now)
 
         Returns:
             Evaluation result
@@ -130,19 +297,19 @@ class HumanEvalEvaluator:
         entry_point = sample["entry_point"]
 
         # Generate completion
-        generated_code = self.generate_completion(prompt)
+        if generated_code is None:
+            generated_code = self.generate_completion(prompt)
 
-        # Test generated code
-        passed, error = self._test_code(
-            prompt, generated_code, test_code, entry_point
-        )
+        # Test generated code (sandboxed process)
+        execution = self.engine.check(prompt + generated_code, test_code, entry_point)
 
         return HumanEvalResult(
             task_id=task_id,
             prompt=prompt,
             generated_code=generated_code,
-            passed=passed,
-            error=error
+            passed=execution.passed,
+            error=execution.error,
+            outcome=execution.outcome
         )
 
     def _test_code(
@@ -164,38 +331,9 @@ class HumanEvalEvaluator:
         Returns:
             Tuple of (passed, error_message)
         """
-        # Combine prompt + completion
-        full_code = prompt + completion
-
-        # Create test environment
-        namespace = {}
-
-        try:
-            # Execute the generated code
-            exec(full_code, namespace)
-
-            # Check if entry point exists
-            if entry_point not in namespace:
-                return False, f"Function '{entry_point}' not found in generated code"
-
-            # Execute tests
-            exec(test_code, namespace)
-
-            # Call check function
-            check_func = namespace.get("check")
-            if check_func is None:
-                return False, "Test function 'check' not found"
-
-            candidate = namespace[entry_point]
-            check_func(candidate)
-
-            # If no exception, tests passed
-            return True, None
-
-        except AssertionError as e:
-            return False, f"Test failed: {str(e)}"
-        except Exception as e:
-            return False, f"Execution error: {type(e).__name__}: {str(e)}"
+        # Runs in a sandboxed process (see execution.py)
+        execution = self.engine.check(prompt + completion, test_code, entry_point)
+        return execution.passed, execution.error
 
     def evaluate_dataset(
         self,
@@ -222,19 +360,47 @@ class HumanEvalEvaluator:
 
         print(f"   {len(samples)} samples to evaluate")
 
-        # Evaluate each sample
+        if self.torch_compile and samples:
+            self.compile_decoding(samples[0]["prompt"])
+
+        # Generate all completions in batches
+        print(f"   Generating (batch size {self.batch_size})...")
+        start = time.perf_counter()
+        completions = self.generate_completions([sample["prompt"] for sample in samples])
+        print(f"   ✅ {len(samples)} completions in {time.perf_counter() - start:.1f}s")
+
+        # Run all tests in parallel sandboxed processes
+        print(f"   Testing ({self.engine.workers} processes, {self.engine.timeout:g}s timeout)...")
+        start = time.perf_counter()
+        executions = self.engine.run([
+            (sample["prompt"] + completion, sample["test"], sample["entry_point"])
+            for sample, completion in zip(samples, completions)
+        ])
+        test_seconds = time.perf_counter() - start
+
         results = []
         passed_count = 0
+        timeout_count = 0
 
-        for i, sample in enumerate(samples):
+        for i, (sample, completion, execution) in enumerate(zip(samples, completions, executions)):
             print(f"   [{i+1}/{len(samples)}] {sample['task_id']}...", end=" ")
 
-            result = self.evaluate_sample(sample)
+            result = HumanEvalResult(
+                task_id=sample["task_id"],
+                prompt=sample["prompt"],
+                generated_code=completion,
+                passed=execution.passed,
+                error=execution.error,
+                outcome=execution.outcome
+            )
             results.append(result)
 
             if result.passed:
                 passed_count += 1
                 print("✅ PASSED")
+            elif result.outcome == TIMEOUT:
+                timeout_count += 1
+                print(f"⏱️  TIMEOUT: {result.error}")
             else:
                 print(f"❌ FAILED: {result.error}")
 
@@ -246,15 +412,23 @@ class HumanEvalEvaluator:
             "total_samples": total,
             "passed": passed_count,
             "failed": total - passed_count,
-            "pass@1": pass_at_1
+            "pass@1": pass_at_1,
+            "timeouts": timeout_count,
+            "test_seconds": test_seconds,
+            "generated_tokens": self.generated_tokens,
+            "ms_per_token": (
+                1000 * self.generation_seconds / self.generated_tokens if self.generated_tokens else 0.0
+            )
         }
 
         print()
         print(f"📊 Results:")
         print(f"   Total: {total}")
         print(f"   Passed: {passed_count}")
-        print(f"   Failed: {total - passed_count}")
+        print(f"   Failed: {total - passed_count} ({timeout_count} timed out)")
         print(f"   Pass@1: {pass_at_1*100:.1f}%")
+        print(f"   Decoding: {metrics['ms_per_token']:.1f} ms/token ({self.generated_tokens} tokens)")
+        print(f"   Tests: {test_seconds:.1f}s")
 
         # Save results
         if output_file:
@@ -267,6 +441,7 @@ class HumanEvalEvaluator:
                     {
                         "task_id": r.task_id,
                         "passed": r.passed,
+                        "outcome": r.outcome,
                         "error": r.error,
                         "generated_code": r.generated_code
                     }
@@ -286,7 +461,12 @@ def evaluate_model(
     model_path: str,
     test_file: str,
     output_file: str,
-    base_model_name: str = "meta-llama/Meta-Llama-3-8B"
+    base_model_name: str = "meta-llama/Meta-Llama-3-8B",
+    torch_compile: bool = False,
+    batch_size: int = 8,
+    test_timeout: float = 10.0,
+    test_memory_mb: Optional[int] = 4096,
+    test_workers: Optional[int] = None
 ) -> Dict[str, Any]:
     """
     Evaluate a single model on HumanEval
@@ -296,6 +476,11 @@ def evaluate_model(
         test_file: Test dataset JSONL
         output_file: Where to save results
         base_model_name: Base model name
+        torch_compile: Compile the decoding forward (kept only if faster)
+        batch_size: Prompts per generate() call
+        test_timeout: Wall-clock and CPU seconds per test run
+        test_memory_mb: Memory cap per test run (None = no cap)
+        test_workers: Test runs in parallel (None = all cores)
 
     Returns:
         Evaluation metrics
@@ -304,7 +489,12 @@ def evaluate_model(
         model_path=model_path,
         base_model_name=base_model_name,
         temperature=0.2,
-        max_new_tokens=512
+        max_new_tokens=512,
+        torch_compile=torch_compile,
+        batch_size=batch_size,
+        test_timeout=test_timeout,
+        test_memory_mb=test_memory_mb,
+        test_workers=test_workers
     )
 
     metrics = evaluator.evaluate_dataset(
@@ -323,6 +513,15 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, required=True, help="Path to model")
     parser.add_argument("--test-file", type=str, required=True, help="Test dataset")
     parser.add_argument("--output", type=str, required=True, help="Output file")
+    parser.add_argument("--base-model", type=str, default="meta-llama/Meta-Llama-3-8B", help="Base model name or path")
+    parser.add_argument("--torch-compile", action="store_true",
+                        help="Compile the decoding forward (falls back to eager if unsupported or not faster)")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Prompts per generate() call (length-sorted, left-padded)")
+    parser.add_argument("--test-timeout", type=float, default=10.0,
+                        help="Wall-clock and CPU seconds per test run (sandboxed process)")
+    parser.add_argument("--test-workers", type=int, default=None,
+                        help="Test runs in parallel (default: all cores)")
 
     args = parser.parse_args()
 
@@ -333,7 +532,12 @@ if __name__ == "__main__":
     metrics = evaluate_model(
         model_path=args.model,
         test_file=args.test_file,
-        output_file=args.output
+        output_file=args.output,
+        base_model_name=args.base_model,
+        torch_compile=args.torch_compile,
+        batch_size=args.batch_size,
+        test_timeout=args.test_timeout,
+        test_workers=args.test_workers
     )
 
     print()
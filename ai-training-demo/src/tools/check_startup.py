@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Startup Import-Time Benchmark
+
+Runs every CLI entry point under `python -X importtime` and fails if
+startup imports exceed a budget or pull in heavy libraries (torch,
+transformers, peft, datasets, scipy, ...) before any work starts.
+Orchestrators call these scripts many times, so the startup tax adds up.
+
+Usage:
+    python src/tools/check_startup.py
+    python src/tools/check_startup.py --budget-ms 200 --python venv/bin/python
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+# (script relative to src/, arguments) - each runs from its own directory
+ENTRY_POINTS = [
+    ("training/train.py", ["--help"]),
+    ("training/sweep.py", ["--help"]),
+    ("training/halving.py", ["--help"]),
+    ("training/autotune.py", ["--help"]),
+    ("training/export.py", ["--help"]),
+    ("training/config.py", None),
+    ("evaluation/humaneval_evaluator.py", ["--help"]),
+    ("evaluation/compare.py", ["--help"]),
+    ("evaluation/config.py", []),
+    ("data/prepare_datasets.py", ["--help"]),
+    ("data/download_humaneval.py", None),
+    ("data/create_control_dataset.py", None),
+    ("data/add_comments_metadata.py", None),
+    ("data/split_dataset.py", None),
+    ("data/create_micro_dataset.py", None),
+]
+
+# Libraries that must only load on code paths that need them
+HEAVY_MODULES = (
+    "torch",
+    "transformers",
+    "peft",
+    "accelerate",
+    "bitsandbytes",
+    "datasets",
+    "scipy",
+    "numpy",
+    "mlflow",
+)
+
+
+@dataclass
+class StartupResult:
+    """Import-time measurement for one entry point"""
+
+    name: str
+    import_ms: float
+    wall_ms: float
+    heavy_modules: List[str] = field(default_factory=list)
+    slowest: List[tuple] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def parse_importtime(stderr: str) -> Dict[str, object]:
+    """
+    Parse `-X importtime` output
+
+    Args:
+        stderr: Captured stderr of the process
+
+    Returns:
+        Dict with total_us (sum of top-level cumulative times),
+        modules (all imported module names) and top (top-level entries)
+    """
+    total_us = 0
+    modules = set()
+    top = []
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        _, _self_us, cumulative_us, name = _split(line)
+        module = name.strip()
+        modules.add(module)
+
+        # Top-level imports are not indented
+        if not name.startswith(" "):
+            total_us += cumulative_us
+            top.append((module, cumulative_us))
+
+    top.sort(key=lambda item: item[1], reverse=True)
+    return {"total_us": total_us, "modules": modules, "top": top}
+
+
+def _split(line: str) -> tuple:
+    """Split an importtime line into (prefix, self_us, cumulative_us, name)"""
+    prefix, rest = line.split(":", 1)
+    self_us, cumulative_us, name = rest.split("|", 2)
+    # Keep indentation of the name (it encodes nesting); drop one separator space
+    return prefix, int(self_us), int(cumulative_us), name[1:]
+
+
+def measure(script: str, args: Optional[List[str]], python: str) -> StartupResult:
+    """
+    Measure startup imports of one entry point
+
+    Args:
+        script: Script path relative to src/
+        args: CLI arguments, or None to only import the module
+        python: Python interpreter to use
+
+    Returns:
+        StartupResult
+    """
+    path = SRC_DIR / script
+    if args is None:
+        name = f"import {path.stem}"
+        command = [python, "-X", "importtime", "-c", f"import {path.stem}"]
+    else:
+        name = " ".join([script] + args)
+        command = [python, "-X", "importtime", path.name] + args
+
+    start = time.perf_counter()
+    proc = subprocess.run(
+        command,
+        cwd=path.parent,
+        capture_output=True,
+        text=True
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    parsed = parse_importtime(proc.stderr)
+    heavy = sorted({
+        module.split(".")[0] for module in parsed["modules"]
+        if module.split(".")[0] in HEAVY_MODULES
+    })
+
+    error = None
+    if proc.returncode != 0:
+        last_line = [l for l in proc.stderr.splitlines() if not l.startswith("import time:")]
+        error = last_line[-1] if last_line else f"exit code {proc.returncode}"
+
+    return StartupResult(
+        name=name,
+        import_ms=parsed["total_us"] / 1000,
+        wall_ms=wall_ms,
+        heavy_modules=heavy,
+        slowest=parsed["top"][:3],
+        error=error
+    )
+
+
+def main():
+    """Run the startup benchmark"""
+    parser = argparse.ArgumentParser(description="Startup import-time benchmark")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=200.0,
+        help="Max import time per entry point in milliseconds"
+    )
+    parser.add_argument(
+        "--python",
+        type=str,
+        default=sys.executable,
+        help="Python interpreter to benchmark"
+    )
+    args = parser.parse_args()
+
+    print("⏱️  Startup import-time benchmark")
+    print(f"   Budget: {args.budget_ms:.0f} ms per entry point")
+    print()
+
+    failures = 0
+    for script, script_args in ENTRY_POINTS:
+        result = measure(script, script_args, args.python)
+
+        problems = []
+        if result.error:
+            problems.append(result.error)
+        if result.import_ms > args.budget_ms:
+            problems.append("over budget")
+        if result.heavy_modules:
+            problems.append(f"heavy imports: {', '.join(result.heavy_modules)}")
+
+        status = "❌" if problems else "✅"
+        print(f"{status} {result.name}")
+        print(f"   imports: {result.import_ms:.0f} ms | wall: {result.wall_ms:.0f} ms")
+        if problems:
+            failures += 1
+            for problem in problems:
+                print(f"   ⚠️  {problem}")
+            slowest = ", ".join(f"{m} {us / 1000:.0f} ms" for m, us in result.slowest)
+            print(f"   Slowest: {slowest}")
+
+    print()
+    if failures:
+        print(f"❌ {failures}/{len(ENTRY_POINTS)} entry points failed the startup budget")
+        sys.exit(1)
+
+    print(f"✅ All {len(ENTRY_POINTS)} entry points start within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+"""
+Hardware Auto-Tuner
+
+The stage presets hard-code micro-batch size, gradient accumulation and
+fp16 for one RTX 4070Ti. This module probes the device a run actually
+gets, whether a GPU (VRAM, bf16 support) or a CPU (RAM, cores). For each
+supported precision it:
+
+1. Finds the largest micro-batch that fits. On a GPU, forward+backward
+   passes at full sequence length are run until one runs out of memory
+   (or passes the headroom). On a CPU, the RSS growth of micro-batch 1
+   and 2 steps is extrapolated against the RAM left beside the resident
+   model, since a host OOM cannot be caught.
+2. Measures training tokens/s at that micro-batch.
+
+The fastest precision wins. Gradient accumulation is then chosen to keep
+the configured effective batch size. The tuned values are applied to the
+TrainingConfig and written with the full run configuration to
+`run_config.json` in the output dir. Later runs on the same device and
+workload reuse the file instead of probing again.
+
+Usage:
+    # Tune inline, then train
+    python train.py --stage stage4 --experiment-type control --auto-tune
+
+    # Only probe and write outputs/final/control/run_config.json
+    python autotune.py --stage stage4 --experiment-type control
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from config import DataConfig, DistributedConfig, ExperimentConfig, ModelConfig, TrainingConfig
+
+if TYPE_CHECKING:
+    from distributed import DistributedContext
+
+
+RUN_CONFIG_FILE = "run_config.json"
+
+# Share of device memory a probe may use (the rest covers optimizer
+# state, fragmentation and evaluation)
+MEMORY_HEADROOM = 0.85
+
+# Upper bound for the micro-batch search
+MAX_MICRO_BATCH = 64
+
+# Timed probe steps per candidate (after one warm-up step)
+PROBE_STEPS = 2
+
+# RSS sampling interval during CPU probe steps
+RSS_SAMPLE_SECONDS = 0.002
+
+
+@dataclass
+class DeviceInfo:
+    """Hardware a run is tuned for"""
+
+    kind: str  # "cuda" or "cpu"
+    name: str
+    memory_gb: float  # VRAM per GPU, or available host RAM
+    cores: int
+    bf16: bool
+    world_size: int
+
+    def key(self) -> str:
+        """Stable identifier of this hardware layout"""
+        return f"{self.kind}:{self.name}:{self.memory_gb:.0f}GB:{self.cores}c:x{self.world_size}"
+
+
+@dataclass
+class Candidate:
+    """Probe result for one precision"""
+
+    precision: str
+    micro_batch: int
+    tokens_per_sec: float = 0.0
+    peak_memory_gb: Optional[float] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class TuneResult:
+    """Tuned training settings and how they were found"""
+
+    device: DeviceInfo
+    workload_key: str
+    precision: str
+    per_device_train_batch_size: int
+    gradient_accumulation_steps: int
+    effective_batch_size: int
+    target_effective_batch_size: int
+    tokens_per_sec: float
+    seq_length: int
+    candidates: List[Candidate] = field(default_factory=list)
+    probe_seconds: float = 0.0
+    tuned_at: str = ""
+
+
+def probe_device(dist_ctx: "DistributedContext") -> DeviceInfo:
+    """
+    Describe the device this rank trains on
+
+    Args:
+        dist_ctx: Distributed context
+
+    Returns:
+        DeviceInfo
+    """
+    import torch
+
+    if not dist_ctx.use_cpu and torch.cuda.is_available():
+        props = torch.cuda.get_device_properties(dist_ctx.local_rank)
+        return DeviceInfo(
+            kind="cuda",
+            name=props.name,
+            memory_gb=props.total_memory / 1024 ** 3,
+            cores=props.multi_processor_count,
+            bf16=torch.cuda.is_bf16_supported(),
+            world_size=dist_ctx.world_size
+        )
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    import platform
+
+    return DeviceInfo(
+        kind="cpu",
+        name=platform.processor() or platform.machine(),
+        memory_gb=_available_host_memory_gb(),
+        cores=cores or 1,
+        # Emulated bf16 is slower than fp32; the throughput probe decides
+        bf16=True,
+        world_size=dist_ctx.world_size
+    )
+
+
+def _available_host_memory_gb() -> float:
+    """Available host RAM (MemAvailable on Linux, total RAM elsewhere)"""
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return 0.0
+
+
+def candidate_precisions(device: DeviceInfo) -> List[str]:
+    """Precisions worth probing on a device (fp16 autocast needs CUDA)"""
+    if device.kind == "cuda":
+        return (["bf16"] if device.bf16 else []) + ["fp16", "fp32"]
+    return ["fp32", "bf16"] if device.bf16 else ["fp32"]
+
+
+def workload_key(model_config: ModelConfig, training_config: TrainingConfig, target_effective_batch: int) -> str:
+    """
+    Hash of the settings that change memory use and speed per sample
+
+    Args:
+        model_config: Model configuration
+        training_config: Training configuration
+        target_effective_batch: Effective batch size to preserve
+
+    Returns:
+        16-character hex key
+    """
+    fields = {
+        "model_name": model_config.model_name,
+        "load_in_4bit": model_config.load_in_4bit,
+        "max_seq_length": model_config.max_seq_length,
+        "lora_r": model_config.lora_r,
+        "lora_target_modules": list(model_config.lora_target_modules),
+        "lora_modules_to_save": list(model_config.lora_modules_to_save),
+        "gradient_checkpointing": training_config.gradient_checkpointing,
+        "target_effective_batch": target_effective_batch,
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def _peak_memory_gb() -> float:
+    """Peak CUDA allocator memory since the last reset"""
+    import torch
+
+    return torch.cuda.max_memory_allocated() / 1024 ** 3
+
+
+def _current_rss_gb() -> Optional[float]:
+    """Current resident set size of this process (None if unavailable)"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 3
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 1024 ** 3
+
+
+def _release_host_memory():
+    """Return freed heap pages to the OS, so RSS drops back after a step"""
+    import ctypes
+    import gc
+
+    gc.collect()
+    try:
+        # glibc keeps freed memory mapped; a later, smaller step would
+        # reuse it and show no growth
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _step_rss_gb(model, micro_batch: int, seq_length: int, precision: str, device: DeviceInfo, generator):
+    """
+    Run one step on the CPU, sampling RSS from a background thread
+
+    ru_maxrss can't be used: it is a lifetime peak, already set by model
+    loading and earlier probes.
+
+    Returns:
+        Tuple of (RSS before the step, peak RSS during it) in GB
+    """
+    import threading
+
+    _release_host_memory()
+    before = _current_rss_gb()
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(RSS_SAMPLE_SECONDS):
+            peak[0] = max(peak[0], _current_rss_gb())
+
+    sampler = threading.Thread(target=sample, name="rss-sampler", daemon=True)
+    sampler.start()
+    try:
+        _train_step(model, micro_batch, seq_length, precision, device, generator)
+    finally:
+        done.set()
+        sampler.join()
+    return before, peak[0]
+
+
+def _train_step(model, micro_batch: int, seq_length: int, precision: str, device: DeviceInfo, generator):
+    """One forward+backward pass on random full-length sequences"""
+    import torch
+
+    vocab_size = model.get_input_embeddings().weight.shape[0]
+    target = next(p for p in model.parameters() if p.requires_grad).device
+    input_ids = torch.randint(0, vocab_size, (micro_batch, seq_length), generator=generator).to(target)
+
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(precision)
+    autocast = torch.autocast(device.kind, dtype=dtype, enabled=dtype is not None)
+    with autocast:
+        loss = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), labels=input_ids).loss
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+
+def _is_oom(error: BaseException) -> bool:
+    return "out of memory" in str(error).lower()
+
+
+def _fits(model, micro_batch: int, seq_length: int, precision: str, device: DeviceInfo, generator) -> Optional[float]:
+    """
+    Try one step on the GPU
+
+    Returns:
+        Peak memory in GB, or None if the step ran out of memory or
+        exceeded MEMORY_HEADROOM
+    """
+    import torch
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+    try:
+        _train_step(model, micro_batch, seq_length, precision, device, generator)
+        torch.cuda.synchronize()
+    except RuntimeError as e:
+        if not _is_oom(e):
+            raise
+        model.zero_grad(set_to_none=True)
+        torch.cuda.empty_cache()
+        return None
+
+    peak = _peak_memory_gb()
+    return peak if peak <= MEMORY_HEADROOM * device.memory_gb else None
+
+
+def find_max_micro_batch(
+    model,
+    seq_length: int,
+    precision: str,
+    device: DeviceInfo,
+    cap: int,
+    generator
+) -> Candidate:
+    """
+    Largest micro-batch (<= cap) whose step fits in device memory
+
+    Args:
+        model: PEFT model in train mode
+        seq_length: Sequence length of training batches
+        precision: "fp16", "bf16" or "fp32"
+        device: Probed device
+        cap: Largest micro-batch worth trying
+        generator: torch.Generator for the probe inputs
+
+    Returns:
+        Candidate (micro_batch 0 with an error if nothing fits)
+    """
+    if device.kind == "cuda":
+        # Double until out of memory, then bisect
+        fit, fail, peak = 0, None, None
+        batch = 1
+        while batch <= cap:
+            step_peak = _fits(model, batch, seq_length, precision, device, generator)
+            if step_peak is None:
+                fail = batch
+                break
+            fit, peak = batch, step_peak
+            batch *= 2
+        upper = min(fail or cap + 1, cap + 1)
+        while fit and upper - fit > 1:
+            mid = (fit + upper) // 2
+            step_peak = _fits(model, mid, seq_length, precision, device, generator)
+            if step_peak is None:
+                upper = mid
+            else:
+                fit, peak = mid, step_peak
+        if not fit:
+            return Candidate(precision, 0, error="micro-batch 1 does not fit")
+        return Candidate(precision, fit, peak_memory_gb=peak)
+
+    # CPU: extrapolate the step's RSS growth from batch 1 and 2 (a host OOM would kill us)
+    if _current_rss_gb() is None:
+        _train_step(model, 1, seq_length, precision, device, generator)
+        return Candidate(precision, 1)
+    resident, peak_one = _step_rss_gb(model, 1, seq_length, precision, device, generator)
+    if cap == 1:
+        return Candidate(precision, 1, peak_memory_gb=peak_one)
+    _, peak_two = _step_rss_gb(model, 2, seq_length, precision, device, generator)
+    growth_one = peak_one - resident
+    # Growth that did not scale with the batch is sampling noise; assume it all does
+    per_sample = peak_two - peak_one if peak_two > peak_one else growth_one
+    per_sample = max(per_sample, 1e-3)
+    # Headroom applies to the whole process, like the GPU's total memory
+    budget = MEMORY_HEADROOM * (resident + _available_host_memory_gb()) - resident
+    fit = max(1, min(cap, 1 + int((budget - growth_one) / per_sample)))
+    return Candidate(precision, fit, peak_memory_gb=peak_one + (fit - 1) * per_sample)
+
+
+def measure_throughput(model, candidate: Candidate, seq_length: int, device: DeviceInfo, generator) -> float:
+    """Training tokens/s at a candidate's micro-batch (after one warm-up step)"""
+    import torch
+
+    _train_step(model, candidate.micro_batch, seq_length, candidate.precision, device, generator)
+    if device.kind == "cuda":
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+    for _ in range(PROBE_STEPS):
+        _train_step(model, candidate.micro_batch, seq_length, candidate.precision, device, generator)
+    if device.kind == "cuda":
+        torch.cuda.synchronize()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    return PROBE_STEPS * candidate.micro_batch * seq_length / elapsed
+
+
+def split_effective_batch(target: int, world_size: int, max_micro_batch: int) -> tuple:
+    """
+    Micro-batch and accumulation steps closest to a target effective batch
+
+    Args:
+        target: Target effective batch size (all ranks)
+        world_size: Data-parallel processes
+        max_micro_batch: Largest micro-batch that fits
+
+    Returns:
+        Tuple of (micro_batch, accumulation_steps)
+    """
+    per_rank = max(1, math.ceil(target / world_size))
+    micro = max(1, min(max_micro_batch, per_rank))
+    accumulation = math.ceil(per_rank / micro)
+    # Spread the batch evenly over the accumulation steps
+    micro = math.ceil(per_rank / accumulation)
+    return micro, accumulation
+
+
+def autotune(
+    model,
+    model_config: ModelConfig,
+    training_config: TrainingConfig,
+    dist_ctx: "DistributedContext"
+) -> TuneResult:
+    """
+    Probe the device and pick micro-batch, accumulation and precision
+
+    The model is left unchanged: no optimizer step runs, gradients are
+    cleared and RNG state is restored afterwards.
+
+    Args:
+        model: PEFT model (adapter attached)
+        model_config: Model configuration
+        training_config: Training configuration (its batch settings give
+            the target effective batch)
+        dist_ctx: Distributed context
+
+    Returns:
+        TuneResult
+    """
+    import torch
+
+    start = time.perf_counter()
+    device = probe_device(dist_ctx)
+    target = (
+        training_config.per_device_train_batch_size
+        * training_config.gradient_accumulation_steps
+        * dist_ctx.world_size
+    )
+    cap = min(MAX_MICRO_BATCH, max(1, math.ceil(target / dist_ctx.world_size)))
+    seq_length = model_config.max_seq_length
+
+    print(f"🔧 Auto-tuning for {device.kind}: {device.name}")
+    print(f"   Memory: {device.memory_gb:.1f} GB | Cores: {device.cores} | Processes: {device.world_size}")
+    print(f"   Target effective batch: {target} | Sequence length: {seq_length}")
+
+    # Probing must not change training: keep RNG streams and model state
+    rng_state = torch.random.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    was_training = model.training
+    model.train()
+    if not dist_ctx.use_cpu and torch.cuda.is_available():
+        first_param = next(model.parameters())
+        if first_param.device.type == "cpu" and not model_config.load_in_4bit:
+            model.to(dist_ctx.device)
+    if training_config.gradient_checkpointing:
+        model.gradient_checkpointing_enable(
+            gradient_checkpointing_kwargs={"use_reentrant": False} if dist_ctx.is_distributed else None
+        )
+    generator = torch.Generator().manual_seed(0)
+
+    candidates = []
+    try:
+        for precision in candidate_precisions(device):
+            try:
+                candidate = find_max_micro_batch(model, seq_length, precision, device, cap, generator)
+                if candidate.micro_batch:
+                    candidate.tokens_per_sec = measure_throughput(model, candidate, seq_length, device, generator)
+            except RuntimeError as e:
+                # e.g. bf16 kernels missing on this device
+                model.zero_grad(set_to_none=True)
+                candidate = Candidate(precision, 0, error=str(e).splitlines()[0][:120])
+            candidates.append(candidate)
+            status = (
+                f"micro-batch {candidate.micro_batch}, {candidate.tokens_per_sec:,.0f} tokens/s"
+                if candidate.micro_batch else f"skipped ({candidate.error})"
+            )
+            print(f"   {precision}: {status}")
+    finally:
+        torch.random.set_rng_state(rng_state)
+        if cuda_rng_state is not None:
+            torch.cuda.set_rng_state_all(cuda_rng_state)
+        model.train(was_training)
+        if device.kind == "cuda":
+            torch.cuda.empty_cache()
+
+    viable = [c for c in candidates if c.micro_batch]
+    if not viable:
+        raise RuntimeError(f"No precision fits a micro-batch of 1 on {device.name}")
+    best = max(viable, key=lambda c: c.tokens_per_sec)
+    precision, max_micro = best.precision, best.micro_batch
+
+    # All ranks must agree: smallest fit, rank 0's precision
+    if dist_ctx.is_distributed:
+        import torch.distributed as dist
+
+        fit = torch.tensor([max_micro], device=dist_ctx.device)
+        dist.all_reduce(fit, op=dist.ReduceOp.MIN)
+        max_micro = int(fit.item())
+        choice = [precision]
+        dist.broadcast_object_list(choice, src=0)
+        precision = choice[0]
+
+    micro, accumulation = split_effective_batch(target, dist_ctx.world_size, max_micro)
+    return TuneResult(
+        device=device,
+        workload_key=workload_key(model_config, training_config, target),
+        precision=precision,
+        per_device_train_batch_size=micro,
+        gradient_accumulation_steps=accumulation,
+        effective_batch_size=micro * accumulation * dist_ctx.world_size,
+        target_effective_batch_size=target,
+        tokens_per_sec=best.tokens_per_sec,
+        seq_length=seq_length,
+        candidates=candidates,
+        probe_seconds=time.perf_counter() - start,
+        tuned_at=datetime.now().isoformat()
+    )
+
+
+def apply_tuning(training_config: TrainingConfig, result: TuneResult):
+    """
+    Apply tuned values to a training configuration (in place)
+
+    Args:
+        training_config: Training configuration
+        result: Auto-tune result
+    """
+    training_config.per_device_train_batch_size = result.per_device_train_batch_size
+    training_config.per_device_eval_batch_size = result.per_device_train_batch_size
+    training_config.gradient_accumulation_steps = result.gradient_accumulation_steps
+    training_config.fp16 = result.precision == "fp16"
+    training_config.bf16 = result.precision == "bf16"
+
+
+def write_run_config(
+    output_dir: str,
+    configs: tuple,
+    result: Optional[TuneResult] = None
+) -> Path:
+    """
+    Write the resolved run configuration (and auto-tune result) as JSON
+
+    Args:
+        output_dir: Run output directory
+        configs: (model_config, training_config, data_config, experiment_config)
+        result: Auto-tune result (None = not tuned)
+
+    Returns:
+        Path of run_config.json
+    """
+    model_config, training_config, data_config, experiment_config = configs
+    run_config = {
+        "model": asdict(model_config),
+        "training": asdict(training_config),
+        "data": asdict(data_config),
+        "experiment": asdict(experiment_config),
+        "autotune": asdict(result) if result is not None else None,
+    }
+    path = Path(output_dir) / RUN_CONFIG_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run_config, f, indent=2, default=str)
+    return path
+
+
+def load_cached_tuning(output_dir: str, device: DeviceInfo, key: str) -> Optional[TuneResult]:
+    """
+    Reuse a previous auto-tune result for the same device and workload
+
+    Args:
+        output_dir: Run output directory
+        device: Probed device
+        key: Workload key (see workload_key)
+
+    Returns:
+        TuneResult, or None if there is no matching result
+    """
+    path = Path(output_dir) / RUN_CONFIG_FILE
+    if not path.exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f).get("autotune")
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not cached or cached.get("workload_key") != key:
+        return None
+
+    cached_device = DeviceInfo(**cached.pop("device"))
+    # Available RAM fluctuates; only the hardware identity has to match
+    if (cached_device.kind, cached_device.name, cached_device.cores, cached_device.world_size) != \
+            (device.kind, device.name, device.cores, device.world_size):
+        return None
+    if device.kind == "cuda" and round(cached_device.memory_gb) != round(device.memory_gb):
+        return None
+
+    candidates = [Candidate(**c) for c in cached.pop("candidates", [])]
+    return TuneResult(device=cached_device, candidates=candidates, **cached)
+
+
+def tune_run(
+    model,
+    configs: tuple,
+    dist_ctx: "DistributedContext",
+    result: Optional[TuneResult] = None
+) -> TuneResult:
+    """
+    Auto-tune a run (or reuse a cached result) and record it
+
+    Args:
+        model: PEFT model (adapter attached)
+        configs: (model_config, training_config, data_config, experiment_config);
+            training_config is updated in place
+        dist_ctx: Distributed context
+        result: Result to apply without probing (paired runs share one)
+
+    Returns:
+        TuneResult
+    """
+    model_config, training_config, _, experiment_config = configs
+    target = (
+        training_config.per_device_train_batch_size
+        * training_config.gradient_accumulation_steps
+        * dist_ctx.world_size
+    )
+
+    key = workload_key(model_config, training_config, target)
+
+    if result is not None and result.workload_key == key:
+        print("🔧 Applying auto-tune result from the previous adapter")
+    else:
+        result = load_cached_tuning(experiment_config.output_dir, probe_device(dist_ctx), key)
+        if result is not None:
+            print(f"🔧 Reusing auto-tune result from {Path(experiment_config.output_dir) / RUN_CONFIG_FILE}")
+        else:
+            result = autotune(model, model_config, training_config, dist_ctx)
+
+    apply_tuning(training_config, result)
+    print(f"   ✅ {result.precision}, micro-batch {result.per_device_train_batch_size} x "
+          f"{result.gradient_accumulation_steps} accumulation x {dist_ctx.world_size} process(es) "
+          f"= effective batch {result.effective_batch_size} (target {result.target_effective_batch_size})")
+
+    if dist_ctx.is_main_process:
+        path = write_run_config(experiment_config.output_dir, configs, result)
+        print(f"   Run config: {path}")
+    return result
+
+
+def main():
+    """Probe this machine and write run_config.json without training"""
+    parser = argparse.ArgumentParser(description="Auto-tune batch size, accumulation and precision")
+    parser.add_argument(
+        "--stage",
+        type=str,
+        default="stage1",
+        choices=["smoke", "stage1", "stage4"],
+        help="Training stage whose configuration is tuned"
+    )
+    parser.add_argument(
+        "--experiment-type",
+        type=str,
+        default="control",
+        choices=["control", "experiment"],
+        help="Experiment type (selects the output dir)"
+    )
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Tune for CPU training"
+    )
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Prepared base-model cache directory"
+    )
+    args = parser.parse_args()
+
+    from distributed import cleanup_distributed
+    from train import metadata_tokens, prepare_run_config, setup_model, setup_tokenizer, start_run
+
+    dist_ctx = start_run(args.stage, DistributedConfig(use_cpu=args.cpu))
+    try:
+        configs = prepare_run_config(
+            args.stage, args.experiment_type, dist_ctx, model_cache_dir=args.model_cache
+        )
+        tokenizer = setup_tokenizer(configs[0], metadata_tokens(configs[2], args.experiment_type))
+        print()
+        model = setup_model(configs[0], dist_ctx, tokenizer)
+        print()
+        tune_run(model, configs, dist_ctx)
+    finally:
+        cleanup_distributed()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1051 @@
+"""
+Training Callbacks
+
+TrainerCallback implementations shared by the training entry points
+(train.py, sweep.py, halving.py).
+"""
+
+import json
+import os
+import sys
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from transformers import TrainerCallback
+
+if TYPE_CHECKING:
+    from distributed import DistributedContext
+
+
+class RungStopCallback(TrainerCallback):
+    """
+    Stop training at a rung boundary with a fresh eval and checkpoint
+
+    Runs alongside the regular callbacks; the Trainer's own eval/save
+    schedule is unchanged between rungs.
+    """
+
+    def __init__(self, stop_step: int):
+        """
+        Args:
+            stop_step: Global step at which the rung ends
+        """
+        self.stop_step = stop_step
+        self.eval_loss: Optional[float] = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step >= self.stop_step:
+            control.should_evaluate = True
+            control.should_save = True
+            control.should_training_stop = True
+        return control
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if metrics and "eval_loss" in metrics and state.global_step >= self.stop_step:
+            self.eval_loss = metrics["eval_loss"]
+
+
+class PlateauStoppingCallback(TrainerCallback):
+    """
+    Stop training when the eval metric plateaus or a stage budget runs out
+
+    - Plateau: `patience` evaluations in a row without improving the best
+      metric by more than `min_delta`
+    - Budget: wall-clock minutes or input tokens seen (incl. padding)
+
+    Every improving evaluation forces a checkpoint, so the best adapter is
+    always on disk (and restored by load_best_model_at_end). At the end of
+    training a summary of the compute saved versus the planned run is
+    printed and written to `early_stopping_summary.json` in output_dir.
+    """
+
+    def __init__(
+        self,
+        patience: int = 2,
+        min_delta: float = 0.0,
+        max_minutes: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        metric: str = "eval_loss",
+        greater_is_better: bool = False,
+        plateau: bool = True
+    ):
+        """
+        Args:
+            patience: Evaluations without improvement before stopping
+            min_delta: Minimum improvement that resets patience
+            max_minutes: Wall-clock budget for this run (None = unlimited)
+            max_tokens: Input-token budget (None = unlimited)
+            metric: Metric to monitor
+            greater_is_better: Whether larger metric values are better
+            plateau: Stop on plateaus (False = budgets only)
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_minutes = max_minutes
+        self.max_tokens = max_tokens
+        self.metric = metric if metric.startswith("eval_") else f"eval_{metric}"
+        self.greater_is_better = greater_is_better
+        self.plateau = plateau
+
+        self.best_metric: Optional[float] = None
+        self.best_step: Optional[int] = None
+        self._plateau_reference: Optional[float] = None
+        self.evals_without_improvement = 0
+        self.stop_reason: Optional[str] = None
+        self._start_time = 0.0
+        self._start_step = 0
+
+    def _better(self, value: float, reference: Optional[float], delta: float = 0.0) -> bool:
+        if reference is None:
+            return True
+        if self.greater_is_better:
+            return value > reference + delta
+        return value < reference - delta
+
+    def _stop(self, control, reason: str):
+        if self.stop_reason is None:
+            self.stop_reason = reason
+            print(f"\n🛑 Early stop: {reason}")
+        control.should_training_stop = True
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._start_time = time.perf_counter()
+        self._start_step = state.global_step
+        if self.max_tokens is not None and not args.include_num_input_tokens_seen:
+            print("   ⚠️  Token budget ignored: include_num_input_tokens_seen is off")
+
+    def on_step_end(self, args, state, control, **kwargs):
+        elapsed_minutes = (time.perf_counter() - self._start_time) / 60
+        if self.max_minutes is not None and elapsed_minutes >= self.max_minutes:
+            self._stop(control, f"time budget of {self.max_minutes:g} min reached")
+            control.should_save = True
+        elif self.max_tokens is not None and state.num_input_tokens_seen >= self.max_tokens:
+            self._stop(control, f"token budget of {self.max_tokens:,} reached")
+            control.should_save = True
+        return control
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        value = (metrics or {}).get(self.metric)
+        if value is None:
+            return control
+
+        if self._better(value, self.best_metric):
+            self.best_metric = value
+            self.best_step = state.global_step
+            # Keep the best adapter on disk even between save_steps
+            control.should_save = True
+
+        if self._better(value, self._plateau_reference, self.min_delta):
+            self._plateau_reference = value
+            self.evals_without_improvement = 0
+        else:
+            self.evals_without_improvement += 1
+            if self.plateau and self.evals_without_improvement >= self.patience:
+                self._stop(
+                    control,
+                    f"{self.metric} improved less than {self.min_delta:g} "
+                    f"for {self.patience} evals (best {self.best_metric:.4f} at step {self.best_step})"
+                )
+        return control
+
+    def summary(self, state) -> Dict[str, Any]:
+        """
+        Compute saved versus the planned run
+
+        Args:
+            state: TrainerState at the end of training
+
+        Returns:
+            Summary dict
+        """
+        elapsed = time.perf_counter() - self._start_time
+        steps_run = state.global_step - self._start_step
+        steps_saved = max(0, state.max_steps - state.global_step)
+        seconds_per_step = elapsed / steps_run if steps_run else 0.0
+        tokens_per_step = state.num_input_tokens_seen / state.global_step if state.global_step else 0.0
+
+        return {
+            "stopped_early": self.stop_reason is not None,
+            "stop_reason": self.stop_reason,
+            "stopped_at_step": state.global_step,
+            "planned_steps": state.max_steps,
+            "steps_saved": steps_saved,
+            "steps_saved_pct": 100 * steps_saved / state.max_steps if state.max_steps else 0.0,
+            "elapsed_seconds": elapsed,
+            "estimated_seconds_saved": steps_saved * seconds_per_step,
+            "estimated_tokens_saved": int(steps_saved * tokens_per_step) if tokens_per_step else None,
+            "best_metric": self.best_metric,
+            "best_step": self.best_step,
+            "metric": self.metric,
+            "best_model_checkpoint": state.best_model_checkpoint,
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+
+        summary = self.summary(state)
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "early_stopping_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+        print()
+        print("⏹️  Early stopping summary:")
+        if summary["stopped_early"]:
+            print(f"   Stopped at step {summary['stopped_at_step']}/{summary['planned_steps']}: {summary['stop_reason']}")
+            print(f"   Saved: {summary['steps_saved']} steps ({summary['steps_saved_pct']:.0f}%), "
+                  f"~{summary['estimated_seconds_saved'] / 60:.1f} min")
+        else:
+            print(f"   Ran all {summary['planned_steps']} steps (no plateau, within budget)")
+        if summary["best_metric"] is not None:
+            print(f"   Best {summary['metric']}: {summary['best_metric']:.4f} at step {summary['best_step']}")
+
+
+class TargetLossCallback(TrainerCallback):
+    """
+    Record when the eval metric first reaches a target
+
+    Reports optimizer steps, samples and wall-clock seconds to the target,
+    so runs with different sampling (see sampling.py) can be compared on
+    time-to-quality rather than final loss. Printed at the end of training
+    and written to `time_to_target.json` in output_dir.
+    """
+
+    def __init__(
+        self,
+        target: float,
+        metric: str = "eval_loss",
+        greater_is_better: bool = False,
+        sampling: str = "uniform"
+    ):
+        """
+        Args:
+            target: Metric value to reach
+            metric: Metric to monitor
+            greater_is_better: Whether larger metric values are better
+            sampling: Label for the run's sampling ("uniform" or "loss_aware")
+        """
+        self.target = target
+        self.metric = metric if metric.startswith("eval_") else f"eval_{metric}"
+        self.greater_is_better = greater_is_better
+        self.sampling = sampling
+
+        self.reached_step: Optional[int] = None
+        self.reached_seconds: Optional[float] = None
+        self.reached_samples: Optional[int] = None
+        self.reached_value: Optional[float] = None
+        self._start_time = 0.0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._start_time = time.perf_counter()
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        value = (metrics or {}).get(self.metric)
+        if value is None or self.reached_step is not None:
+            return control
+
+        reached = value >= self.target if self.greater_is_better else value <= self.target
+        if reached:
+            self.reached_step = state.global_step
+            self.reached_seconds = time.perf_counter() - self._start_time
+            self.reached_samples = state.global_step * args.per_device_train_batch_size \
+                * args.gradient_accumulation_steps * args.world_size
+            self.reached_value = value
+            if state.is_world_process_zero:
+                print(f"\n🎯 {self.metric} {value:.4f} reached target {self.target:g} "
+                      f"at step {self.reached_step} ({self.reached_seconds:.0f}s)")
+        return control
+
+    def summary(self) -> Dict[str, Any]:
+        """Time-to-target result"""
+        return {
+            "sampling": self.sampling,
+            "metric": self.metric,
+            "target": self.target,
+            "reached": self.reached_step is not None,
+            "steps_to_target": self.reached_step,
+            "samples_to_target": self.reached_samples,
+            "seconds_to_target": self.reached_seconds,
+            "value_at_target": self.reached_value,
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+
+        summary = self.summary()
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "time_to_target.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+        print()
+        print(f"🎯 Time to {self.metric} <= {self.target:g} ({self.sampling} sampling):")
+        if summary["reached"]:
+            print(f"   {summary['steps_to_target']} steps, {summary['samples_to_target']} samples, "
+                  f"{summary['seconds_to_target']:.0f}s")
+        else:
+            print(f"   Not reached in {state.global_step} steps")
+
+
+class PassAtOneProbeCallback(TrainerCallback):
+    """
+    Greedy pass@1 on a fixed validation subset every `every` steps
+
+    eval_loss says little about whether completions pass their tests.
+    At each probe step the main process generates completions for a small
+    fixed subset of the validation file. Decoding is batched and greedy,
+    on the plain prompts as in compare.py. The tests then run in the
+    evaluator's sandbox (evaluation/execution.py), one process per check.
+    Training continues while they run.
+
+    A finished probe is printed and added to the next log as
+    `probe_pass@1` and `probe_step` (the step it measured). It is also
+    written to `probe_history.json` in output_dir.
+
+    With `patience`, training stops (with a checkpoint) after that many
+    probes in a row without beating the best pass@1 by more than
+    `min_delta`. All ranks agree on the stop at the same step.
+    """
+
+    def __init__(
+        self,
+        samples: List[Dict[str, Any]],
+        tokenizer,
+        every: int,
+        batch_size: int = 8,
+        max_new_tokens: int = 256,
+        timeout: float = 5.0,
+        workers: Optional[int] = None,
+        patience: Optional[int] = None,
+        min_delta: float = 0.0
+    ):
+        """
+        Args:
+            samples: Probe subset (see probe.select_probe_samples)
+            tokenizer: Training tokenizer
+            every: Probe every N optimizer steps
+            batch_size: Prompts per generate() call
+            max_new_tokens: Token limit per completion
+            timeout: Seconds per test
+            workers: Tests running at once (None = all cores but one)
+            patience: Probes without improvement before stopping (None = log only)
+            min_delta: Smaller pass@1 gains count as no improvement
+        """
+        from probe import ExecutionEngine
+
+        self.samples = samples
+        self.tokenizer = tokenizer
+        self.every = every
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.patience = patience
+        self.min_delta = min_delta
+        self.engine = ExecutionEngine(workers=workers or max(1, (os.cpu_count() or 2) - 1), timeout=timeout)
+
+        self.history: List[Dict[str, Any]] = []
+        self.best: Optional[float] = None
+        self.best_step: Optional[int] = None
+        self.probes_without_improvement = 0
+        self.stop_reason: Optional[str] = None
+        self._pending: List[Tuple[int, float, float, Any]] = []
+        self._unlogged: List[Dict[str, Any]] = []
+
+    def _history_file(self, args) -> str:
+        return os.path.join(args.output_dir, "probe_history.json")
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # Resumed run: keep the probes up to the checkpoint
+        if state.global_step == 0 or not os.path.exists(self._history_file(args)):
+            return
+        with open(self._history_file(args), "r", encoding="utf-8") as f:
+            for entry in json.load(f)["probes"]:
+                if entry["step"] <= state.global_step:
+                    self._record(entry, quiet=True)
+
+    def _launch(self, model, state):
+        from probe import generate_completions, probe_check
+
+        start = time.perf_counter()
+        completions = generate_completions(
+            model, self.tokenizer, [sample["prompt"] for sample in self.samples],
+            batch_size=self.batch_size, max_new_tokens=self.max_new_tokens
+        ).completions
+        generation_seconds = time.perf_counter() - start
+        future = self.engine.submit([
+            probe_check(sample, completion)
+            for sample, completion in zip(self.samples, completions)
+        ])
+        self._pending.append((state.global_step, generation_seconds, time.perf_counter(), future))
+
+    def _collect(self, wait: bool = False):
+        """Record finished probes (optionally waiting for all of them)"""
+        from probe import TIMEOUT
+
+        still_pending = []
+        for step, generation_seconds, submitted, future in self._pending:
+            if not wait and not future.done():
+                still_pending.append((step, generation_seconds, submitted, future))
+                continue
+
+            # Every check has its own timeout, so a probe always finishes
+            results = future.result()
+            passed = sum(result.passed for result in results)
+            self._record({
+                "step": step,
+                "pass@1": passed / len(results) if results else 0.0,
+                "passed": passed,
+                "timeouts": sum(result.outcome == TIMEOUT for result in results),
+                "total": len(results),
+                "generation_seconds": generation_seconds,
+                "test_seconds": time.perf_counter() - submitted,
+                "failed_tasks": [
+                    sample["task_id"] for sample, result in zip(self.samples, results) if not result.passed
+                ],
+            })
+        self._pending = still_pending
+
+    def _record(self, entry: Dict[str, Any], quiet: bool = False):
+        self.history.append(entry)
+        value = entry["pass@1"]
+        if self.best is None or value > self.best + self.min_delta:
+            self.probes_without_improvement = 0
+        else:
+            self.probes_without_improvement += 1
+        if self.best is None or value > self.best:
+            self.best, self.best_step = value, entry["step"]
+        if quiet:
+            return
+
+        self._unlogged.append(entry)
+        print(f"\n🧪 Probe @ step {entry['step']}: pass@1 {value:.1%} ({entry['passed']}/{entry['total']}"
+              + (f", {entry['timeouts']} timed out" if entry["timeouts"] else "")
+              + f") - generate {entry['generation_seconds']:.1f}s, tests {entry['test_seconds']:.1f}s")
+        if self.patience is not None and self.probes_without_improvement >= self.patience and self.stop_reason is None:
+            self.stop_reason = (f"probe pass@1 did not improve for {self.patience} probes "
+                                f"(best {self.best:.1%} at step {self.best_step})")
+            print(f"🛑 Early stop: {self.stop_reason}")
+
+    def _agree_stop(self, args) -> bool:
+        """Broadcast the main process's decision, so all ranks stop at the same step"""
+        import torch
+        import torch.distributed as dist
+
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return self.stop_reason is not None
+
+        flag = torch.tensor([1 if self.stop_reason is not None else 0], device=args.device)
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+        return bool(flag.item())
+
+    def on_step_end(self, args, state, control, model=None, **kwargs):
+        if state.is_world_process_zero:
+            self._collect()
+            if state.global_step % self.every == 0:
+                self._launch(model, state)
+        if self.patience is not None and self._agree_stop(args):
+            control.should_save = True
+            control.should_training_stop = True
+        return control
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is not None and self._unlogged:
+            latest = self._unlogged[-1]
+            logs["probe_pass@1"] = latest["pass@1"]
+            logs["probe_step"] = latest["step"]
+            self._unlogged = []
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+
+        self._collect(wait=True)
+        self.engine.shutdown()
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(self._history_file(args), "w", encoding="utf-8") as f:
+            json.dump({
+                "task_ids": [sample["task_id"] for sample in self.samples],
+                "best_pass@1": self.best,
+                "best_step": self.best_step,
+                "stop_reason": self.stop_reason,
+                "probes": self.history,
+            }, f, indent=2)
+
+        if self.history:
+            print()
+            print(f"🧪 pass@1 probe ({len(self.samples)} val samples): "
+                  + " -> ".join(f"{entry['pass@1']:.0%}@{entry['step']}" for entry in self.history[-8:]))
+            print(f"   Best {self.best:.1%} at step {self.best_step}")
+
+
+def _host_peak_memory_mb() -> Optional[float]:
+    """Peak resident set size of this process in MB (None if unavailable)"""
+    try:
+        import resource
+    except ImportError:
+        # Windows: fall back to current RSS if psutil is installed
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().rss / 1024 ** 2
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Per-logging-window throughput and memory metrics
+
+    For every logging step records:
+    - tokens/s (all and non-padding) and samples/s
+    - mean optimizer-step latency
+    - padding ratio of the training batches
+    - dataloader stall: time from the end of one micro-batch to the forward
+      of the next (batch fetch + collate + host-to-device copy)
+    - starved batches: micro-batches whose wait exceeded STARVED_FRACTION
+      of the previous micro-batch's compute, and the longest single wait.
+      The mean stall can hide occasional starvation; these show it
+    - peak memory: torch.cuda.max_memory_allocated, or process peak RSS
+
+    Evaluation and checkpoint time is excluded from all rates.
+
+    Metrics go to TensorBoard (`perf/*` in logging_dir) and to
+    `throughput.jsonl` in logging_dir; an end-of-run summary is printed.
+    Under DDP every rank measures its own share and the metrics are
+    averaged across ranks before rank 0 writes them (rates stay per rank).
+    """
+
+    # A wait longer than this fraction of a micro-batch's compute counts as starved
+    STARVED_FRACTION = 0.1
+
+    def __init__(self, dist_ctx: Optional["DistributedContext"] = None):
+        """
+        Args:
+            dist_ctx: Distributed context (None = single process)
+        """
+        self.dist_ctx = dist_ctx
+        self._hook = None
+        self._writer = None
+        self._jsonl = None
+        self._cuda = False
+        self._reset_window()
+        self._totals = {
+            "tokens": 0, "real_tokens": 0, "samples": 0, "stall": 0.0, "steps": 0, "paused": 0.0,
+            "batches": 0, "starved": 0
+        }
+        self._step_latencies: List[float] = []
+        self._peak_memory_mb = 0.0
+        self._max_stall = 0.0
+        self._train_start = 0.0
+        self._step_start = 0.0
+        self._last_micro_end: Optional[float] = None
+        self._forward_start: Optional[float] = None
+        self._last_compute: Optional[float] = None
+        self._pending_real_tokens = None  # Device tensor, read once per logging window
+
+    def _reset_window(self):
+        self._window = {
+            "tokens": 0, "real_tokens": 0, "samples": 0, "stall": 0.0,
+            "steps": 0, "step_time": 0.0, "paused": 0.0,
+            "batches": 0, "starved": 0, "max_stall": 0.0
+        }
+        self._window_start = time.perf_counter()
+
+    def _forward_pre_hook(self, module, args, kwargs):
+        if not module.training:
+            return
+        now = time.perf_counter()
+        if self._last_micro_end is not None:
+            wait = now - self._last_micro_end
+            self._window["stall"] += wait
+            self._window["batches"] += 1
+            self._window["max_stall"] = max(self._window["max_stall"], wait)
+            if self._last_compute is not None and wait > self.STARVED_FRACTION * self._last_compute:
+                self._window["starved"] += 1
+        self._forward_start = now
+
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        attention_mask = kwargs.get("attention_mask")
+        tokens = input_ids.numel()
+        if attention_mask is not None:
+            # Summed on the device: reading it here would sync before every forward
+            real_tokens = attention_mask.sum()
+            if self._pending_real_tokens is not None:
+                real_tokens = real_tokens + self._pending_real_tokens
+            self._pending_real_tokens = real_tokens
+        else:
+            self._window["real_tokens"] += tokens
+
+        self._window["tokens"] += tokens
+        self._window["samples"] += input_ids.shape[0]
+
+    def _collect_real_tokens(self):
+        if self._pending_real_tokens is not None:
+            self._window["real_tokens"] += int(self._pending_real_tokens.item())
+            self._pending_real_tokens = None
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        import torch
+
+        self._cuda = torch.cuda.is_available() and not args.use_cpu
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+        if model is not None:
+            self._hook = model.register_forward_pre_hook(self._forward_pre_hook, with_kwargs=True)
+
+        if state.is_world_process_zero:
+            os.makedirs(args.logging_dir, exist_ok=True)
+            self._jsonl = open(os.path.join(args.logging_dir, "throughput.jsonl"), "a", encoding="utf-8")
+            try:
+                from torch.utils.tensorboard import SummaryWriter
+                self._writer = SummaryWriter(log_dir=args.logging_dir)
+            except ImportError:
+                self._writer = None
+
+        self._train_start = time.perf_counter()
+        self._last_micro_end = time.perf_counter()
+        self._reset_window()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = time.perf_counter()
+
+    def _end_micro_batch(self, now: float):
+        if self._forward_start is not None:
+            self._last_compute = now - self._forward_start
+            self._forward_start = None
+        self._last_micro_end = now
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self._end_micro_batch(time.perf_counter())
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        self._end_micro_batch(now)
+        latency = now - self._step_start
+        self._window["step_time"] += latency
+        self._window["steps"] += 1
+        self._step_latencies.append(latency)
+
+    def _pause(self):
+        # Evaluation and checkpointing are neither training time nor stalls
+        now = time.perf_counter()
+        if self._last_micro_end is not None:
+            self._window["paused"] += now - self._last_micro_end
+        self._last_micro_end = now
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._pause()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._pause()
+
+    def _peak_memory(self) -> Optional[float]:
+        if self._cuda:
+            import torch
+
+            peak = torch.cuda.max_memory_allocated() / 1024 ** 2
+            torch.cuda.reset_peak_memory_stats()
+            return peak
+        return _host_peak_memory_mb()
+
+    def _average_over_ranks(self, metrics: Dict[str, Any]) -> Dict[str, Any]:
+        # Collective: every rank calls this at the same logging step
+        if self.dist_ctx is None or not self.dist_ctx.is_distributed:
+            return metrics
+        from distributed import all_reduce_mean
+
+        numeric = {
+            key: value for key, value in metrics.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        averaged = all_reduce_mean(numeric, self.dist_ctx)
+        return {**metrics, **{key: type(numeric[key])(value) for key, value in averaged.items()}}
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        window = self._window
+        if window["steps"] == 0:
+            return
+
+        self._collect_real_tokens()
+        elapsed = max(time.perf_counter() - self._window_start - window["paused"], 1e-9)
+        peak_memory_mb = self._peak_memory()
+        if peak_memory_mb is not None:
+            self._peak_memory_mb = max(self._peak_memory_mb, peak_memory_mb)
+
+        metrics = {
+            "tokens_per_sec": window["tokens"] / elapsed,
+            "real_tokens_per_sec": window["real_tokens"] / elapsed,
+            "samples_per_sec": window["samples"] / elapsed,
+            "step_latency_ms": 1000 * window["step_time"] / window["steps"],
+            "padding_ratio": 1 - window["real_tokens"] / window["tokens"] if window["tokens"] else 0.0,
+            "dataloader_stall_ms": 1000 * window["stall"] / window["steps"],
+            "dataloader_stall_pct": 100 * window["stall"] / elapsed,
+            "dataloader_stall_max_ms": 1000 * window["max_stall"],
+            "starved_batch_pct": 100 * window["starved"] / window["batches"] if window["batches"] else 0.0,
+            "peak_memory_mb": peak_memory_mb,
+        }
+
+        self._fold_window()
+        metrics = self._average_over_ranks(metrics)
+
+        if not state.is_world_process_zero:
+            return
+
+        if self._writer is not None:
+            for key, value in metrics.items():
+                if value is not None:
+                    self._writer.add_scalar(f"perf/{key}", value, state.global_step)
+            self._writer.flush()
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps({"step": state.global_step, **metrics}) + "\n")
+            self._jsonl.flush()
+        self._last_micro_end = time.perf_counter()
+
+    def _fold_window(self):
+        self._collect_real_tokens()
+        for key in self._totals:
+            self._totals[key] += self._window[key]
+        self._max_stall = max(self._max_stall, self._window["max_stall"])
+        self._reset_window()
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Whole-run throughput summary
+
+        Returns:
+            Summary dict (per rank, averaged across ranks under DDP;
+            all ranks must call it together)
+        """
+        totals = self._totals
+        elapsed = max(time.perf_counter() - self._train_start - totals["paused"], 1e-9)
+        latencies = sorted(self._step_latencies)
+
+        def percentile(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        return self._average_over_ranks({
+            "steps": len(latencies),
+            "elapsed_seconds": elapsed,
+            "tokens": totals["tokens"],
+            "tokens_per_sec": totals["tokens"] / elapsed,
+            "real_tokens_per_sec": totals["real_tokens"] / elapsed,
+            "samples_per_sec": totals["samples"] / elapsed,
+            "step_latency_p50_ms": percentile(0.5),
+            "step_latency_p90_ms": percentile(0.9),
+            "padding_ratio": 1 - totals["real_tokens"] / totals["tokens"] if totals["tokens"] else 0.0,
+            "dataloader_stall_pct": 100 * totals["stall"] / elapsed,
+            "dataloader_stall_max_ms": 1000 * self._max_stall,
+            "starved_batch_pct": 100 * totals["starved"] / totals["batches"] if totals["batches"] else 0.0,
+            "peak_memory_mb": self._peak_memory_mb or None,
+            "peak_memory_kind": "cuda_allocated" if self._cuda else "host_rss",
+        })
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
+
+        # Fold in steps since the last log
+        self._fold_window()
+        summary = self.summary()
+
+        if not state.is_world_process_zero:
+            return
+
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps({"step": state.global_step, "summary": summary}) + "\n")
+            self._jsonl.close()
+            self._jsonl = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        world_size = args.world_size
+        print()
+        print("⚡ Throughput summary (per rank" + (f", mean of {world_size}" if world_size > 1 else "") + "):")
+        print(f"   Steps: {summary['steps']} in {summary['elapsed_seconds']:.1f}s (excl. eval/save)")
+        print(f"   Tokens/s: {summary['tokens_per_sec']:,.0f} "
+              f"({summary['real_tokens_per_sec']:,.0f} non-padding)"
+              + (f", x{world_size} ranks" if world_size > 1 else ""))
+        print(f"   Samples/s: {summary['samples_per_sec']:.2f}")
+        if summary["step_latency_p50_ms"] is not None:
+            print(f"   Step latency: p50 {summary['step_latency_p50_ms']:.0f} ms, "
+                  f"p90 {summary['step_latency_p90_ms']:.0f} ms")
+        print(f"   Padding ratio: {100 * summary['padding_ratio']:.1f}%")
+        print(f"   Dataloader stall: {summary['dataloader_stall_pct']:.1f}% of wall time, "
+              f"{summary['starved_batch_pct']:.1f}% of batches starved "
+              f"(max wait {summary['dataloader_stall_max_ms']:.0f} ms)")
+        if summary["peak_memory_mb"] is not None:
+            print(f"   Peak memory: {summary['peak_memory_mb']:,.0f} MB ({summary['peak_memory_kind']})")
+
+
+class PreemptionCallback(TrainerCallback):
+    """
+    Checkpoint and stop cleanly on SIGTERM / SIGINT
+
+    Spot and preemptible machines get a SIGTERM shortly before they are
+    reclaimed. The handler only records the signal. At the end of the
+    current optimizer step, training saves a checkpoint with full state
+    (adapter, optimizer, scheduler, RNG, trainer state and stream
+    position) and stops, so an interruption loses one step, not up to
+    save_steps.
+
+    On resume, the Trainer restores the data position from global_step.
+    The seedable sampler replays the same per-epoch order, and consumed
+    batches are skipped by index without being loaded or tokenized.
+
+    A second Ctrl-C while the checkpoint is pending aborts immediately.
+    """
+
+    def __init__(self, signals: Optional[Tuple[int, ...]] = None):
+        """
+        Args:
+            signals: Signals to handle (default: SIGTERM and SIGINT)
+        """
+        import signal
+
+        self.signals = signals or (signal.SIGTERM, signal.SIGINT)
+        self.signal_received: Optional[int] = None
+        self._previous_handlers: Dict[int, Any] = {}
+
+    def _handle(self, signum, frame):
+        import signal
+
+        if self.signal_received is not None and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        self.signal_received = signum
+        print(f"\n⚠️  Received {signal.Signals(signum).name}: checkpointing after this step...")
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        import signal
+        import threading
+
+        # Signal handlers can only be installed from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in self.signals:
+            self._previous_handlers[signum] = signal.signal(signum, self._handle)
+
+    def _any_rank_signalled(self, args) -> bool:
+        """Agree across ranks, so all of them stop at the same step"""
+        import torch
+        import torch.distributed as dist
+
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return self.signal_received is not None
+
+        flag = torch.tensor([1 if self.signal_received is not None else 0], device=args.device)
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+        return bool(flag.item())
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._any_rank_signalled(args):
+            if self.signal_received is None:
+                import signal
+
+                self.signal_received = signal.SIGTERM
+            control.should_save = True
+            control.should_training_stop = True
+        return control
+
+    def on_train_end(self, args, state, control, **kwargs):
+        import signal
+
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+        if self.signal_received is not None:
+            print(f"💾 Preemption checkpoint saved at step {state.global_step}")
+
+
+def parse_step_range(spec: str) -> Tuple[int, int]:
+    """
+    Parse a "START-END" (or single "STEP") optimizer-step range
+
+    Args:
+        spec: Range text, 1-based and inclusive
+
+    Returns:
+        Tuple of (start, end)
+    """
+    start, _, end = spec.partition("-")
+    start, end = int(start), int(end or start)
+    if start < 1 or end < start:
+        raise ValueError(f"Invalid step range: {spec} (expected START-END with 1 <= START <= END)")
+    return start, end
+
+
+class ProfilerCallback(TrainerCallback):
+    """
+    torch.profiler capture of a window of optimizer steps
+
+    Records CPU and CUDA activity, tensor shapes and memory for steps
+    START..END (1-based, inclusive), including fetching the first batch of
+    the window. Trace regions label the phases of each step:
+
+    - `data_wait` - waiting for the next batch (fetch, collate, copy)
+    - `forward` - model forward (gradient checkpointing recompute shows
+      up as forward ops inside autograd backward)
+    - `optimizer_step` - optimizer.step() (e.g. paged_adamw_8bit)
+    - `eval_and_checkpoint` - evaluation/saving after a step in the window
+
+    Exports a Chrome trace (open in chrome://tracing or Perfetto) and
+    op-summary tables to `<logging_dir>/profile/`. Only add this callback
+    when profiling is requested; it is not installed otherwise.
+    """
+
+    def __init__(self, start_step: int, end_step: int, with_stack: bool = False):
+        """
+        Args:
+            start_step: First optimizer step to profile (1-based)
+            end_step: Last optimizer step to profile (inclusive)
+            with_stack: Record Python stacks (higher overhead)
+        """
+        self.start_step = start_step
+        self.end_step = end_step
+        self.with_stack = with_stack
+        self._profiler = None
+        self._hooks = []
+        self._regions: Dict[str, Any] = {}
+        self._model = None
+        self._optimizer = None
+        self._cuda = False
+        self._pending_save = False
+
+    def _open(self, name: str):
+        from torch.autograd.profiler import record_function
+
+        if name not in self._regions:
+            region = record_function(name)
+            region.__enter__()
+            self._regions[name] = region
+
+    def _close(self, name: str):
+        region = self._regions.pop(name, None)
+        if region is not None:
+            region.__exit__(None, None, None)
+
+    def _start(self, args):
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        self._cuda = torch.cuda.is_available() and not args.use_cpu
+        if self._cuda:
+            activities.append(ProfilerActivity.CUDA)
+
+        print(f"\n🔬 Profiling steps {self.start_step}-{self.end_step}...")
+        self._profiler = profile(
+            activities=activities,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=self.with_stack
+        )
+        self._profiler.__enter__()
+
+        if self._model is not None:
+            self._hooks.append(self._model.register_forward_pre_hook(
+                lambda module, inputs: self._on_forward_begin(module)
+            ))
+            self._hooks.append(self._model.register_forward_hook(
+                lambda module, inputs, output: self._close("forward")
+            ))
+        if self._optimizer is not None and hasattr(self._optimizer, "register_step_pre_hook"):
+            self._hooks.append(self._optimizer.register_step_pre_hook(
+                lambda optimizer, args, kwargs: self._open("optimizer_step")
+            ))
+            self._hooks.append(self._optimizer.register_step_post_hook(
+                lambda optimizer, args, kwargs: self._close("optimizer_step")
+            ))
+
+        self._open("data_wait")
+
+    def _on_forward_begin(self, module):
+        if module.training:
+            self._close("data_wait")
+            self._open("forward")
+
+    def _stop(self, args, state):
+        for name in list(self._regions):
+            self._close(name)
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+        profiler, self._profiler = self._profiler, None
+        profiler.__exit__(None, None, None)
+
+        rank = args.process_index
+        last_step = min(state.global_step, self.end_step)
+        profile_dir = os.path.join(args.logging_dir, "profile")
+        os.makedirs(profile_dir, exist_ok=True)
+        stem = f"steps{self.start_step}-{last_step}_rank{rank}"
+
+        trace_path = os.path.join(profile_dir, f"trace_{stem}.json")
+        profiler.export_chrome_trace(trace_path)
+
+        averages = profiler.key_averages()
+        sort_keys = ["self_cpu_time_total", "cpu_time_total", "self_cpu_memory_usage"]
+        if self._cuda:
+            sort_keys = ["self_cuda_time_total", "self_cuda_memory_usage"] + sort_keys
+
+        table_path = os.path.join(profile_dir, f"ops_{stem}.txt")
+        with open(table_path, "w", encoding="utf-8") as f:
+            for sort_key in sort_keys:
+                f.write(f"=== Top ops by {sort_key} (steps {self.start_step}-{last_step}, rank {rank}) ===\n")
+                f.write(averages.table(sort_by=sort_key, row_limit=30))
+                f.write("\n\n")
+
+        if state.is_world_process_zero:
+            print(f"🔬 Profile written: {trace_path}")
+            print(f"   Op summary: {table_path}")
+            print(averages.table(sort_by=sort_keys[0], row_limit=10))
+
+    def on_train_begin(self, args, state, control, model=None, optimizer=None, **kwargs):
+        self._model = model
+        # accelerate wraps the optimizer; hooks go on the torch optimizer
+        self._optimizer = getattr(optimizer, "optimizer", optimizer)
+        if state.global_step + 1 == self.start_step:
+            self._start(args)
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        if self._profiler is not None:
+            self._open("data_wait")
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._profiler is not None:
+            if state.global_step >= self.end_step:
+                self._stop(args, state)
+            elif control.should_evaluate or control.should_save:
+                # Flags set by the default flow callback, which runs first
+                self._pending_save = control.should_save
+                self._open("eval_and_checkpoint")
+            else:
+                self._open("data_wait")
+        elif state.global_step + 1 == self.start_step:
+            self._start(args)
+
+    def _end_eval_and_checkpoint(self):
+        self._close("eval_and_checkpoint")
+        self._open("data_wait")
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        if self._profiler is not None and not self._pending_save:
+            self._end_eval_and_checkpoint()
+
+    def on_save(self, args, state, control, **kwargs):
+        if self._profiler is not None:
+            self._pending_save = False
+            self._end_eval_and_checkpoint()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        # Training ended inside the window
+        if self._profiler is not None:
+            self._stop(args, state)
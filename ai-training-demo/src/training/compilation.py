@@ -0,0 +1,225 @@
+"""
+torch.compile for the Training Forward
+
+Opt-in via TrainingConfig.torch_compile (--torch-compile). The base
+model's forward, which runs the LoRA layers, is compiled in place: the
+module, its state_dict keys and adapter saving are unchanged.
+
+Before training, a few forward+backward steps on random full-length
+batches run eager and then compiled. The compiled forward is kept only
+if it compiles and is at least MIN_COMPILE_SPEEDUP faster in steady
+state. Otherwise the run trains eager. The report shows compile time,
+eager vs compiled step time, and how many steps it takes to earn the
+compile time back.
+
+Defaults fit this training loop:
+- mode "default": "reduce-overhead" uses CUDA graphs, which need static
+  shapes and extra memory. "max-autotune" compiles for many minutes.
+- dynamic None (automatic): the first graph is static. A new shape (eval
+  batches, the last partial batch) recompiles once with dynamic dims
+  instead of once per shape.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+from config import ModelConfig, TrainingConfig
+
+if TYPE_CHECKING:
+    from distributed import DistributedContext
+
+
+# Timed steps per variant (after one warm-up / compile step)
+COMPILE_BENCH_STEPS = 3
+
+# Smaller gains are within timing noise and don't cover eval recompiles
+MIN_COMPILE_SPEEDUP = 1.05
+
+
+@dataclass
+class CompileReport:
+    """Outcome of compiling the training forward"""
+
+    kept: bool
+    compile_seconds: float = 0.0
+    eager_step_ms: float = 0.0
+    compiled_step_ms: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def speedup(self) -> float:
+        return self.eager_step_ms / self.compiled_step_ms if self.compiled_step_ms else 0.0
+
+    @property
+    def break_even_steps(self) -> Optional[int]:
+        """Steps until the compile time is paid back (None = never)"""
+        saved_ms = self.eager_step_ms - self.compiled_step_ms
+        if saved_ms <= 0:
+            return None
+        return int(self.compile_seconds * 1000 / saved_ms) + 1
+
+
+def _describe(error: BaseException) -> str:
+    """One-line error summary"""
+    message = str(error).splitlines()[0][:200] if str(error) else ""
+    return f"{type(error).__name__}: {message}"
+
+
+class CompiledForward:
+    """
+    Module forward that runs compiled and falls back to eager
+
+    Installed as an instance attribute, so nn.Module.__call__ (hooks,
+    DDP, PEFT) works as before. If compiling or running the compiled
+    graph raises, the error is reported once and the module stays eager.
+    """
+
+    def __init__(self, module, mode: str = "default", dynamic: Optional[bool] = None):
+        import torch
+
+        self.eager = module.forward
+        self.compiled = torch.compile(self.eager, mode=mode, dynamic=dynamic)
+        self.error = None
+
+    def __call__(self, *args, **kwargs):
+        if self.error is None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                self.error = _describe(e)
+                print(f"⚠️  torch.compile failed, continuing eager: {self.error}")
+        return self.eager(*args, **kwargs)
+
+
+def install_compiled_forward(module, mode: str = "default", dynamic: Optional[bool] = None) -> CompiledForward:
+    """Compile a module's forward in place (undo with remove_compiled_forward)"""
+    remove_compiled_forward(module)
+    compiled = CompiledForward(module, mode=mode, dynamic=dynamic)
+    module.forward = compiled
+    return compiled
+
+
+def remove_compiled_forward(module):
+    """Restore the eager forward"""
+    if isinstance(module.__dict__.get("forward"), CompiledForward):
+        del module.forward
+
+
+def _time_steps(step_fn, steps: int, device_type: str) -> float:
+    """Mean seconds per call of step_fn"""
+    import torch
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step_fn()
+    if device_type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def compile_for_training(
+    model,
+    model_config: ModelConfig,
+    training_config: TrainingConfig,
+    dist_ctx: "DistributedContext"
+) -> CompileReport:
+    """
+    Compile the PEFT model's forward if it pays off
+
+    Args:
+        model: PEFT model (adapter attached)
+        model_config: Model configuration (sequence length)
+        training_config: Training configuration (batch size, precision,
+            compile mode)
+        dist_ctx: Distributed context
+
+    Returns:
+        CompileReport (kept=False means training runs eager)
+    """
+    import torch
+
+    base_model = model.get_base_model()
+    device_type = "cuda" if not dist_ctx.use_cpu and torch.cuda.is_available() else "cpu"
+    if device_type == "cuda" and next(model.parameters()).device.type == "cpu" and not model_config.load_in_4bit:
+        model.to(dist_ctx.device)
+    if training_config.gradient_checkpointing:
+        # Same setting the Trainer applies, so its first step reuses this graph
+        model.gradient_checkpointing_enable(
+            gradient_checkpointing_kwargs={"use_reentrant": False} if dist_ctx.is_distributed else None
+        )
+
+    print(f"⚡ torch.compile (mode={training_config.torch_compile_mode}, "
+          f"dynamic={training_config.torch_compile_dynamic})...")
+
+    dtype = torch.float16 if training_config.fp16 else torch.bfloat16 if training_config.bf16 else None
+    vocab_size = model.get_input_embeddings().weight.shape[0]
+    target = next(p for p in model.parameters() if p.requires_grad).device
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(
+        0, vocab_size,
+        (training_config.per_device_train_batch_size, model_config.max_seq_length),
+        generator=generator
+    ).to(target)
+
+    def step():
+        with torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
+            loss = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), labels=input_ids).loss
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    # Benchmark steps must not shift the training RNG streams (dropout)
+    rng_state = torch.random.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    was_training = model.training
+    model.train()
+    try:
+        _time_steps(step, 1, device_type)
+        eager = _time_steps(step, COMPILE_BENCH_STEPS, device_type)
+
+        compiled = install_compiled_forward(
+            base_model, mode=training_config.torch_compile_mode, dynamic=training_config.torch_compile_dynamic
+        )
+        first = _time_steps(step, 1, device_type)
+        steady = _time_steps(step, COMPILE_BENCH_STEPS, device_type) if compiled.error is None else 0.0
+        report = CompileReport(
+            kept=False,
+            compile_seconds=max(first - eager, 0.0),
+            eager_step_ms=eager * 1000,
+            compiled_step_ms=steady * 1000,
+            error=compiled.error
+        )
+        report.kept = compiled.error is None and report.speedup >= MIN_COMPILE_SPEEDUP
+    except Exception as e:
+        # e.g. backward graph failing to compile
+        model.zero_grad(set_to_none=True)
+        report = CompileReport(kept=False, error=_describe(e))
+    finally:
+        torch.random.set_rng_state(rng_state)
+        if cuda_rng_state is not None:
+            torch.cuda.set_rng_state_all(cuda_rng_state)
+        model.train(was_training)
+
+    # Ranks must run the same code path
+    if dist_ctx.is_distributed:
+        import torch.distributed as dist
+
+        keep = torch.tensor([int(report.kept)], device=dist_ctx.device)
+        dist.all_reduce(keep, op=dist.ReduceOp.MIN)
+        report.kept = bool(keep.item())
+
+    if not report.kept:
+        remove_compiled_forward(base_model)
+
+    if report.error:
+        print(f"   ⚠️  Compile unsupported here, training eager: {report.error}")
+    else:
+        print(f"   Compile time: {report.compile_seconds:.1f}s")
+        print(f"   Step time: {report.eager_step_ms:.1f} ms eager -> {report.compiled_step_ms:.1f} ms compiled "
+              f"({report.speedup:.2f}x)")
+        if report.kept:
+            print(f"   ✅ Compiled forward kept (pays back after ~{report.break_even_steps} steps)")
+        else:
+            print(f"   ⚠️  Below {MIN_COMPILE_SPEEDUP:.2f}x, training eager")
+    print()
+    return report
@@ -37,10 +37,17 @@ class ModelConfig:
         "up_proj",
         "down_proj"
     ])
+    lora_modules_to_save: list = field(default_factory=list)  # Fully trained modules, e.g. ["embed_tokens", "lm_head"]
 
     # Context window
     max_seq_length: int = 2048  # Max tokens per sample
 
+    # Smoke test: tiny random-init Llama + local tokenizer (no download, CPU)
+    smoke_test: bool = False
+
+    # Prepared base-model snapshots (None = load and prepare every run)
+    prepared_cache_dir: Optional[str] = None
+
 
 @dataclass
 class TrainingConfig:
@@ -48,9 +55,11 @@ class TrainingConfig:
 
     # Training regime
     num_epochs: int = 3
+    max_steps: int = -1  # Overrides num_epochs when > 0 (required for streaming)
     per_device_train_batch_size: int = 1  # Small for 12GB VRAM
     per_device_eval_batch_size: int = 1
     gradient_accumulation_steps: int = 4  # Effective batch size = 4
+    auto_tune: bool = False  # Probe the device for micro-batch, accumulation and precision
 
     # Optimizer
     learning_rate: float = 2e-4
@@ -65,20 +74,54 @@ class TrainingConfig:
     fp16: bool = True  # Use FP16 for RTX 4070Ti
     bf16: bool = False  # BF16 only on Ampere+ (RTX 30xx+)
 
+    # torch.compile (kept only if it compiles and speeds up steps)
+    torch_compile: bool = False
+    torch_compile_mode: str = "default"  # "reduce-overhead" needs static shapes (CUDA graphs)
+    torch_compile_dynamic: Optional[bool] = None  # None = recompile dynamic on first shape change
+
     # Logging
     logging_steps: int = 10
     eval_steps: int = 50
     save_steps: int = 100
+    throughput_metrics: bool = True  # tokens/s, step latency, padding, stalls, memory
+    profile_steps: Optional[str] = None  # "START-END" optimizer steps to torch.profiler
+    metrics_stream_port: Optional[int] = None  # Live SSE metrics endpoint (see metrics_stream.py)
+    metrics_stream_host: str = "127.0.0.1"  # "0.0.0.0" to reach it from other machines
+    metrics_stream_queue: int = 256  # Events buffered per client before the oldest are dropped
 
     # Evaluation
     evaluation_strategy: str = "steps"
     save_strategy: str = "steps"
     save_total_limit: int = 3  # Keep only 3 checkpoints
+    checkpoint_mode: str = "full"  # "full" (synchronous) or "async_adapter"
+    optimizer_save_interval: int = 5  # async_adapter: optimizer/RNG state every N checkpoints
+    preemption_checkpoint: bool = True  # Checkpoint and stop on SIGTERM/SIGINT
 
     # Early stopping
     load_best_model_at_end: bool = True
     metric_for_best_model: str = "eval_loss"
     greater_is_better: bool = False
+    early_stopping: bool = False  # Stop when the metric plateaus
+    early_stopping_patience: int = 2  # Evals without improvement before stopping
+    early_stopping_min_delta: float = 0.0  # Smaller improvements count as a plateau
+    max_train_minutes: Optional[float] = None  # Wall-clock budget per run
+    max_train_tokens: Optional[int] = None  # Input-token budget (incl. padding)
+    target_eval_loss: Optional[float] = None  # Report steps/time to reach it (time_to_target.json)
+
+    # Greedy pass@1 probe on a fixed val subset (see probe.py)
+    probe_steps: int = 0  # Probe every N optimizer steps (0 = off)
+    probe_samples: int = 16  # Size of the fixed val subset
+    probe_batch_size: int = 8  # Prompts per generate() call
+    probe_max_new_tokens: int = 256
+    probe_timeout: float = 5.0  # Seconds per test
+    probe_workers: Optional[int] = None  # Test processes (None = all cores but one)
+    probe_patience: Optional[int] = None  # Stop after N probes without a better pass@1 (None = log only)
+
+    # Loss-aware sampling (see sampling.py; map-style datasets only)
+    loss_aware_sampling: bool = False  # Draw high-loss samples more often
+    loss_sampling_floor: float = 0.2  # Share of draws spread uniformly over all samples
+    loss_sampling_temperature: float = 1.0  # Lower = stronger skew toward high-loss samples
+    loss_sampling_ema: float = 0.5  # Weight of a sample's previous loss
 
     # Memory optimization
     gradient_checkpointing: bool = True
@@ -99,8 +142,25 @@ class DataConfig:
     max_completion_length: int = 512
 
     # Data loading
-    num_workers: int = 4
-    preprocessing_num_workers: int = 4
+    num_workers: int = 4  # DataLoader worker processes (0 = main process)
+    pin_memory: bool = True  # Page-locked batches for async host-to-GPU copies
+    prefetch_factor: int = 2  # Batches prefetched per worker
+    persistent_workers: bool = True  # Keep workers alive between epochs/evals
+    preprocessing_num_workers: int = 4  # Processes for pre-tokenization
+    pretokenize: bool = True  # Tokenize once into a memory-mapped cache
+    tokenized_cache_dir: Optional[str] = None  # None = .tokenized/ next to each data file
+    lazy_loading: bool = False  # Offset-indexed dataset for large corpora
+
+    # Experiment metadata header (see dataset.MetadataHeaderFormatter)
+    metadata_encoding: str = "kv"  # "verbose" (original), "abbrev" or "kv"
+    metadata_drop_evident: bool = True  # Omit fields the prompt shows (function name, params)
+    metadata_token_budget: Optional[int] = 48  # Max header tokens per sample (None = unlimited)
+    metadata_special_tokens: bool = False  # Add header tags to the vocabulary (trains embed_tokens + lm_head)
+
+    # Streaming (multi-source mixing, train split only)
+    streaming: bool = False
+    train_sources: list = field(default_factory=list)  # [{"path", "weight", "include_metadata"}]
+    shuffle_buffer_size: int = 1000
 
 
 @dataclass
@@ -122,16 +182,34 @@ class ExperimentConfig:
     # Checkpointing
     resume_from_checkpoint: Optional[str] = None
 
+    # Merged export after training (see export.py)
+    export_merged: bool = False
+    export_dtype: str = "float16"  # "float16", "bfloat16" or "float32"
+    export_dequantize: Optional[bool] = None  # None = when the base trained 4-bit
+    export_quantize: Optional[str] = None  # Also save an "int8" or "nf4" copy
+
     # Seed for reproducibility
     seed: int = 42
 
 
+@dataclass
+class DistributedConfig:
+    """Multi-process data-parallel configuration (launch with torchrun)"""
+
+    backend: Optional[str] = None  # None = "nccl" on GPU, "gloo" on CPU
+    use_cpu: bool = False  # Train on CPU even if CUDA is available
+    timeout_minutes: int = 30
+
+
 # Preset configurations for different stages
 
-def get_stage1_config() -> tuple[ModelConfig, TrainingConfig, DataConfig, ExperimentConfig]:
+def get_stage1_config(experiment_type: str = "control") -> tuple[ModelConfig, TrainingConfig, DataConfig, ExperimentConfig]:
     """
     Stage 1: Tiny test (5 samples, 30 min)
     Purpose: Verify code runs without errors
+
+    Args:
+        experiment_type: "control" or "experiment" (selects the output dir)
     """
     model_config = ModelConfig()
 
@@ -152,8 +230,60 @@ def get_stage1_config() -> tuple[ModelConfig, TrainingConfig, DataConfig, Experi
 
     experiment_config = ExperimentConfig(
         experiment_name="stage1-validation",
-        output_dir="outputs/stage1/control",
-        logging_dir="outputs/stage1/control/logs"
+        output_dir=f"outputs/stage1/{experiment_type}",
+        logging_dir=f"outputs/stage1/{experiment_type}/logs"
+    )
+
+    return model_config, training_config, data_config, experiment_config
+
+
+def get_smoke_config(experiment_type: str = "control") -> tuple[ModelConfig, TrainingConfig, DataConfig, ExperimentConfig]:
+    """
+    Smoke test: tiny random model on CPU (< 1 min)
+    Purpose: Fast regression gate for pipeline and performance changes
+
+    Data files are generated by train.py (see smoke.py).
+
+    Args:
+        experiment_type: "control" or "experiment"
+    """
+    model_config = ModelConfig(
+        model_name="smoke-tiny-llama",
+        tokenizer_name="smoke-tiny-llama",
+        load_in_4bit=False,
+        lora_r=8,
+        lora_alpha=16,
+        max_seq_length=128,
+        smoke_test=True
+    )
+
+    training_config = TrainingConfig(
+        num_epochs=2,
+        per_device_train_batch_size=4,
+        per_device_eval_batch_size=4,
+        gradient_accumulation_steps=1,
+        learning_rate=1e-3,
+        warmup_ratio=0.0,
+        fp16=False,
+        logging_steps=1,
+        eval_steps=3,
+        save_steps=3,
+        save_total_limit=1,
+        gradient_checkpointing=False,  # Tiny model: recompute costs more than it saves
+        optim="adamw_torch"
+    )
+
+    data_config = DataConfig(
+        train_file="outputs/smoke/data/train.jsonl",
+        val_file="outputs/smoke/data/val.jsonl",
+        test_file="outputs/smoke/data/test.jsonl",
+        num_workers=0
+    )
+
+    experiment_config = ExperimentConfig(
+        experiment_name=f"smoke-{experiment_type}",
+        output_dir=f"outputs/smoke/{experiment_type}",
+        logging_dir=f"outputs/smoke/{experiment_type}/logs"
     )
 
     return model_config, training_config, data_config, experiment_config
@@ -174,7 +304,11 @@ def get_stage4_config(experiment_type: str = "control") -> tuple[ModelConfig, Tr
         gradient_accumulation_steps=4,
         logging_steps=10,
         eval_steps=50,
-        save_steps=100
+        save_steps=100,
+        checkpoint_mode="async_adapter",  # Don't stall 21 hrs of training on saves
+        early_stopping=True,
+        early_stopping_patience=2,
+        early_stopping_min_delta=0.005
     )
 
     if experiment_type == "control":
@@ -203,6 +337,23 @@ def get_stage4_config(experiment_type: str = "control") -> tuple[ModelConfig, Tr
     return model_config, training_config, data_config, experiment_config
 
 
+def get_stage_config(stage: str, experiment_type: str = "control") -> tuple[ModelConfig, TrainingConfig, DataConfig, ExperimentConfig]:
+    """
+    Preset config for a training stage
+
+    Args:
+        stage: "smoke", "stage1" or "stage4"
+        experiment_type: "control" or "experiment"
+    """
+    if stage == "smoke":
+        return get_smoke_config(experiment_type)
+    if stage == "stage1":
+        return get_stage1_config(experiment_type)
+    if stage == "stage4":
+        return get_stage4_config(experiment_type)
+    raise ValueError(f"Unknown stage: {stage}")
+
+
 # Hardware validation
 def validate_gpu():
     """
@@ -2,13 +2,26 @@
 Dataset loader for HumanEval training data
 
 Handles both control (no metadata) and experiment (with metadata) datasets.
+Experiment metadata headers can use a compact encoding and a per-sample
+token budget (see MetadataHeaderFormatter).
+Map-style datasets can be pre-tokenized once, in parallel, into a
+memory-mapped cache (see pretokenize_dataset), so dataloader workers only
+slice arrays instead of tokenizing in __getitem__.
 """
 
+import hashlib
 import json
+import os
+import re
+import shutil
+import time
+from array import array
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator, Set, Tuple, Union
 from dataclasses import dataclass
 
+import torch
 from torch.utils.data import Dataset
 
 
@@ -23,12 +36,17 @@ class HumanEvalSample:
     test: str
     entry_point: str
 
-    def to_training_text(self, include_metadata: bool = False) -> str:
+    def to_training_text(
+        self,
+        include_metadata: bool = False,
+        formatter: Optional["MetadataHeaderFormatter"] = None
+    ) -> str:
         """
         Convert sample to training text format
 
         Args:
             include_metadata: If True, prepend metadata as comments
+            formatter: Header encoding and budget (None = verbose header)
 
         Returns:
             Formatted training text
@@ -38,47 +56,336 @@ class HumanEvalSample:
             return self.prompt + self.completion
 
         # Experiment dataset: Add metadata as .comments-style annotations
-        metadata_text = self._format_metadata()
+        metadata_text = self._format_metadata(formatter)
+        if not metadata_text:
+            return self.prompt + self.completion
         return metadata_text + "\n" + self.prompt + self.completion
 
-    def _format_metadata(self) -> str:
+    def _format_metadata(self, formatter: Optional["MetadataHeaderFormatter"] = None) -> str:
         """Format metadata as comment-style annotations"""
-        if not self.metadata:
-            return ""
+        if formatter is None:
+            return format_metadata(self.metadata)
+        return formatter(self.metadata, self.prompt)
+
+
+class HumanEvalRecord:
+    """
+    Compact training record used by LazyHumanEvalDataset
+
+    Holds only the columns training reads (no test code or entry point)
+    and uses __slots__ so each record carries no per-instance dict.
+    """
+
+    __slots__ = ("task_id", "prompt", "completion", "metadata")
+
+    def __init__(
+        self,
+        task_id: str,
+        prompt: str,
+        completion: str,
+        metadata: Optional[Dict[str, Any]] = None
+    ):
+        self.task_id = task_id
+        self.prompt = prompt
+        self.completion = completion
+        self.metadata = metadata or {}
+
+    def to_training_text(
+        self,
+        include_metadata: bool = False,
+        formatter: Optional["MetadataHeaderFormatter"] = None
+    ) -> str:
+        """Convert record to training text (same format as HumanEvalSample)"""
+        if not include_metadata or not self.metadata:
+            return self.prompt + self.completion
+
+        header = format_metadata(self.metadata) if formatter is None else formatter(self.metadata, self.prompt)
+        if not header:
+            return self.prompt + self.completion
+        return header + "\n" + self.prompt + self.completion
+
+
+# Header encodings: "verbose" is the original multi-line .comments block,
+# "abbrev" uses short tags, "kv" packs all fields into one comment line
+METADATA_ENCODINGS = ("verbose", "abbrev", "kv")
+
+# (metadata key, verbose tag, abbreviated tag) in header order
+METADATA_FIELDS = (
+    ("functionName", "function", "fn"),
+    ("paramCount", "params", "p"),
+    ("algorithmType", "algorithm", "algo"),
+    ("complexity", "complexity", "cx"),
+    ("timeComplexity", "time", "t"),
+    ("spaceComplexity", "space", "s"),
+    ("edgeCases", "edgeCases", "edge"),
+    ("validates", "validates", "val"),
+)
+
+# Most useful first; an over-budget header loses fields from the end
+METADATA_FIELD_PRIORITY = (
+    "algorithmType",
+    "timeComplexity",
+    "spaceComplexity",
+    "edgeCases",
+    "complexity",
+    "validates",
+    "paramCount",
+    "functionName",
+)
+
+
+# Big-O classes written by data/add_comments_metadata.py
+METADATA_COMPLEXITY_CLASSES = ("O(1)", "O(n)", "O(n^2)", "O(n^3)", "O(2^n)")
+
+# Fields whose values are METADATA_COMPLEXITY_CLASSES
+METADATA_COMPLEXITY_KEYS = ("timeComplexity", "spaceComplexity")
+
+
+def metadata_special_tokens(encoding: str = "verbose") -> List[str]:
+    """
+    Metadata vocabulary to register as added tokens
+
+    Tags are taken exactly as format_metadata renders them, including the
+    "# " comment prefix and the space or "=" after the tag (and the "; "
+    separator for kv). That way they only match inside headers, not in
+    ordinary code: "# @t " does not match "# @todo". Big-O classes are
+    only registered with their tag ("# @t O(n)"), since a bare "O(n)"
+    also appears in docstrings. Word-like values such as "loop" are left
+    out.
+
+    Args:
+        encoding: Header encoding the tokens are for
+
+    Returns:
+        Token strings
+    """
+    if encoding not in METADATA_ENCODINGS:
+        raise ValueError(f"Unknown metadata encoding: {encoding!r} (expected one of {METADATA_ENCODINGS})")
+
+    if encoding == "verbose":
+        tags = [(key, f"# @{tag} ") for key, tag, _ in METADATA_FIELDS]
+    elif encoding == "abbrev":
+        tags = [(key, f"# @{tag} ") for key, _, tag in METADATA_FIELDS]
+    else:
+        # Any field can come first once others are dropped
+        tags = [(key, f"# @meta {tag}=") for key, _, tag in METADATA_FIELDS]
+        tags += [(key, f"; {tag}=") for key, _, tag in METADATA_FIELDS]
+
+    tokens = ["# .comments metadata"] if encoding == "verbose" else []
+    for key, tag in tags:
+        tokens.append(tag)
+        if key in METADATA_COMPLEXITY_KEYS:
+            # The longest added token wins, so "# @t O(n)" beats "# @t "
+            tokens += [tag + value for value in METADATA_COMPLEXITY_CLASSES]
+    return tokens
+
+
+def _metadata_value(key: str, value: Any) -> str:
+    if key == "complexity":
+        return f"{value}/5"
+    if key == "edgeCases":
+        return ", ".join(value)
+    return str(value)
+
+
+def format_metadata(
+    metadata: Dict[str, Any],
+    encoding: str = "verbose",
+    exclude: Optional[Set[str]] = None
+) -> str:
+    """
+    Format metadata as comment-style annotations
+
+    Args:
+        metadata: Metadata dict from the experiment dataset
+        encoding: "verbose", "abbrev" or "kv" (see METADATA_ENCODINGS)
+        exclude: Metadata keys to leave out
+
+    Returns:
+        Comment header (empty string if no metadata or every field is excluded)
+    """
+    if encoding not in METADATA_ENCODINGS:
+        raise ValueError(f"Unknown metadata encoding: {encoding!r} (expected one of {METADATA_ENCODINGS})")
+    if not metadata:
+        return ""
+
+    exclude = exclude or set()
+    fields = [
+        (verbose_tag, short_tag, _metadata_value(key, metadata[key]))
+        for key, verbose_tag, short_tag in METADATA_FIELDS
+        if key in metadata and key not in exclude and (key != "edgeCases" or metadata[key])
+    ]
+
+    if encoding == "verbose":
+        return "\n".join(["# .comments metadata"] + [f"# @{tag} {value}" for tag, _, value in fields])
+    if not fields:
+        return ""
+    if encoding == "abbrev":
+        return "\n".join(f"# @{tag} {value}" for _, tag, value in fields)
+    return "# @meta " + "; ".join(f"{tag}={value}" for _, tag, value in fields)
+
+
+def evident_metadata_fields(metadata: Dict[str, Any], prompt: str) -> Set[str]:
+    """
+    Metadata keys the prompt already shows
+
+    The function name and parameter count are visible in the prompt's
+    `def name(...)` signature.
+
+    Args:
+        metadata: Metadata dict
+        prompt: Sample prompt
+
+    Returns:
+        Set of metadata keys
+    """
+    name = metadata.get("functionName")
+    if name and re.search(rf"\bdef\s+{re.escape(str(name))}\s*\(", prompt):
+        return {"functionName", "paramCount"}
+    return set()
+
+
+class MetadataHeaderFormatter:
+    """
+    Render experiment metadata headers with an encoding and token budget
+
+    Headers over `token_budget` tokens lose whole fields in reverse
+    METADATA_FIELD_PRIORITY order. Edge cases are trimmed item by item
+    before that field is dropped. If nothing fits, the header is omitted.
+    """
+
+    def __init__(
+        self,
+        encoding: str = "verbose",
+        drop_evident: bool = False,
+        token_budget: Optional[int] = None,
+        tokenizer=None
+    ):
+        """
+        Initialize formatter
 
-        lines = ["# .comments metadata"]
+        Args:
+            encoding: "verbose", "abbrev" or "kv" (see METADATA_ENCODINGS)
+            drop_evident: Leave out fields the prompt already shows
+            token_budget: Max header tokens per sample (None = unlimited)
+            tokenizer: HuggingFace tokenizer (required with token_budget)
+        """
+        if encoding not in METADATA_ENCODINGS:
+            raise ValueError(f"Unknown metadata encoding: {encoding!r} (expected one of {METADATA_ENCODINGS})")
+        if token_budget is not None and tokenizer is None:
+            raise ValueError("token_budget needs a tokenizer")
+
+        self.encoding = encoding
+        self.drop_evident = drop_evident
+        self.token_budget = token_budget
+        self.tokenizer = tokenizer
+
+    def key(self) -> Dict[str, Any]:
+        """Settings that change the rendered text (for cache keys)"""
+        return {
+            "encoding": self.encoding,
+            "drop_evident": self.drop_evident,
+            "token_budget": self.token_budget,
+        }
+
+    def describe(self) -> str:
+        """Short human-readable summary"""
+        parts = [self.encoding]
+        if self.drop_evident:
+            parts.append("no evident fields")
+        if self.token_budget is not None:
+            parts.append(f"<= {self.token_budget} tokens")
+        return ", ".join(parts)
+
+    def count_tokens(self, header: str) -> int:
+        """Tokens a header adds (including its trailing newline)"""
+        if not header:
+            return 0
+        return len(self.tokenizer(header + "\n", add_special_tokens=False)["input_ids"])
+
+    def render(self, metadata: Dict[str, Any], prompt: str = "") -> Tuple[str, List[str]]:
+        """
+        Render a header and report what the budget removed
+
+        Args:
+            metadata: Metadata dict
+            prompt: Sample prompt (for drop_evident)
+
+        Returns:
+            Tuple of (header, names of fields dropped or trimmed by the budget)
+        """
+        exclude = evident_metadata_fields(metadata, prompt) if self.drop_evident else set()
+        header = format_metadata(metadata, self.encoding, exclude)
+        if self.token_budget is None or self.count_tokens(header) <= self.token_budget:
+            return header, []
+
+        metadata = dict(metadata)
+        truncated = []
+        for key in reversed(METADATA_FIELD_PRIORITY):
+            if key not in metadata or key in exclude:
+                continue
+            if key == "edgeCases" and isinstance(metadata[key], list):
+                # Keep the leading edge cases if that is enough
+                while len(metadata[key]) > 1:
+                    metadata[key] = metadata[key][:-1]
+                    header = format_metadata(metadata, self.encoding, exclude)
+                    if self.count_tokens(header) <= self.token_budget:
+                        return header, truncated + [key]
+            exclude.add(key)
+            truncated.append(key)
+            header = format_metadata(metadata, self.encoding, exclude)
+            if self.count_tokens(header) <= self.token_budget:
+                return header, truncated
 
-        # Function info
-        if "functionName" in self.metadata:
-            lines.append(f"# @function {self.metadata['functionName']}")
+        # Not even the banner fits
+        return "", truncated
 
-        if "paramCount" in self.metadata:
-            lines.append(f"# @params {self.metadata['paramCount']}")
+    def __call__(self, metadata: Dict[str, Any], prompt: str = "") -> str:
+        return self.render(metadata, prompt)[0]
 
-        # Algorithm info
-        if "algorithmType" in self.metadata:
-            lines.append(f"# @algorithm {self.metadata['algorithmType']}")
 
-        if "complexity" in self.metadata:
-            lines.append(f"# @complexity {self.metadata['complexity']}/5")
+def _formatter_label(formatter: Optional[MetadataHeaderFormatter]) -> str:
+    return formatter.describe() if formatter is not None else "verbose"
 
-        # Performance
-        if "timeComplexity" in self.metadata:
-            lines.append(f"# @time {self.metadata['timeComplexity']}")
 
-        if "spaceComplexity" in self.metadata:
-            lines.append(f"# @space {self.metadata['spaceComplexity']}")
+def encode_training_text(
+    tokenizer,
+    text: str,
+    max_length: int,
+    task_id: str
+) -> Dict[str, Any]:
+    """
+    Tokenize training text for causal LM training
 
-        # Edge cases
-        if "edgeCases" in self.metadata and self.metadata["edgeCases"]:
-            edge_cases = ", ".join(self.metadata["edgeCases"])
-            lines.append(f"# @edgeCases {edge_cases}")
+    Args:
+        tokenizer: HuggingFace tokenizer
+        text: Training text (prompt + completion, optionally with metadata)
+        max_length: Maximum sequence length
+        task_id: Task ID passed through with the sample
 
-        # Validation
-        if "validates" in self.metadata:
-            lines.append(f"# @validates {self.metadata['validates']}")
+    Returns:
+        Dict with input_ids, attention_mask, labels, task_id
+    """
+    encoding = tokenizer(
+        text,
+        max_length=max_length,
+        padding="max_length",
+        truncation=True,
+        return_tensors="pt"
+    )
+
+    # Labels = input_ids (causal LM training)
+    labels = encoding["input_ids"].clone()
 
-        return "\n".join(lines)
+    # Mask padding tokens in labels (-100 = ignore in loss)
+    labels[labels == tokenizer.pad_token_id] = -100
+
+    return {
+        "input_ids": encoding["input_ids"].squeeze(0),
+        "attention_mask": encoding["attention_mask"].squeeze(0),
+        "labels": labels.squeeze(0),
+        "task_id": task_id
+    }
 
 
 class HumanEvalDataset(Dataset):
@@ -89,7 +396,8 @@ class HumanEvalDataset(Dataset):
         data_file: str,
         tokenizer,
         max_length: int = 2048,
-        include_metadata: bool = False
+        include_metadata: bool = False,
+        metadata_formatter: Optional[MetadataHeaderFormatter] = None
     ):
         """
         Initialize dataset
@@ -99,18 +407,20 @@ class HumanEvalDataset(Dataset):
             tokenizer: HuggingFace tokenizer
             max_length: Maximum sequence length
             include_metadata: Include metadata in training text
+            metadata_formatter: Header encoding and budget (None = verbose header)
         """
         self.data_file = data_file
         self.tokenizer = tokenizer
         self.max_length = max_length
         self.include_metadata = include_metadata
+        self.metadata_formatter = metadata_formatter
 
         # Load samples
         self.samples = self._load_samples()
 
         print(f"📊 Loaded {len(self.samples)} samples from {data_file}")
         if include_metadata:
-            print(f"   Including .comments metadata in training")
+            print(f"   Including .comments metadata in training ({_formatter_label(metadata_formatter)})")
 
     def _load_samples(self) -> List[HumanEvalSample]:
         """Load samples from JSONL file"""
@@ -142,37 +452,130 @@ class HumanEvalDataset(Dataset):
         sample = self.samples[idx]
 
         # Convert to text
-        text = sample.to_training_text(include_metadata=self.include_metadata)
-
-        # Tokenize
-        encoding = self.tokenizer(
-            text,
-            max_length=self.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt"
+        text = sample.to_training_text(self.include_metadata, self.metadata_formatter)
+
+        return encode_training_text(
+            self.tokenizer, text, self.max_length, sample.task_id
         )
 
-        # Labels = input_ids (causal LM training)
-        labels = encoding["input_ids"].clone()
+    def iter_samples(self) -> Iterator[HumanEvalSample]:
+        """Iterate over loaded samples"""
+        return iter(self.samples)
 
-        # Mask padding tokens in labels (-100 = ignore in loss)
-        labels[labels == self.tokenizer.pad_token_id] = -100
 
-        return {
-            "input_ids": encoding["input_ids"].squeeze(0),
-            "attention_mask": encoding["attention_mask"].squeeze(0),
-            "labels": labels.squeeze(0),
-            "task_id": sample.task_id
-        }
+class LazyHumanEvalDataset(Dataset):
+    """
+    Memory-compact map-style Dataset for large JSONL corpora
+
+    Only a byte-offset index (8 bytes per sample) is kept in memory.
+    Each __getitem__ seeks to the sample's line and decodes just the
+    columns training needs into a slotted HumanEvalRecord, so memory per
+    dataloader worker stays roughly constant as the corpus grows.
+    """
+
+    def __init__(
+        self,
+        data_file: str,
+        tokenizer,
+        max_length: int = 2048,
+        include_metadata: bool = False,
+        metadata_formatter: Optional[MetadataHeaderFormatter] = None
+    ):
+        """
+        Initialize dataset
+
+        Args:
+            data_file: Path to JSONL file
+            tokenizer: HuggingFace tokenizer
+            max_length: Maximum sequence length
+            include_metadata: Include metadata in training text
+            metadata_formatter: Header encoding and budget (None = verbose header)
+        """
+        self.data_file = data_file
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.include_metadata = include_metadata
+        self.metadata_formatter = metadata_formatter
+
+        # Build offset index (file handle is opened lazily per process)
+        self.offsets = self._build_offset_index()
+        self._handle = None
+        self._handle_pid = None
+
+        print(f"📊 Indexed {len(self.offsets)} samples from {data_file} (lazy)")
+        if include_metadata:
+            print(f"   Including .comments metadata in training ({_formatter_label(metadata_formatter)})")
+
+    def _build_offset_index(self) -> array:
+        """Record the byte offset of every non-empty line"""
+        offsets = array("q")
+        with open(self.data_file, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+        return offsets
+
+    def _file(self):
+        """Return a file handle owned by the current process"""
+        # Dataloader workers are forked/spawned: never share a handle
+        if self._handle is None or self._handle_pid != os.getpid():
+            self._handle = open(self.data_file, "rb")
+            self._handle_pid = os.getpid()
+        return self._handle
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_handle"] = None
+        state["_handle_pid"] = None
+        return state
+
+    def _read_record(self, idx: int) -> HumanEvalRecord:
+        """Read a single record from disk"""
+        f = self._file()
+        f.seek(self.offsets[idx])
+        data = json.loads(f.readline())
+
+        return HumanEvalRecord(
+            task_id=data["task_id"],
+            prompt=data["prompt"],
+            completion=data["completion"],
+            # Control runs never format metadata, so don't keep it
+            metadata=data.get("metadata") if self.include_metadata else None
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        """
+        Get training sample
+
+        Returns:
+            Dict with input_ids, attention_mask, labels
+        """
+        record = self._read_record(idx)
+        text = record.to_training_text(self.include_metadata, self.metadata_formatter)
+
+        return encode_training_text(
+            self.tokenizer, text, self.max_length, record.task_id
+        )
+
+    def iter_samples(self) -> Iterator[HumanEvalRecord]:
+        """Stream records in file order"""
+        for idx in range(len(self.offsets)):
+            yield self._read_record(idx)
 
 
 def load_humaneval_dataset(
     data_file: str,
     tokenizer,
     max_length: int = 2048,
-    include_metadata: bool = False
-) -> HumanEvalDataset:
+    include_metadata: bool = False,
+    lazy: bool = False,
+    metadata_formatter: Optional[MetadataHeaderFormatter] = None
+) -> Union[HumanEvalDataset, LazyHumanEvalDataset]:
     """
     Load HumanEval dataset
 
@@ -181,52 +584,487 @@ def load_humaneval_dataset(
         tokenizer: HuggingFace tokenizer
         max_length: Maximum sequence length
         include_metadata: Include metadata (True for experiment, False for control)
+        lazy: Use the offset-indexed LazyHumanEvalDataset (for large corpora)
+        metadata_formatter: Header encoding and budget (None = verbose header)
 
     Returns:
-        HumanEvalDataset instance
+        HumanEvalDataset or LazyHumanEvalDataset instance
     """
-    return HumanEvalDataset(
+    dataset_cls = LazyHumanEvalDataset if lazy else HumanEvalDataset
+
+    return dataset_cls(
         data_file=data_file,
         tokenizer=tokenizer,
         max_length=max_length,
-        include_metadata=include_metadata
+        include_metadata=include_metadata,
+        metadata_formatter=metadata_formatter
+    )
+
+
+# Bump when the cache layout or the encoding changes
+PRETOKENIZED_FORMAT_VERSION = 1
+
+# Samples per tokenization task (one pickle round trip per chunk)
+PRETOKENIZE_CHUNK_SIZE = 512
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of everything in a tokenizer that changes token ids
+
+    Covers the vocabulary, merges, added/special tokens and normalization
+    (the serialized fast tokenizer), plus padding and truncation settings.
+    Any change (e.g. new added tokens) gives a new fingerprint.
+
+    Args:
+        tokenizer: HuggingFace tokenizer
+
+    Returns:
+        16-character hex fingerprint
+    """
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode("utf-8"))
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    settings = [
+        type(tokenizer).__name__,
+        tokenizer.pad_token_id,
+        tokenizer.padding_side,
+        tokenizer.truncation_side,
+        len(tokenizer),
+    ]
+    digest.update(json.dumps(settings).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+# Tokenizer of a pretokenize worker process (set by _init_pretokenize_worker)
+_worker_tokenizer = None
+
+
+def _init_pretokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode_chunk(texts: List[str], max_length: int, tokenizer=None):
+    """
+    Encode texts exactly like encode_training_text, plus untruncated lengths
+
+    Args:
+        texts: Training texts
+        max_length: Maximum sequence length
+        tokenizer: Tokenizer (None = the worker process tokenizer)
+
+    Returns:
+        Tuple of (input_ids int32 [n, max_length], attention_mask uint8
+        [n, max_length], untruncated token lengths)
+    """
+    import numpy as np
+
+    tokenizer = tokenizer or _worker_tokenizer
+    full = tokenizer(texts)["input_ids"]
+
+    input_ids = np.full((len(texts), max_length), tokenizer.pad_token_id, dtype=np.int32)
+    attention_mask = np.zeros((len(texts), max_length), dtype=np.uint8)
+    lengths = []
+    for i, ids in enumerate(full):
+        lengths.append(len(ids))
+        if len(ids) > max_length:
+            # Let the tokenizer truncate (it keeps room for special tokens)
+            ids = tokenizer(texts[i], max_length=max_length, truncation=True)["input_ids"]
+        if tokenizer.padding_side == "left":
+            input_ids[i, max_length - len(ids):] = ids
+            attention_mask[i, max_length - len(ids):] = 1
+        else:
+            input_ids[i, :len(ids)] = ids
+            attention_mask[i, :len(ids)] = 1
+    return input_ids, attention_mask, lengths
+
+
+def _chunked(iterable: Iterator[Any], size: int) -> Iterator[List[Any]]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class PretokenizedDataset(Dataset):
+    """
+    Map-style Dataset over a pre-tokenized cache
+
+    input_ids and attention_mask are memory-mapped .npy arrays, opened
+    lazily per process, so dataloader workers share the page cache instead
+    of holding (or re-tokenizing) their own copy. Samples are identical to
+    the source dataset's __getitem__.
+    """
+
+    def __init__(self, cache_path: Path, source: Optional[Dataset] = None):
+        """
+        Args:
+            cache_path: Cache directory written by pretokenize_dataset
+            source: Dataset the cache was built from (for iter_samples)
+        """
+        self.cache_path = Path(cache_path)
+        with open(self.cache_path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        self.task_ids: List[str] = meta["task_ids"]
+        self.token_lengths: List[int] = meta["token_lengths"]
+        self.samples_with_metadata: int = meta["samples_with_metadata"]
+        self.pad_token_id: int = meta["pad_token_id"]
+        self.max_length: int = meta["max_length"]
+        self.include_metadata: bool = meta["include_metadata"]
+        self.metadata_formatter = source.metadata_formatter if source is not None else None
+        self.data_file: str = meta["data_file"]
+        self.source = source
+        self._arrays = None
+        self._arrays_pid = None
+
+    def _open(self):
+        """Memory-map the arrays in the current process"""
+        if self._arrays is None or self._arrays_pid != os.getpid():
+            import numpy as np
+
+            self._arrays = (
+                np.load(self.cache_path / "input_ids.npy", mmap_mode="r"),
+                np.load(self.cache_path / "attention_mask.npy", mmap_mode="r"),
+            )
+            self._arrays_pid = os.getpid()
+        return self._arrays
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        state["_arrays_pid"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.task_ids)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        input_ids, attention_mask = self._open()
+        ids = torch.from_numpy(input_ids[idx].astype("int64"))
+        labels = ids.clone()
+        labels[labels == self.pad_token_id] = -100
+
+        return {
+            "input_ids": ids,
+            "attention_mask": torch.from_numpy(attention_mask[idx].astype("int64")),
+            "labels": labels,
+            "task_id": self.task_ids[idx]
+        }
+
+    def iter_samples(self) -> Iterator[Any]:
+        """Iterate over the source samples"""
+        if self.source is None:
+            raise ValueError("iter_samples needs the source dataset")
+        return self.source.iter_samples()
+
+
+def _metadata_format_key(dataset: Dataset) -> Optional[Dict[str, Any]]:
+    """Header settings that affect the training text (None for control)"""
+    if not dataset.include_metadata:
+        return None
+    formatter = dataset.metadata_formatter
+    return formatter.key() if formatter is not None else {"encoding": "verbose"}
+
+
+def pretokenized_cache_path(dataset: Dataset, cache_dir: Optional[str] = None) -> Path:
+    """
+    Cache directory for a dataset and tokenizer
+
+    The key covers the data file (path, size, mtime), the tokenizer
+    fingerprint, max_length, include_metadata, the metadata header format
+    and the format version.
+
+    Args:
+        dataset: HumanEvalDataset or LazyHumanEvalDataset
+        cache_dir: Root cache directory (None = `.tokenized/` next to the data file)
+
+    Returns:
+        Cache path (may not exist yet)
+    """
+    data_file = Path(dataset.data_file).resolve()
+    stat = data_file.stat()
+    key_fields = {
+        "data_file": str(data_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "tokenizer": tokenizer_fingerprint(dataset.tokenizer),
+        "max_length": dataset.max_length,
+        "include_metadata": dataset.include_metadata,
+        "metadata_format": _metadata_format_key(dataset),
+        "version": PRETOKENIZED_FORMAT_VERSION,
+    }
+    key = hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    root = Path(cache_dir) if cache_dir else data_file.parent / ".tokenized"
+    return root / f"{data_file.stem}-{key}"
+
+
+def pretokenize_dataset(
+    dataset: Union[HumanEvalDataset, LazyHumanEvalDataset],
+    num_workers: int = 1,
+    cache_dir: Optional[str] = None
+) -> PretokenizedDataset:
+    """
+    Tokenize a dataset once (in parallel) and cache it as memory-mapped arrays
+
+    Chunks of samples are tokenized by `num_workers` processes and written
+    straight into the cache arrays, so the corpus is never held in memory
+    as Python objects. Later runs with the same data and tokenizer load the
+    cache instantly; a vocabulary change gives a new cache.
+
+    Args:
+        dataset: HumanEvalDataset or LazyHumanEvalDataset
+        num_workers: Tokenization processes (<= 1 = in this process)
+        cache_dir: Root cache directory (None = `.tokenized/` next to the data file)
+
+    Returns:
+        PretokenizedDataset
+    """
+    import numpy as np
+
+    cache_path = pretokenized_cache_path(dataset, cache_dir)
+    if (cache_path / "meta.json").exists():
+        print(f"   ⚡ Pre-tokenized cache hit: {cache_path}")
+        return PretokenizedDataset(cache_path, source=dataset)
+
+    start = time.perf_counter()
+    tokenizer = dataset.tokenizer
+    num_samples = len(dataset)
+    max_length = dataset.max_length
+
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp-{os.getpid()}")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    input_ids = np.lib.format.open_memmap(
+        tmp_path / "input_ids.npy", mode="w+", dtype=np.int32, shape=(num_samples, max_length)
     )
+    attention_mask = np.lib.format.open_memmap(
+        tmp_path / "attention_mask.npy", mode="w+", dtype=np.uint8, shape=(num_samples, max_length)
+    )
+
+    task_ids: List[str] = []
+    token_lengths: List[int] = []
+    samples_with_metadata = 0
+
+    def texts():
+        nonlocal samples_with_metadata
+        for sample in dataset.iter_samples():
+            task_ids.append(sample.task_id)
+            if sample.metadata:
+                samples_with_metadata += 1
+            yield sample.to_training_text(dataset.include_metadata, dataset.metadata_formatter)
+
+    def store(row: int, encoded) -> int:
+        chunk_ids, chunk_mask, chunk_lengths = encoded
+        input_ids[row:row + len(chunk_ids)] = chunk_ids
+        attention_mask[row:row + len(chunk_ids)] = chunk_mask
+        token_lengths.extend(chunk_lengths)
+        return row + len(chunk_ids)
+
+    row = 0
+    chunks = _chunked(texts(), PRETOKENIZE_CHUNK_SIZE)
+    if num_samples <= PRETOKENIZE_CHUNK_SIZE:
+        # A single chunk: starting worker processes would cost more than it saves
+        num_workers = 1
+    if num_workers <= 1:
+        for chunk in chunks:
+            row = store(row, _encode_chunk(chunk, max_length, tokenizer))
+    else:
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_pretokenize_worker,
+            initargs=(tokenizer,)
+        ) as pool:
+            # Bounded in-flight chunks (Executor.map would read the whole corpus
+            # up front); results are stored in order
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_encode_chunk, chunk, max_length))
+                if len(pending) >= 2 * num_workers:
+                    row = store(row, pending.popleft().result())
+            while pending:
+                row = store(row, pending.popleft().result())
+
+    input_ids.flush()
+    attention_mask.flush()
+    del input_ids, attention_mask
+
+    meta = {
+        "data_file": str(dataset.data_file),
+        "task_ids": task_ids,
+        "token_lengths": token_lengths,
+        "samples_with_metadata": samples_with_metadata,
+        "pad_token_id": tokenizer.pad_token_id,
+        "max_length": max_length,
+        "include_metadata": dataset.include_metadata,
+        "metadata_format": _metadata_format_key(dataset),
+        "tokenizer_fingerprint": tokenizer_fingerprint(tokenizer),
+        "version": PRETOKENIZED_FORMAT_VERSION,
+    }
+    with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    # Another process may have finished the same cache first
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    print(f"   💾 Pre-tokenized {num_samples} samples in {time.perf_counter() - start:.1f}s "
+          f"({max(num_workers, 1)} worker(s)): {cache_path}")
+    return PretokenizedDataset(cache_path, source=dataset)
 
 
-def get_dataset_stats(dataset: HumanEvalDataset) -> Dict[str, Any]:
+def get_dataset_stats(
+    dataset: Union[HumanEvalDataset, LazyHumanEvalDataset, PretokenizedDataset]
+) -> Dict[str, Any]:
     """
     Get dataset statistics
 
+    Samples are streamed and only running totals are kept, so this also
+    works on LazyHumanEvalDataset without materializing the corpus.
+
     Args:
-        dataset: HumanEvalDataset instance
+        dataset: HumanEvalDataset, LazyHumanEvalDataset or PretokenizedDataset
 
     Returns:
         Dict with statistics
     """
     total_samples = len(dataset)
-    samples_with_metadata = sum(1 for s in dataset.samples if s.metadata)
+    samples_with_metadata = 0
+
+    # Lengths were recorded while pre-tokenizing
+    if isinstance(dataset, PretokenizedDataset):
+        lengths = dataset.token_lengths
+        return {
+            "total_samples": total_samples,
+            "samples_with_metadata": dataset.samples_with_metadata,
+            "avg_token_length": sum(lengths) / total_samples if total_samples else 0.0,
+            "max_token_length": max(lengths, default=0),
+            "min_token_length": min(lengths, default=0),
+            "samples_exceeding_max_length": sum(1 for n in lengths if n > dataset.max_length)
+        }
 
     # Token length statistics
-    token_lengths = []
-    for sample in dataset.samples:
-        text = sample.to_training_text(include_metadata=dataset.include_metadata)
-        tokens = dataset.tokenizer(text, return_tensors="pt")
-        token_lengths.append(tokens["input_ids"].shape[1])
+    total_tokens = 0
+    max_tokens = 0
+    min_tokens = None
+    exceeding = 0
+    for sample in dataset.iter_samples():
+        if sample.metadata:
+            samples_with_metadata += 1
+
+        text = sample.to_training_text(dataset.include_metadata, dataset.metadata_formatter)
+        length = len(dataset.tokenizer(text)["input_ids"])
+
+        total_tokens += length
+        max_tokens = max(max_tokens, length)
+        min_tokens = length if min_tokens is None else min(min_tokens, length)
+        if length > dataset.max_length:
+            exceeding += 1
 
     stats = {
         "total_samples": total_samples,
         "samples_with_metadata": samples_with_metadata,
-        "avg_token_length": sum(token_lengths) / len(token_lengths),
-        "max_token_length": max(token_lengths),
-        "min_token_length": min(token_lengths),
-        "samples_exceeding_max_length": sum(
-            1 for length in token_lengths if length > dataset.max_length
-        )
+        "avg_token_length": total_tokens / total_samples if total_samples else 0.0,
+        "max_token_length": max_tokens,
+        "min_token_length": min_tokens or 0,
+        "samples_exceeding_max_length": exceeding
     }
 
     return stats
 
 
+# Samples read for the header cost report
+HEADER_REPORT_SAMPLES = 1000
+
+
+def metadata_header_report(
+    dataset: Union[HumanEvalDataset, LazyHumanEvalDataset, PretokenizedDataset],
+    max_samples: int = HEADER_REPORT_SAMPLES
+) -> Dict[str, Dict[str, float]]:
+    """
+    Header token cost of each metadata encoding
+
+    Rows use the dataset formatter's drop_evident and token_budget settings
+    for every encoding, plus "verbose (original)" (full verbose header).
+
+    Args:
+        dataset: Experiment dataset (include_metadata=True)
+        max_samples: Samples to read from the start of the dataset
+
+    Returns:
+        Dict of encoding -> {"mean", "p95", "max" header tokens,
+        "share" of sample tokens, "truncated" samples}
+    """
+    source = dataset.source if isinstance(dataset, PretokenizedDataset) else dataset
+    tokenizer = source.tokenizer
+    current = dataset.metadata_formatter or MetadataHeaderFormatter()
+    formatters = {"verbose (original)": MetadataHeaderFormatter("verbose", tokenizer=tokenizer)}
+    for encoding in METADATA_ENCODINGS:
+        formatters[encoding] = MetadataHeaderFormatter(
+            encoding, current.drop_evident, current.token_budget, tokenizer
+        )
+
+    body_tokens = 0
+    header_tokens = {name: [] for name in formatters}
+    truncated = {name: 0 for name in formatters}
+    for sample in islice(dataset.iter_samples(), max_samples):
+        if not sample.metadata:
+            continue
+        body_tokens += len(tokenizer(sample.prompt + sample.completion, add_special_tokens=False)["input_ids"])
+        for name, formatter in formatters.items():
+            header, dropped = formatter.render(sample.metadata, sample.prompt)
+            header_tokens[name].append(formatter.count_tokens(header))
+            truncated[name] += bool(dropped)
+
+    report = {}
+    for name, counts in header_tokens.items():
+        counts = sorted(counts)
+        total = sum(counts)
+        report[name] = {
+            "mean": total / len(counts) if counts else 0.0,
+            "p95": counts[int(0.95 * (len(counts) - 1))] if counts else 0,
+            "max": counts[-1] if counts else 0,
+            "share": total / (total + body_tokens) if total + body_tokens else 0.0,
+            "truncated": truncated[name],
+        }
+    return report
+
+
+def collate_batch(features: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Collate samples into a batch
+
+    Samples are already padded to max_length, so tensors are stacked.
+    task_id strings are kept as a list (the default HF collators try to
+    tensorize every field and fail on them).
+
+    Args:
+        features: Samples from __getitem__
+
+    Returns:
+        Batch dict with stacked tensors and a task_id list
+    """
+    batch = {
+        key: torch.stack([f[key] for f in features])
+        for key in ("input_ids", "attention_mask", "labels")
+    }
+    batch["task_id"] = [f["task_id"] for f in features]
+
+    return batch
+
+
 if __name__ == "__main__":
     """Test dataset loading"""
     print("🧪 Testing dataset loader...")
@@ -247,5 +1085,6 @@ if __name__ == "__main__":
     print("       'datasets/control/train.jsonl',")
     print("       tokenizer,")
     print("       max_length=2048,")
-    print("       include_metadata=False  # False for control, True for experiment")
+    print("       include_metadata=False,  # False for control, True for experiment")
+    print("       lazy=False  # True for large corpora (offset-indexed, low memory)")
     print("   )")
@@ -0,0 +1,167 @@
+"""
+Distributed Data-Parallel Helpers
+
+Multi-process training via torch.distributed. Launch with torchrun:
+
+    # CPU box (gloo), 4 processes
+    torchrun --nproc_per_node 4 train.py --stage smoke --cpu
+
+    # GPU cluster (nccl), 2 nodes x 8 GPUs
+    torchrun --nnodes 2 --nproc_per_node 8 --rdzv_backend c10d \\
+        --rdzv_endpoint $HEAD:29500 train.py --stage stage4
+
+The same code path is used for both; only the backend differs.
+"""
+
+import os
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Dict, Optional
+
+import torch
+import torch.distributed as dist
+
+
+@dataclass
+class DistributedContext:
+    """Process layout for the current run"""
+
+    rank: int = 0
+    local_rank: int = 0
+    world_size: int = 1
+    backend: Optional[str] = None
+    use_cpu: bool = False
+
+    @property
+    def is_distributed(self) -> bool:
+        return self.world_size > 1
+
+    @property
+    def is_main_process(self) -> bool:
+        return self.rank == 0
+
+    @property
+    def device(self) -> str:
+        if self.use_cpu:
+            return "cpu"
+        return f"cuda:{self.local_rank}"
+
+
+def init_distributed(
+    backend: Optional[str] = None,
+    use_cpu: bool = False,
+    timeout_minutes: int = 30
+) -> DistributedContext:
+    """
+    Initialize the process group if launched by torchrun
+
+    Args:
+        backend: "gloo" or "nccl" (None = nccl on GPU, gloo on CPU)
+        use_cpu: Train on CPU even if CUDA is available
+        timeout_minutes: Collective timeout
+
+    Returns:
+        DistributedContext (world_size 1 when not launched by torchrun)
+    """
+    use_cpu = use_cpu or not torch.cuda.is_available()
+    if backend is None:
+        backend = "gloo" if use_cpu else "nccl"
+    if backend == "nccl" and use_cpu:
+        raise ValueError("NCCL backend requires CUDA; use --ddp-backend gloo on CPU")
+
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    rank = int(os.environ.get("RANK", 0))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+    ctx = DistributedContext(
+        rank=rank,
+        local_rank=local_rank,
+        world_size=world_size,
+        backend=backend if world_size > 1 else None,
+        use_cpu=use_cpu
+    )
+
+    if not ctx.is_distributed:
+        return ctx
+
+    if not use_cpu:
+        torch.cuda.set_device(local_rank)
+
+    if not dist.is_initialized():
+        dist.init_process_group(
+            backend=backend,
+            timeout=timedelta(minutes=timeout_minutes)
+        )
+
+    if ctx.is_main_process:
+        print(f"🌐 Distributed: {world_size} processes, backend={backend}, device={'cpu' if use_cpu else 'cuda'}")
+
+    return ctx
+
+
+def configure_cpu_threads(ctx: DistributedContext) -> int:
+    """
+    Split CPU cores evenly across ranks
+
+    Every rank defaulting to all cores oversubscribes the machine and is
+    much slower than one intra-op thread pool per core slice.
+
+    Args:
+        ctx: Distributed context
+
+    Returns:
+        Intra-op threads used by this rank
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+
+    threads = max(1, cores // ctx.world_size)
+    torch.set_num_threads(threads)
+
+    # Inter-op parallelism only adds contention for small models
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Already set (can only be set once per process)
+
+    if ctx.is_main_process:
+        print(f"🧵 CPU threads: {threads} per rank ({cores} cores, {ctx.world_size} rank(s))")
+
+    return threads
+
+
+def barrier(ctx: DistributedContext):
+    """Wait for all ranks (no-op when not distributed)"""
+    if ctx.is_distributed and dist.is_initialized():
+        dist.barrier()
+
+
+def all_reduce_mean(values: Dict[str, float], ctx: DistributedContext) -> Dict[str, float]:
+    """
+    Average scalar metrics across ranks
+
+    Args:
+        values: Per-rank metrics
+        ctx: Distributed context
+
+    Returns:
+        Metrics averaged over all ranks (same on every rank)
+    """
+    if not ctx.is_distributed or not values:
+        return dict(values)
+
+    keys = sorted(values)
+    device = "cpu" if ctx.use_cpu else ctx.device
+    tensor = torch.tensor([float(values[k]) for k in keys], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    tensor /= ctx.world_size
+
+    return {k: v for k, v in zip(keys, tensor.tolist())}
+
+
+def cleanup_distributed():
+    """Destroy the process group if one was created"""
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
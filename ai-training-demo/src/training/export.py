@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Merge-and-Export LoRA Adapters
+
+The evaluator wraps the base model in PeftModel, so every generated
+token runs the LoRA A/B matmuls beside each frozen projection. Merging
+folds scale * B @ A into the base weights once. The export is a plain
+transformers checkpoint in safetensors that loads without peft.
+
+Variants:
+- dtype (float16 / bfloat16 / float32): precision of the merged weights
+- dequantize: merge into the 4-bit base the adapter was trained against,
+  dequantized, instead of the original full-precision weights. QLoRA
+  adapters learn around NF4 rounding, so this reproduces the trained
+  model (needs CUDA + bitsandbytes). Default when the run trained 4-bit.
+- quantize (int8 / nf4): additionally save a re-quantized copy of the
+  merged model with bitsandbytes (needs CUDA)
+
+Before saving, logits of the merged model are compared with the adapter
+model on probe prompts. Exports beyond MERGE_TOLERANCE are rejected, and
+the difference is recorded in export_meta.json.
+
+Usage:
+    # After training
+    python train.py --stage stage4 --experiment-type control --export-merged
+
+    # From a finished run (writes outputs/final/control/merged-float16)
+    python export.py --stage stage4 --experiment-type control
+
+    # Any adapter, plus an NF4 re-quantized copy
+    python export.py --stage stage4 --adapter outputs/final/control/checkpoint-300 --quantize nf4
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from config import ExperimentConfig, ModelConfig, get_stage_config
+
+
+EXPORT_META_FILE = "export_meta.json"
+EXPORT_DTYPES = ("float16", "bfloat16", "float32")
+EXPORT_QUANTIZATIONS = ("int8", "nf4")
+
+# Max |logit| difference between the adapter model and the merged model
+MERGE_TOLERANCE = {"float32": 1e-3, "float16": 5e-2, "bfloat16": 2.5e-1}
+
+# HumanEval-style prompts for the merge check
+PROBE_PROMPTS = [
+    'def add(a: int, b: int) -> int:\n    """Return the sum of a and b."""\n',
+    "from typing import List\n\n\ndef has_close_elements(numbers: List[float], threshold: float) -> bool:\n"
+    '    """Check if any two numbers are closer to each other than the threshold."""\n',
+]
+
+
+def is_merged_export(path: str) -> bool:
+    """Check whether path holds a merged export (not a LoRA adapter)"""
+    return (Path(path) / EXPORT_META_FILE).exists()
+
+
+def merged_export_path(output_dir: str, variant: str) -> Path:
+    """
+    Export directory for a variant
+
+    Args:
+        output_dir: Run output directory
+        variant: dtype or quantization name
+
+    Returns:
+        Path such as outputs/final/control/merged-float16
+    """
+    return Path(output_dir) / f"merged-{variant}"
+
+
+def _bnb_4bit_config(model_config: ModelConfig):
+    """BitsAndBytesConfig matching the training quantization"""
+    import torch
+    from transformers import BitsAndBytesConfig
+
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=getattr(torch, model_config.bnb_4bit_compute_dtype),
+        bnb_4bit_quant_type=model_config.bnb_4bit_quant_type,
+        bnb_4bit_use_double_quant=model_config.bnb_4bit_use_double_quant
+    )
+
+
+def _dequantize_to_cpu(model, dtype):
+    """
+    Replace bitsandbytes 4-bit linears with dequantized nn.Linear on CPU
+
+    Layer by layer, so GPU memory never holds more than the 4-bit model
+    (a full fp16 8B model would not fit a 12GB card).
+    """
+    import bitsandbytes as bnb
+    import torch
+
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if not isinstance(child, bnb.nn.Linear4bit):
+                continue
+            weight = bnb.functional.dequantize_4bit(child.weight.data, child.weight.quant_state)
+            linear = torch.nn.Linear(
+                child.in_features, child.out_features,
+                bias=child.bias is not None, device="cpu", dtype=dtype
+            )
+            linear.weight.data = weight.to("cpu", dtype)
+            if child.bias is not None:
+                linear.bias.data = child.bias.data.to("cpu", dtype)
+            setattr(module, child_name, linear)
+
+    # Bypass PreTrainedModel.to, which refuses bitsandbytes models
+    torch.nn.Module.to(model, device="cpu", dtype=dtype)
+    model.hf_quantizer = None
+    model.is_quantized = False
+    model.is_loaded_in_4bit = False
+    model.quantization_method = None
+    if hasattr(model.config, "quantization_config"):
+        del model.config.quantization_config
+    return model
+
+
+def load_export_base(
+    base_model: str,
+    dtype: str,
+    dequantize: bool = False,
+    model_config: Optional[ModelConfig] = None
+):
+    """
+    Load the base model that the adapter is merged into (on CPU)
+
+    Args:
+        base_model: Hub name or local path of the base model
+        dtype: Merged weight precision
+        dequantize: Load 4-bit as in training, then dequantize
+        model_config: Model configuration (4-bit settings for dequantize)
+
+    Returns:
+        Base model on CPU
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    torch_dtype = getattr(torch, dtype)
+    if not dequantize:
+        return AutoModelForCausalLM.from_pretrained(
+            base_model, torch_dtype=torch_dtype, low_cpu_mem_usage=True, trust_remote_code=True
+        )
+
+    if not torch.cuda.is_available():
+        raise RuntimeError("--dequantize needs CUDA and bitsandbytes (the 4-bit base only loads on GPU)")
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model,
+        quantization_config=_bnb_4bit_config(model_config or ModelConfig()),
+        torch_dtype=torch_dtype,
+        device_map={"": 0},
+        trust_remote_code=True
+    )
+    model = _dequantize_to_cpu(model, torch_dtype)
+    torch.cuda.empty_cache()
+    return model
+
+
+def _probe_logits(model, tokenizer) -> List[Any]:
+    """Float32 logits for each probe prompt"""
+    import torch
+
+    logits = []
+    with torch.no_grad():
+        for prompt in PROBE_PROMPTS:
+            inputs = tokenizer(prompt, return_tensors="pt", return_token_type_ids=False)
+            logits.append(model(**inputs).logits.float())
+    return logits
+
+
+def _write_atomically(output_path: Path, write_fn):
+    """Write into a temporary dir and swap it into place"""
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    write_fn(tmp_path)
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+
+
+def _write_meta(path: Path, meta: Dict[str, Any]):
+    with open(path / EXPORT_META_FILE, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+
+def merge_and_export(
+    adapter_path: str,
+    base_model: str,
+    output_path: str,
+    dtype: str = "float16",
+    dequantize: bool = False,
+    model_config: Optional[ModelConfig] = None
+) -> Path:
+    """
+    Merge a LoRA adapter into its base model and save the result
+
+    Args:
+        adapter_path: Saved adapter (final_model or a checkpoint)
+        base_model: Hub name or local path of the base model
+        output_path: Export directory (replaced if it exists)
+        dtype: Merged weight precision ("float16", "bfloat16", "float32")
+        dequantize: Merge into the dequantized 4-bit training base
+        model_config: Model configuration (4-bit settings)
+
+    Returns:
+        Path of the merged export
+    """
+    from peft import PeftModel
+    from transformers import AutoTokenizer
+
+    if dtype not in EXPORT_DTYPES:
+        raise ValueError(f"dtype must be one of {EXPORT_DTYPES}, got {dtype!r}")
+
+    start = time.perf_counter()
+    output_path = Path(output_path)
+    print(f"🔀 Merging {adapter_path} into {base_model} ({dtype}"
+          f"{', dequantized 4-bit base' if dequantize else ''})...")
+
+    tokenizer = AutoTokenizer.from_pretrained(adapter_path, trust_remote_code=True)
+    base = load_export_base(base_model, dtype, dequantize, model_config)
+    if len(tokenizer) > base.get_input_embeddings().weight.shape[0]:
+        # Added vocabulary: the trained rows come with the adapter (modules_to_save)
+        base.resize_token_embeddings(len(tokenizer))
+    model = PeftModel.from_pretrained(base, adapter_path)
+    model.eval()
+
+    reference = _probe_logits(model, tokenizer)
+    merged = model.merge_and_unload()
+    max_diff = max(
+        (ref - out).abs().max().item()
+        for ref, out in zip(reference, _probe_logits(merged, tokenizer))
+    )
+    tolerance = MERGE_TOLERANCE[dtype]
+    print(f"   Max logit difference vs adapter: {max_diff:.2e} (tolerance {tolerance:.0e})")
+    if max_diff > tolerance:
+        raise RuntimeError(
+            f"Merged model differs from the adapter model by {max_diff:.2e}; "
+            f"export in float32 or check the base model"
+        )
+
+    meta = {
+        "adapter": str(adapter_path),
+        "base_model": base_model,
+        "dtype": dtype,
+        "dequantized": dequantize,
+        "quantization": None,
+        "max_logit_diff": max_diff,
+        "tolerance": tolerance,
+        "exported_at": datetime.now().isoformat(),
+    }
+
+    def write_merged(path: Path):
+        merged.save_pretrained(str(path), safe_serialization=True)
+        tokenizer.save_pretrained(str(path))
+        _write_meta(path, meta)
+
+    _write_atomically(output_path, write_merged)
+    print(f"   ✅ Merged model saved: {output_path} ({time.perf_counter() - start:.1f}s)")
+    return output_path
+
+
+def quantize_export(merged_path: Path, quantize: str, model_config: Optional[ModelConfig] = None) -> Path:
+    """
+    Save a bitsandbytes re-quantized copy of a merged export
+
+    Args:
+        merged_path: Merged export directory
+        quantize: "int8" or "nf4"
+        model_config: Model configuration (4-bit settings for nf4)
+
+    Returns:
+        Path of the quantized export (merged-<quantize> beside merged_path)
+    """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+    if not torch.cuda.is_available():
+        raise RuntimeError("Re-quantized exports need CUDA and bitsandbytes")
+
+    merged_path = Path(merged_path)
+    output_path = merged_path.with_name(f"merged-{quantize}")
+    print(f"🗜️  Re-quantizing {merged_path} to {quantize}...")
+
+    quantization_config = (
+        BitsAndBytesConfig(load_in_8bit=True) if quantize == "int8"
+        else _bnb_4bit_config(model_config or ModelConfig())
+    )
+    model = AutoModelForCausalLM.from_pretrained(
+        str(merged_path), quantization_config=quantization_config, device_map={"": 0}
+    )
+    tokenizer = AutoTokenizer.from_pretrained(str(merged_path))
+    with open(merged_path / EXPORT_META_FILE, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta.update(quantization=quantize, exported_at=datetime.now().isoformat())
+
+    def write_quantized(path: Path):
+        model.save_pretrained(str(path), safe_serialization=True)
+        tokenizer.save_pretrained(str(path))
+        _write_meta(path, meta)
+
+    _write_atomically(output_path, write_quantized)
+    print(f"   ✅ Quantized model saved: {output_path}")
+    return output_path
+
+
+def export_run(
+    adapter_path: str,
+    model_config: ModelConfig,
+    experiment_config: ExperimentConfig
+) -> Path:
+    """
+    Export a run's adapter with the run's export settings
+
+    Args:
+        adapter_path: Saved adapter (usually <output_dir>/final_model)
+        model_config: Model configuration
+        experiment_config: Experiment configuration (export settings)
+
+    Returns:
+        Path of the export (the re-quantized copy if export_quantize is set)
+    """
+    base_model = model_config.model_name
+    if model_config.smoke_test:
+        # No hub model: train.py keeps the base next to the adapter
+        base_model = str(Path(experiment_config.output_dir) / "smoke_base")
+
+    dequantize = experiment_config.export_dequantize
+    if dequantize is None:
+        dequantize = model_config.load_in_4bit
+
+    # The merged model is freed before the quantized copy is loaded
+    path = merge_and_export(
+        adapter_path,
+        base_model,
+        str(merged_export_path(experiment_config.output_dir, experiment_config.export_dtype)),
+        dtype=experiment_config.export_dtype,
+        dequantize=dequantize,
+        model_config=model_config
+    )
+    if experiment_config.export_quantize:
+        path = quantize_export(path, experiment_config.export_quantize, model_config)
+    return path
+
+
+def main():
+    """Export a trained adapter as a merged model"""
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into its base model and export it")
+    parser.add_argument(
+        "--stage",
+        type=str,
+        default="stage1",
+        choices=["smoke", "stage1", "stage4"],
+        help="Training stage of the run (base model and output dir)"
+    )
+    parser.add_argument(
+        "--experiment-type",
+        type=str,
+        default="control",
+        choices=["control", "experiment"],
+        help="Experiment type of the run"
+    )
+    parser.add_argument(
+        "--adapter",
+        type=str,
+        default=None,
+        help="Adapter dir (default: <output_dir>/final_model)"
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float16",
+        choices=EXPORT_DTYPES,
+        help="Precision of the merged weights"
+    )
+    parser.add_argument(
+        "--dequantize",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Merge into the dequantized 4-bit training base (default: when the stage trains 4-bit)"
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=EXPORT_QUANTIZATIONS,
+        help="Also save a bitsandbytes re-quantized copy (needs CUDA)"
+    )
+    args = parser.parse_args()
+
+    model_config, _, _, experiment_config = get_stage_config(args.stage, args.experiment_type)
+    experiment_config.export_dtype = args.dtype
+    experiment_config.export_dequantize = args.dequantize
+    experiment_config.export_quantize = args.quantize
+    adapter_path = args.adapter or str(Path(experiment_config.output_dir) / "final_model")
+
+    export_run(adapter_path, model_config, experiment_config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Successive-Halving Trial Scheduler
+
+Stage 4 takes hours per model, and a weak configuration normally burns the
+whole budget before its eval loss is seen. This scheduler starts many
+trials on a small step budget, ranks them by eval_loss at each rung and
+promotes only the best 1/eta to the next (eta times larger) budget:
+
+    9 trials x 50 steps -> 3 trials x 150 steps -> 1 trial x 450 steps
+
+Every trial is configured for the final budget (same LR schedule as a
+full run) and stopped at rung boundaries by a callback; a promoted trial
+resumes from its rung checkpoint (weights, optimizer, scheduler, data
+position), so a surviving trial matches one trained straight through up
+to resume nondeterminism. All trials share one resident base model
+(see sweep.py); a trial's adapter and optimizer are released as soon as
+its rung ends, and pruned trials are never loaded again.
+
+Usage:
+    python halving.py --stage stage4 --experiment-type experiment \\
+        --grid model.lora_r=8,16,32 --grid training.learning_rate=1e-4,2e-4,4e-4 \\
+        --min-steps 50 --max-steps 450 --eta 3
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import DistributedConfig
+from sweep import (
+    TrialResult,
+    expand_grid,
+    parse_grid,
+    trial_configs,
+    trial_name,
+    validate_overrides,
+    write_results,
+)
+
+
+@dataclass
+class Rung:
+    """One successive-halving rung"""
+
+    steps: int  # Cumulative step budget at the end of the rung
+    num_trials: int  # Trials trained in this rung
+    num_promoted: int  # Trials promoted to the next rung (0 for the last)
+
+
+def halving_schedule(num_trials: int, min_steps: int, max_steps: int, eta: int = 3) -> List[Rung]:
+    """
+    Compute rung budgets and promotion counts
+
+    Args:
+        num_trials: Trials in the first rung
+        min_steps: Step budget of the first rung
+        max_steps: Final step budget
+        eta: Reduction factor (keep the top 1/eta, multiply the budget by eta)
+
+    Returns:
+        List of Rung (last rung always ends at max_steps)
+    """
+    if eta < 2:
+        raise ValueError("eta must be >= 2")
+    if not 0 < min_steps <= max_steps:
+        raise ValueError("Need 0 < min_steps <= max_steps")
+
+    rungs = []
+    steps, trials = min_steps, num_trials
+    while True:
+        last = steps >= max_steps or trials == 1
+        steps = max_steps if last else steps
+        promoted = 0 if last else max(1, math.ceil(trials / eta))
+        rungs.append(Rung(steps=steps, num_trials=trials, num_promoted=promoted))
+        if last:
+            return rungs
+        steps, trials = min(steps * eta, max_steps), promoted
+
+
+@dataclass
+class TrialState:
+    """Live state of one trial across rungs"""
+
+    trial: int
+    overrides: Dict[str, Any]
+    configs: Tuple
+    result: TrialResult
+    last_loss: Optional[float] = None
+
+
+def train_rung(base_model, tokenizer, state: TrialState, stop_step: int, experiment_type: str, dist_ctx):
+    """
+    Train one trial up to stop_step, resuming from its last rung checkpoint
+
+    Args:
+        base_model: Prepared base model (no adapter attached)
+        tokenizer: Tokenizer
+        state: Trial state
+        stop_step: Global step at which this rung ends
+        experiment_type: "control" or "experiment"
+        dist_ctx: Distributed context
+
+    Returns:
+        Base model with the trial's adapter unloaded again
+    """
+    import gc
+
+    import torch
+    from transformers import set_seed
+    from transformers.trainer_utils import get_last_checkpoint
+
+    from callbacks import RungStopCallback
+    from train import apply_lora, build_trainer
+
+    model_config, training_config, data_config, experiment_config = state.configs
+    # Rungs resume with optimizer state, so every rung boundary needs a full checkpoint
+    training_config.checkpoint_mode = "full"
+    # Rungs are ranked by the eval at stop_step; a trial stopped earlier by a
+    # plateau or budget would have none and be pruned as the worst
+    training_config.early_stopping = False
+    training_config.max_train_minutes = None
+    training_config.max_train_tokens = None
+
+    # Fresh trials get the same adapter init; resumed ones load their weights
+    set_seed(experiment_config.seed)
+    model = apply_lora(base_model, model_config)
+    state.result.trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    output_dir = Path(experiment_config.output_dir)
+    checkpoint = get_last_checkpoint(str(output_dir)) if output_dir.exists() else None
+
+    trainer = None
+    start = time.perf_counter()
+    try:
+        trainer = build_trainer(
+            model, tokenizer, experiment_type,
+            model_config, training_config, data_config, experiment_config, dist_ctx
+        )
+        rung_stop = RungStopCallback(stop_step)
+        trainer.add_callback(rung_stop)
+
+        trainer.train(resume_from_checkpoint=checkpoint)
+        if trainer.preemption_requested():
+            # Checkpointed mid-rung; a rerun resumes the trial from there
+            state.result.status = "preempted"
+        state.last_loss = rung_stop.eval_loss
+        # The Trainer's train_loss summary averages over all steps but only
+        # sums this rung's losses after a resume; report the last logged loss
+        losses = [log["loss"] for log in trainer.state.log_history if "loss" in log]
+        state.result.train_loss = losses[-1] if losses else None
+        state.result.best_eval_loss = trainer.state.best_metric
+
+    except Exception as e:
+        # A diverging or OOM-ing trial is pruned, not fatal
+        print(f"❌ Trial {state.trial} failed: {e}")
+        state.last_loss = None
+        state.result.status = f"failed: {type(e).__name__}"
+
+    state.result.train_runtime += time.perf_counter() - start
+    state.result.eval_loss = state.last_loss
+    state.result.extra["steps"] = stop_step
+    state.result.extra[f"loss@{stop_step}"] = state.last_loss
+
+    # Release the adapter and optimizer state immediately
+    base_model = model.unload()
+    del trainer, model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    return base_model
+
+
+def halving_rank_key(result: TrialResult) -> Tuple:
+    """Sort key: trials that got further first, then by eval loss"""
+    loss = result.eval_loss
+    return (-result.extra.get("steps", 0), loss is None, loss if loss is not None else 0.0)
+
+
+def run_halving(
+    stage: str,
+    experiment_type: str,
+    trials: List[Dict[str, Any]],
+    min_steps: int,
+    max_steps: int,
+    eta: int = 3,
+    output_dir: Optional[str] = None,
+    distributed_config: Optional[DistributedConfig] = None,
+    model_cache_dir: Optional[str] = None
+) -> List[TrialResult]:
+    """
+    Run trials under successive halving
+
+    Args:
+        stage: "smoke", "stage1" or "stage4"
+        experiment_type: "control" or "experiment"
+        trials: Override dict per trial (see sweep.py)
+        min_steps: Step budget of the first rung
+        max_steps: Final step budget
+        eta: Reduction factor
+        output_dir: Output directory (default: <stage output dir>/halving)
+        distributed_config: Device / data-parallel settings (torchrun launch)
+        model_cache_dir: Prepared base-model cache directory
+
+    Returns:
+        List of TrialResult (best first)
+    """
+    from distributed import cleanup_distributed
+    from train import (
+        PREEMPTED_EXIT_CODE,
+        load_base_model,
+        metadata_tokens,
+        prepare_run_config,
+        save_smoke_base,
+        setup_tokenizer,
+        start_run,
+    )
+
+    schedule = halving_schedule(len(trials), min_steps, max_steps, eta)
+
+    print("=" * 60)
+    print(f"✂️  SUCCESSIVE HALVING: {len(trials)} trials, eta={eta}")
+    print("=" * 60)
+    for i, rung in enumerate(schedule):
+        print(f"   Rung {i}: {rung.num_trials} trial(s) to step {rung.steps}")
+    print()
+
+    start_time = time.perf_counter()
+    dist_ctx = start_run(stage, distributed_config)
+
+    configs = prepare_run_config(
+        stage, experiment_type, dist_ctx, max_steps=max_steps, model_cache_dir=model_cache_dir
+    )
+    for overrides in trials:
+        validate_overrides(overrides, configs)
+
+    halving_dir = Path(output_dir or Path(configs[3].output_dir) / "halving")
+
+    states = []
+    for trial, overrides in enumerate(trials):
+        trial_config = trial_configs(configs, trial, overrides, halving_dir)
+        result = TrialResult(
+            trial=trial,
+            name=trial_name(overrides),
+            overrides=overrides,
+            output_dir=trial_config[3].output_dir,
+            status="running"
+        )
+        states.append(TrialState(trial=trial, overrides=overrides, configs=trial_config, result=result))
+
+    def write():
+        if dist_ctx.is_main_process:
+            return write_results(
+                [s.result for s in states], halving_dir,
+                sort_key=halving_rank_key, title="Successive Halving Results"
+            )
+
+    try:
+        tokenizer = setup_tokenizer(configs[0], metadata_tokens(configs[2], experiment_type))
+        print()
+        base_model = load_base_model(configs[0], dist_ctx, tokenizer)
+        print()
+
+        if configs[0].smoke_test and dist_ctx.is_main_process:
+            save_smoke_base(base_model, tokenizer, configs[3])
+
+        alive = list(states)
+        for i, rung in enumerate(schedule):
+            print("=" * 60)
+            print(f"🪜 RUNG {i}: {len(alive)} trial(s) to step {rung.steps}")
+            print("=" * 60)
+
+            for state in alive:
+                print(f"🧪 Trial {state.trial}: {state.result.name}")
+                base_model = train_rung(base_model, tokenizer, state, rung.steps, experiment_type, dist_ctx)
+                print(f"   eval_loss@{rung.steps}: {state.last_loss}")
+                print()
+                if state.result.status == "preempted":
+                    break
+
+            if any(s.result.status == "preempted" for s in alive):
+                print("⚠️  Halving preempted: remaining rungs skipped")
+                write()
+                sys.exit(PREEMPTED_EXIT_CODE)
+
+            ranked = sorted(
+                alive,
+                key=lambda s: (s.last_loss is None, s.last_loss if s.last_loss is not None else 0.0)
+            )
+            if rung.num_promoted == 0:
+                for state in ranked:
+                    if not state.result.status.startswith("failed"):
+                        state.result.status = "completed"
+                alive = []
+            else:
+                alive = [s for s in ranked[:rung.num_promoted] if s.last_loss is not None]
+                for state in ranked[rung.num_promoted:]:
+                    if not state.result.status.startswith("failed"):
+                        state.result.status = f"pruned@{rung.steps}"
+                print(f"   Promoted: {', '.join(str(s.trial) for s in alive) or 'none'}")
+                print()
+
+            write()
+            if not alive:
+                break
+
+    finally:
+        cleanup_distributed()
+
+    paths = write()
+    results = sorted((s.result for s in states), key=halving_rank_key)
+
+    if dist_ctx.is_main_process:
+        full_steps = len(trials) * max_steps
+        used_steps = sum(s.result.extra.get("steps", 0) for s in states)
+
+        print("=" * 60)
+        print("✅ SUCCESSIVE HALVING COMPLETE")
+        print("=" * 60)
+        print(f"   Time: {time.perf_counter() - start_time:.1f}s")
+        print(f"   Steps: {used_steps} of {full_steps} for full training ({100 * used_steps / full_steps:.0f}%)")
+        best = results[0]
+        if best.eval_loss is not None:
+            print(f"   Best: trial {best.trial} ({best.name}) eval_loss={best.eval_loss:.4f}")
+            print(f"   Checkpoints: {best.output_dir}")
+        print(f"   Results: {paths[1]}")
+
+    return results
+
+
+def main():
+    """Parse arguments and run successive halving"""
+    parser = argparse.ArgumentParser(description="Successive-halving scheduler for training trials")
+
+    parser.add_argument(
+        "--stage",
+        type=str,
+        default="stage1",
+        choices=["smoke", "stage1", "stage4"],
+        help="Baseline stage config"
+    )
+
+    parser.add_argument(
+        "--experiment-type",
+        type=str,
+        default="control",
+        choices=["control", "experiment"],
+        help="Experiment type (control=no metadata, experiment=with metadata)"
+    )
+
+    parser.add_argument(
+        "--grid",
+        type=str,
+        action="append",
+        default=[],
+        metavar="SECTION.FIELD=VALUES",
+        help="Grid axis, e.g. model.lora_r=8,16 (repeatable; all combinations are trials)"
+    )
+
+    parser.add_argument(
+        "--trials",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="JSON file with a list of override dicts (in addition to --grid)"
+    )
+
+    parser.add_argument(
+        "--min-steps",
+        type=int,
+        required=True,
+        help="Step budget of the first rung"
+    )
+
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        required=True,
+        help="Final step budget of surviving trials"
+    )
+
+    parser.add_argument(
+        "--eta",
+        type=int,
+        default=3,
+        help="Keep the top 1/eta trials per rung and multiply the budget by eta"
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=None,
+        help="Output directory (default: <stage output dir>/halving)"
+    )
+
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Train on CPU"
+    )
+
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Prepared base-model cache directory"
+    )
+
+    args = parser.parse_args()
+
+    trials = expand_grid(parse_grid(args.grid))
+    if args.trials:
+        with open(args.trials, "r", encoding="utf-8") as f:
+            trials.extend(json.load(f))
+    if not trials:
+        parser.error("No trials: pass --grid and/or --trials")
+
+    run_halving(
+        stage=args.stage,
+        experiment_type=args.experiment_type,
+        trials=trials,
+        min_steps=args.min_steps,
+        max_steps=args.max_steps,
+        eta=args.eta,
+        output_dir=args.output_dir,
+        distributed_config=DistributedConfig(use_cpu=args.cpu),
+        model_cache_dir=args.model_cache
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""
+Live Training Metrics Stream
+
+Opt-in via TrainingConfig.metrics_stream_port (--metrics-stream PORT).
+Every logged step is published as a Server-Sent Event from a small
+asyncio server on a background thread, for the dashboard's split-screen
+control vs experiment chart:
+
+    GET  /events                          every run
+    GET  /events?runs=control,experiment  only these runs
+    GET  /runs                            known runs and their latest event (JSON)
+    POST /publish                         event relayed from another training process
+
+Events are named "status" (started/finished) or "metrics" (train and
+eval logs); the data is one JSON object with run, step, epoch and time:
+
+    const source = new EventSource("http://localhost:8765/events");
+    source.addEventListener("metrics", (e) => chart.add(JSON.parse(e.data)));
+
+Backpressure: each client has a bounded queue. A client that falls
+behind loses its oldest events (reported as a "dropped" event with the
+count), so a slow or stalled client never holds up training or other
+clients. The training thread only hands events to the event loop and
+never waits on a socket.
+
+Both runs share one endpoint. Paired runs publish from one process.
+When control and experiment train as separate processes on one host, the
+first binds the port and the second relays its events with POST /publish
+from a background thread (same drop-oldest policy). If the serving
+process exits first, the relay takes the port over.
+
+A new client first gets the recent history of the runs it asked for, so
+a chart opened mid-run starts filled in. Reconnects send Last-Event-ID
+and only get the events they missed.
+"""
+
+import asyncio
+import atexit
+import errno
+import json
+import math
+import socket
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from transformers import TrainerCallback
+
+
+STREAM_HISTORY = 2000  # Events kept for clients that connect mid-run
+KEEPALIVE_SECONDS = 15.0  # Comment line sent to idle clients (detects dead sockets)
+MAX_PUBLISH_BYTES = 1 << 20
+RELAY_TIMEOUT_SECONDS = 2.0
+
+_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large"}
+
+
+def _json_safe(value: Any) -> Any:
+    """Log value as strict JSON (NaN/inf -> null, unknown types -> str)"""
+    if isinstance(value, bool) or value is None or isinstance(value, (int, str)):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    try:
+        return _json_safe(float(value))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class _Client:
+    """One SSE subscriber: run filter and a bounded drop-oldest queue"""
+
+    def __init__(self, runs: Optional[Set[str]], queue_size: int):
+        self.runs = runs
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def wants(self, run: str) -> bool:
+        return self.runs is None or run in self.runs
+
+    def push(self, record: Tuple[int, str, bytes]):
+        """Queue an event, dropping the oldest one if the client is behind"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(record)
+
+
+class MetricsStreamServer:
+    """SSE endpoint on an asyncio loop in a daemon thread"""
+
+    def __init__(self, host: str, port: int, queue_size: int = 256, history: int = STREAM_HISTORY):
+        """
+        Args:
+            host: Interface to bind ("0.0.0.0" to reach it from other machines)
+            port: TCP port
+            queue_size: Events buffered per client before the oldest are dropped
+            history: Events replayed to clients that connect mid-run
+        """
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self._history: deque = deque(maxlen=history)
+        self._runs: Dict[str, Dict[str, Any]] = {}
+        self._clients: Set[_Client] = set()
+        self._next_id = 1
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """
+        Bind the port and start serving
+
+        Raises:
+            OSError: The port is taken (errno.EADDRINUSE) or cannot be bound
+        """
+        # Bind here so a port clash surfaces in the caller, not the thread
+        sock = socket.create_server((self.host, self.port))
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, sock=sock))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="metrics-stream", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def publish(self, event: Dict[str, Any]):
+        """Hand an event to the loop (thread-safe, never blocks)"""
+        self._loop.call_soon_threadsafe(self._broadcast, event)
+
+    def close(self, timeout: float = 1.0):
+        """Give clients up to `timeout` seconds to receive queued events, then stop"""
+        if self._loop is None or not self._loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(timeout), self._loop).result(timeout + 1.0)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=1.0)
+
+    # Event loop side
+
+    def _broadcast(self, event: Dict[str, Any]):
+        event_id = self._next_id
+        self._next_id += 1
+        run = str(event.get("run", ""))
+        kind = str(event.get("type", "metrics"))
+        data = json.dumps(event, separators=(",", ":"))
+        record = (event_id, run, f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n".encode("utf-8"))
+
+        self._history.append(record)
+        self._runs[run] = {"last_event_id": event_id, **{k: v for k, v in event.items() if k != "metrics"}}
+        for client in self._clients:
+            if client.wants(run):
+                client.push(record)
+
+    async def _shutdown(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while any(not client.queue.empty() for client in self._clients) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._server.close()
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_SECONDS)
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), KEEPALIVE_SECONDS)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            if method == "GET" and url.path == "/events":
+                await self._stream(writer, headers, query)
+            elif method == "GET" and url.path == "/runs":
+                await self._respond(writer, 200, json.dumps(self._runs).encode("utf-8"))
+            elif method == "POST" and url.path == "/publish":
+                length = int(headers.get("content-length", 0))
+                if length > MAX_PUBLISH_BYTES:
+                    await self._respond(writer, 413)
+                    return
+                self._broadcast(json.loads(await reader.readexactly(length)))
+                await self._respond(writer, 204)
+            elif method == "OPTIONS":
+                # CORS preflight from the dashboard dev server
+                await self._respond(writer, 204)
+            else:
+                await self._respond(writer, 404)
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            await self._respond(writer, 400)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, body: bytes = b""):
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                "Access-Control-Allow-Origin: *\r\n"
+                "Access-Control-Allow-Headers: Content-Type, Last-Event-ID\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _stream(self, writer: asyncio.StreamWriter, headers: Dict[str, str], query: Dict[str, list]):
+        runs = {run for run in query["runs"][0].split(",") if run} if "runs" in query else None
+        last_event_id = int(headers.get("last-event-id") or 0)
+
+        client = _Client(runs, self.queue_size)
+        for record in self._history:
+            if record[0] > last_event_id and client.wants(record[1]):
+                client.push(record)
+        client.dropped = 0  # History beyond the queue is not a loss
+        self._clients.add(client)
+
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Access-Control-Allow-Origin: *\r\n"
+                b"Connection: keep-alive\r\n\r\n"
+                b"retry: 2000\n\n"
+            )
+            await writer.drain()
+            while True:
+                try:
+                    record = await asyncio.wait_for(client.queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                    await writer.drain()
+                    continue
+                if client.dropped:
+                    writer.write(f"event: dropped\ndata: {{\"count\":{client.dropped}}}\n\n".encode("utf-8"))
+                    client.dropped = 0
+                writer.write(record[2])
+                # Only this client's coroutine waits on a slow socket
+                await writer.drain()
+        finally:
+            self._clients.discard(client)
+
+
+class MetricsStream:
+    """
+    Process-wide publisher for one endpoint
+
+    Serves the endpoint if the port is free; otherwise relays events to
+    the process that serves it.
+    """
+
+    def __init__(self, host: str, port: int, queue_size: int = 256):
+        """
+        Args:
+            host: Interface to bind / relay to
+            port: TCP port
+            queue_size: Events buffered per client (and for the relay)
+        """
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.server: Optional[MetricsStreamServer] = None
+        self.relay_dropped = 0
+        self._pending: deque = deque(maxlen=queue_size)
+        self._cond = threading.Condition()
+
+        if self._serve():
+            print(f"📡 Metrics stream: http://{host}:{port}/events")
+        else:
+            print(f"📡 Metrics stream: port {port} is served by another run, relaying events to it")
+            threading.Thread(target=self._relay_loop, name="metrics-relay", daemon=True).start()
+        atexit.register(self.close)
+
+    def _serve(self) -> bool:
+        server = MetricsStreamServer(self.host, self.port, self.queue_size)
+        try:
+            server.start()
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            return False
+        self.server = server
+        return True
+
+    def publish(self, event: Dict[str, Any]):
+        """Publish one event (thread-safe, never blocks on the network)"""
+        with self._cond:
+            if self.server is not None:
+                self.server.publish(event)
+                return
+            if len(self._pending) == self._pending.maxlen:
+                self.relay_dropped += 1
+            self._pending.append(event)
+            self._cond.notify()
+
+    def _relay_loop(self):
+        from urllib.error import URLError
+        from urllib.request import Request, urlopen
+
+        host = "127.0.0.1" if self.host in ("0.0.0.0", "") else self.host
+        url = f"http://{host}:{self.port}/publish"
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                event = self._pending.popleft()
+
+            body = json.dumps(event).encode("utf-8")
+            try:
+                urlopen(Request(url, data=body, headers={"Content-Type": "application/json"}),
+                        timeout=RELAY_TIMEOUT_SECONDS).close()
+            except (URLError, OSError) as e:
+                if not isinstance(getattr(e, "reason", e), ConnectionRefusedError):
+                    self.relay_dropped += 1
+                    continue
+                # The serving run has exited: take the port over
+                with self._cond:
+                    if self._serve():
+                        print(f"\n📡 Metrics stream: now serving http://{self.host}:{self.port}/events")
+                        self.server.publish(event)
+                        while self._pending:
+                            self.server.publish(self._pending.popleft())
+                        return
+                    self.relay_dropped += 1
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+_STREAMS: Dict[Tuple[str, int], MetricsStream] = {}
+
+
+def get_metrics_stream(host: str, port: int, queue_size: int = 256) -> MetricsStream:
+    """
+    Shared stream for (host, port), started on first use
+
+    Paired runs and sweep trials publish to the same endpoint.
+    """
+    key = (host, port)
+    if key not in _STREAMS:
+        _STREAMS[key] = MetricsStream(host, port, queue_size)
+    return _STREAMS[key]
+
+
+class MetricsStreamCallback(TrainerCallback):
+    """Publish run status and every log (train and eval) to a MetricsStream"""
+
+    def __init__(self, stream: MetricsStream, run: str):
+        """
+        Args:
+            stream: Shared stream (see get_metrics_stream)
+            run: Run name clients filter on ("control", "experiment", trial name)
+        """
+        self.stream = stream
+        self.run = run
+
+    def _publish(self, kind: str, state, **fields):
+        self.stream.publish({
+            "type": kind,
+            "run": self.run,
+            "step": state.global_step,
+            "epoch": _json_safe(state.epoch),
+            "time": time.time(),
+            **fields
+        })
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            self._publish("status", state, status="started", max_steps=state.max_steps)
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if state.is_world_process_zero and logs:
+            self._publish("metrics", state, metrics={key: _json_safe(value) for key, value in logs.items()})
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            self._publish("status", state, status="finished")
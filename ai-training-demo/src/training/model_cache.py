@@ -0,0 +1,180 @@
+"""
+Prepared Base-Model Cache
+
+Loading the base model from the HF cache, quantizing it and running
+prepare_model_for_kbit_training takes minutes before the first step.
+This module snapshots the prepared base model as safetensors (including
+the already-quantized 4-bit weights) so later runs memory-map it instead.
+
+Snapshots live in `<cache_dir>/<model>-<key>/`, where the key hashes the
+ModelConfig fields that change the loaded weights plus the library
+versions that produced them. Any change gives a new key (a cache miss),
+never a stale model.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from config import ModelConfig
+
+
+# ModelConfig fields that change the prepared base weights.
+# LoRA settings are applied on top of the snapshot and are not part of the key.
+CACHE_KEY_FIELDS = (
+    "model_name",
+    "load_in_4bit",
+    "bnb_4bit_compute_dtype",
+    "bnb_4bit_quant_type",
+    "bnb_4bit_use_double_quant",
+    "smoke_test",
+)
+
+CACHE_META_FILE = "cache_meta.json"
+
+
+def _library_versions() -> Dict[str, str]:
+    """Versions of the libraries that produce the snapshot"""
+    import peft
+    import torch
+    import transformers
+
+    versions = {
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "peft": peft.__version__,
+    }
+    try:
+        import bitsandbytes
+        versions["bitsandbytes"] = bitsandbytes.__version__
+    except ImportError:
+        versions["bitsandbytes"] = None
+    return versions
+
+
+def cache_key_fields(model_config: ModelConfig) -> Dict[str, Any]:
+    """
+    Collect the inputs that identify a prepared base model
+
+    Args:
+        model_config: Model configuration
+
+    Returns:
+        Dict of key fields and library versions
+    """
+    fields = {name: getattr(model_config, name) for name in CACHE_KEY_FIELDS}
+    if not model_config.load_in_4bit:
+        # Quantization settings are ignored for unquantized models
+        for name in CACHE_KEY_FIELDS:
+            if name.startswith("bnb_"):
+                fields[name] = None
+    fields["versions"] = _library_versions()
+    return fields
+
+
+def cache_key(model_config: ModelConfig) -> str:
+    """
+    Short stable hash of the cache key fields
+
+    Args:
+        model_config: Model configuration
+
+    Returns:
+        16-character hex key
+    """
+    payload = json.dumps(cache_key_fields(model_config), sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def prepared_model_path(cache_dir: str, model_config: ModelConfig) -> Path:
+    """
+    Snapshot directory for a model configuration
+
+    Args:
+        cache_dir: Root cache directory
+        model_config: Model configuration
+
+    Returns:
+        Path of the snapshot (may not exist yet)
+    """
+    safe_name = model_config.model_name.replace("/", "--")
+    return Path(cache_dir) / f"{safe_name}-{cache_key(model_config)}"
+
+
+def has_prepared_model(path: Path) -> bool:
+    """Check whether a complete snapshot exists at path"""
+    return (path / CACHE_META_FILE).exists()
+
+
+def save_prepared_model(model, path: Path, model_config: ModelConfig) -> bool:
+    """
+    Snapshot a prepared base model
+
+    Writes to a temporary directory and renames it into place, so a
+    crashed or concurrent writer never leaves a half-written snapshot.
+
+    Args:
+        model: Prepared base model (before LoRA is applied)
+        path: Snapshot directory from prepared_model_path
+        model_config: Model configuration
+
+    Returns:
+        True if the snapshot was written
+    """
+    path = Path(path)
+    if has_prepared_model(path):
+        return True
+
+    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    start = time.perf_counter()
+    try:
+        model.save_pretrained(str(tmp_path), safe_serialization=True)
+        meta = {
+            "key": path.name,
+            "fields": cache_key_fields(model_config),
+            "created": datetime.now().isoformat(),
+        }
+        with open(tmp_path / CACHE_META_FILE, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        # Serializing 4-bit weights needs recent transformers/bitsandbytes;
+        # a failed snapshot only costs the speed-up
+        print(f"   ⚠️  Could not cache prepared model: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return False
+
+    print(f"   💾 Cached prepared model: {path} ({time.perf_counter() - start:.1f}s)")
+    return True
+
+
+def load_prepared_model(path: Path, device_map: Optional[Any] = None):
+    """
+    Load a snapshot written by save_prepared_model
+
+    Weights are memory-mapped from safetensors and materialized tensor by
+    tensor; 4-bit weights are loaded as-is without re-quantizing.
+
+    Args:
+        path: Snapshot directory
+        device_map: Device placement (None = CPU, Trainer moves it)
+
+    Returns:
+        Base model (callers re-apply non-persistent preparation such as
+        gradient checkpointing and input gradients)
+    """
+    from transformers import AutoModelForCausalLM
+
+    return AutoModelForCausalLM.from_pretrained(
+        str(path),
+        device_map=device_map,
+        torch_dtype="auto",
+        low_cpu_mem_usage=True,
+        use_safetensors=True,
+        trust_remote_code=True
+    )
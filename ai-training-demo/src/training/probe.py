@@ -0,0 +1,51 @@
+"""
+pass@1 Probe Helpers
+
+Used by PassAtOneProbeCallback (callbacks.py): a fixed validation subset.
+Generation and tests use the evaluator's code (evaluation/generation.py
+and evaluation/execution.py): the same batched decoding and stop
+sequences, and one fresh sandboxed process per check. So probe and
+compare.py results count the same way.
+
+Only the standard library is imported at module level.
+"""
+
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+# Generation and the test sandbox are shared with the evaluator (src/evaluation)
+SRC_DIR = str(Path(__file__).resolve().parent.parent)
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
+
+from evaluation.execution import TIMEOUT, ExecutionEngine
+from evaluation.generation import generate_completions
+
+
+def select_probe_samples(val_file: str, num_samples: int) -> List[Dict[str, Any]]:
+    """
+    Fixed, evenly spaced subset of the validation file
+
+    The subset is the same for every run and seed, so control and
+    experiment probes are comparable.
+
+    Args:
+        val_file: Validation JSONL (task_id, prompt, test, entry_point)
+        num_samples: Subset size
+
+    Returns:
+        List of sample dicts
+    """
+    with open(val_file, "r", encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    if num_samples >= len(samples):
+        return samples
+    stride = len(samples) / num_samples
+    return [samples[int(i * stride)] for i in range(num_samples)]
+
+
+def probe_check(sample: Dict[str, Any], completion: str) -> Tuple[str, str, str]:
+    """(code, test_code, entry_point) for ExecutionEngine, as the evaluator builds it"""
+    return sample["prompt"] + completion, sample["test"], sample["entry_point"]
@@ -23,29 +23,15 @@ if not exist "..\..\datasets\control\humaneval_micro.jsonl" (
     exit /b 1
 )
 
-echo Step 1: Training CONTROL model (no metadata)
-echo ---------------------------------------------
+echo Training CONTROL and EXPERIMENT adapters (one shared base model)
+echo -----------------------------------------------------------------
 echo.
 
-python train.py --stage stage1 --experiment-type control
+python train.py --stage stage1 --experiment-type paired
 
 if errorlevel 1 (
     echo.
-    echo Control model training failed
-    exit /b 1
-)
-
-echo.
-echo.
-echo Step 2: Training EXPERIMENT model (with metadata)
-echo --------------------------------------------------
-echo.
-
-python train.py --stage stage1 --experiment-type experiment
-
-if errorlevel 1 (
-    echo.
-    echo Experiment model training failed
+    echo Paired training failed
     exit /b 1
 )
 
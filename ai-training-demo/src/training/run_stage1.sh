@@ -23,33 +23,17 @@ if [ ! -f "../../datasets/control/humaneval_micro.jsonl" ]; then
     exit 1
 fi
 
-echo "Step 1: Training CONTROL model (no metadata)"
-echo "---------------------------------------------"
+echo "Training CONTROL and EXPERIMENT adapters (one shared base model)"
+echo "-----------------------------------------------------------------"
 echo ""
 
 python train.py \
     --stage stage1 \
-    --experiment-type control
+    --experiment-type paired
 
 if [ $? -ne 0 ]; then
     echo ""
-    echo "❌ Control model training failed"
-    exit 1
-fi
-
-echo ""
-echo ""
-echo "Step 2: Training EXPERIMENT model (with metadata)"
-echo "--------------------------------------------------"
-echo ""
-
-python train.py \
-    --stage stage1 \
-    --experiment-type experiment
-
-if [ $? -ne 0 ]; then
-    echo ""
-    echo "❌ Experiment model training failed"
+    echo "❌ Paired training failed"
     exit 1
 fi
 
@@ -0,0 +1,261 @@
+"""
+Loss-Aware Sampling
+
+Opt-in via TrainingConfig.loss_aware_sampling. Instead of a uniform
+shuffle, each epoch draws len(dataset) samples with replacement, weighted
+by each sample's recent training loss. Samples the adapter has already
+learned are drawn less often and hard ones more often. Losses are
+standardized first, so the skew does not depend on the loss scale. A
+floor keeps every sample in the mix:
+
+    z_i = (loss_i - mean(loss)) / std(loss)
+    p_i = (1 - floor) * softmax(z / temperature)_i + floor / N
+
+Losses come from the training forward pass itself: HumanEvalTrainer
+computes each sample's mean token loss from the logits it already has
+and reports it here by task_id. No extra forward passes are run.
+
+- The first epoch is a plain shuffle (no losses yet). Samples not seen
+  after that count as the hardest seen so far.
+- Weights change once per epoch, when the order is drawn. Data-parallel
+  ranks sum their losses first, so every rank draws the same order and
+  accelerate shards it as usual.
+- The loss table is saved with every checkpoint, plus the current
+  epoch's order when saved mid-epoch, so a resumed run replays the same
+  batches.
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import torch
+from torch.utils.data import Sampler
+from transformers import TrainerCallback
+
+
+SAMPLER_STATE_FILE = "sampler_state.json"
+
+
+def dataset_task_ids(dataset) -> List[str]:
+    """
+    task_id of every sample, in index order
+
+    Args:
+        dataset: HumanEvalDataset, LazyHumanEvalDataset or PretokenizedDataset
+
+    Returns:
+        List of task ids
+    """
+    task_ids = getattr(dataset, "task_ids", None)
+    if task_ids is not None:
+        return list(task_ids)
+    return [sample.task_id for sample in dataset.iter_samples()]
+
+
+@torch.no_grad()
+def per_sample_loss(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """
+    Mean next-token loss of each sample in a batch
+
+    Same shift and ignore_index as the model's own loss. Rows are done
+    one at a time to bound the temporary (seq_len x vocab) buffer.
+
+    Args:
+        logits: [batch, seq_len, vocab] logits from the training forward
+        labels: [batch, seq_len] labels (-100 = ignored)
+
+    Returns:
+        [batch] float tensor on the CPU
+    """
+    losses = []
+    for row_logits, row_labels in zip(logits, labels):
+        shift_labels = row_labels[1:]
+        token_loss = torch.nn.functional.cross_entropy(
+            row_logits[:-1].float(), shift_labels, ignore_index=-100, reduction="sum"
+        )
+        losses.append(token_loss / (shift_labels != -100).sum().clamp(min=1))
+    return torch.stack(losses).cpu()
+
+
+class LossAwareSampler(Sampler):
+    """Sampler that favors high-loss samples (see module docstring)"""
+
+    def __init__(
+        self,
+        task_ids: List[str],
+        floor: float = 0.2,
+        temperature: float = 1.0,
+        ema: float = 0.5,
+        seed: int = 42,
+        device: Optional[torch.device] = None
+    ):
+        """
+        Args:
+            task_ids: task_id of every dataset index
+            floor: Share of draws spread uniformly (0 = pure loss weights,
+                1 = uniform with replacement)
+            temperature: Softmax temperature on standardized losses (lower
+                = more skew; 1 draws a sample one std above the mean ~2.7x
+                as often as an average one)
+            ema: Weight of the previous loss when a sample is seen again
+            seed: Seed for the per-epoch draws
+            device: Device for the cross-rank loss reduction (NCCL needs CUDA)
+        """
+        if not 0.0 <= floor <= 1.0:
+            raise ValueError(f"floor must be in [0, 1], got {floor}")
+        if temperature <= 0:
+            raise ValueError(f"temperature must be positive, got {temperature}")
+        if not 0.0 <= ema < 1.0:
+            raise ValueError(f"ema must be in [0, 1), got {ema}")
+
+        self.task_ids = list(task_ids)
+        self.floor = floor
+        self.temperature = temperature
+        self.ema = ema
+        self.seed = seed
+        self.device = device or torch.device("cpu")
+
+        self._positions: Dict[str, List[int]] = {}
+        for idx, task_id in enumerate(self.task_ids):
+            self._positions.setdefault(task_id, []).append(idx)
+
+        num_samples = len(self.task_ids)
+        self.losses = torch.full((num_samples,), float("nan"), dtype=torch.float64)
+        self._pending_sum = torch.zeros(num_samples, dtype=torch.float64)
+        self._pending_count = torch.zeros(num_samples, dtype=torch.float64)
+        self.epoch = 0
+        self._order: List[int] = []
+        self._restored_order: Optional[List[int]] = None
+
+    def __len__(self) -> int:
+        return len(self.task_ids)
+
+    def update(self, task_ids: List[str], losses: torch.Tensor):
+        """Record the training loss of samples in a batch (applied at the next sync)"""
+        for task_id, loss in zip(task_ids, losses.tolist()):
+            for idx in self._positions.get(task_id, ()):
+                self._pending_sum[idx] += loss
+                self._pending_count[idx] += 1
+
+    def sync(self):
+        """Fold pending losses into the table (collective on data-parallel runs)"""
+        import torch.distributed as dist
+
+        pending = torch.stack([self._pending_sum, self._pending_count])
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            pending = pending.to(self.device)
+            dist.all_reduce(pending)
+            pending = pending.cpu()
+
+        total, count = pending
+        seen = count > 0
+        new = total[seen] / count[seen]
+        old = self.losses[seen]
+        self.losses[seen] = torch.where(torch.isnan(old), new, self.ema * old + (1 - self.ema) * new)
+        self._pending_sum.zero_()
+        self._pending_count.zero_()
+
+    def weights(self) -> torch.Tensor:
+        """Draw probability of every sample"""
+        num_samples = len(self.task_ids)
+        seen = ~torch.isnan(self.losses)
+        if not seen.any():
+            return torch.full((num_samples,), 1.0 / num_samples, dtype=torch.float64)
+
+        # Unseen samples count as the hardest seen so far
+        losses = torch.where(seen, self.losses, self.losses[seen].max())
+        z = (losses - losses.mean()) / losses.std().clamp(min=1e-8) if num_samples > 1 else losses * 0
+        return (1 - self.floor) * torch.softmax(z / self.temperature, dim=0) + self.floor / num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        if self._restored_order is not None:
+            # Resumed mid-epoch: replay the order the checkpointed epoch used
+            self._order, self._restored_order = self._restored_order, None
+        else:
+            self.sync()
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            if torch.isnan(self.losses).all():
+                self._order = torch.randperm(len(self.task_ids), generator=generator).tolist()
+            else:
+                self._order = torch.multinomial(
+                    self.weights(), len(self.task_ids), replacement=True, generator=generator
+                ).tolist()
+            self.epoch += 1
+        return iter(self._order)
+
+    def stats(self) -> Dict[str, float]:
+        """How far the current epoch's draws are from uniform"""
+        num_samples = len(self.task_ids)
+        weights = self.weights()
+        return {
+            "sampling_max_weight": float(weights.max() * num_samples),
+            "sampling_min_weight": float(weights.min() * num_samples),
+            "sampling_unique_fraction": len(set(self._order)) / num_samples if self._order else 1.0,
+        }
+
+    def state_dict(self) -> Dict[str, Any]:
+        self.sync()
+        return {
+            "epoch": self.epoch,
+            "order": self._order,
+            "losses": [None if torch.isnan(loss) else float(loss) for loss in self.losses],
+            "task_ids": self.task_ids,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        if state["task_ids"] != self.task_ids:
+            raise ValueError("Sampler state is for a different dataset")
+        self.epoch = state["epoch"]
+        self.losses = torch.tensor(
+            [float("nan") if loss is None else loss for loss in state["losses"]], dtype=torch.float64
+        )
+        self._restored_order = state["order"] or None
+
+    def load_state(self, checkpoint_dir: str) -> bool:
+        """
+        Restore state saved with a checkpoint
+
+        Returns:
+            True if the checkpoint had sampler state
+        """
+        state_file = Path(checkpoint_dir) / SAMPLER_STATE_FILE
+        if not state_file.exists():
+            return False
+        with open(state_file, "r", encoding="utf-8") as f:
+            self.load_state_dict(json.load(f))
+        print(f"   🎯 Sampler state restored (epoch {self.epoch})")
+        return True
+
+
+class LossAwareSamplingCallback(TrainerCallback):
+    """Save sampler state with every checkpoint and log how skewed sampling is"""
+
+    def __init__(self, sampler: LossAwareSampler):
+        self.sampler = sampler
+
+    def on_save(self, args, state, control, **kwargs):
+        # Every rank takes part in the loss reduction; the main process writes
+        sampler_state = self.sampler.state_dict()
+        if not state.is_world_process_zero:
+            return
+        if state.epoch is not None and abs(state.epoch - round(state.epoch)) < 1e-6:
+            # Epoch finished: a resumed run draws the next epoch fresh
+            sampler_state["order"] = []
+        checkpoint_dir = Path(args.output_dir) / f"checkpoint-{state.global_step}"
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        with open(checkpoint_dir / SAMPLER_STATE_FILE, "w", encoding="utf-8") as f:
+            json.dump(sampler_state, f)
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        # Kept in trainer_state.json's log_history
+        if logs is not None and "loss" in logs:
+            logs.update(self.sampler.stats())
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        stats = self.sampler.stats()
+        print(f"\n🎯 Loss-aware sampling (epoch {self.sampler.epoch}): "
+              f"{stats['sampling_unique_fraction']:.0%} of samples drawn, "
+              f"weights {stats['sampling_min_weight']:.2f}x-{stats['sampling_max_weight']:.2f}x uniform")
@@ -0,0 +1,348 @@
+"""
+Streaming dataset for multi-source HumanEval-style corpora
+
+Mixes several JSONL sources (e.g. HumanEval-experiment plus harvested
+repos) with configurable weights, without ever materializing a corpus.
+"""
+
+import itertools
+import json
+import os
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import TrainerCallback
+
+from dataset import HumanEvalRecord, MetadataHeaderFormatter, encode_training_text
+
+
+STREAM_STATE_FILE = "stream_state.json"
+
+
+@dataclass
+class StreamSource:
+    """Single JSONL source in a streaming mix"""
+
+    path: str
+    weight: float = 1.0
+    include_metadata: bool = False
+    name: Optional[str] = None
+
+    @classmethod
+    def parse(cls, spec: str, include_metadata: bool = False) -> "StreamSource":
+        """
+        Parse a "path[:weight]" CLI spec
+
+        Args:
+            spec: Source path, optionally followed by ":weight"
+            include_metadata: Include metadata for this source
+
+        Returns:
+            StreamSource instance
+        """
+        path, sep, weight = spec.rpartition(":")
+        if not sep or not weight.replace(".", "", 1).isdigit():
+            return cls(path=spec, include_metadata=include_metadata)
+        return cls(path=path, weight=float(weight), include_metadata=include_metadata)
+
+
+class MixedStreamDataset(IterableDataset):
+    """
+    Weighted multi-source streaming Dataset
+
+    - Lines are sharded round-robin across (rank, dataloader worker)
+    - Each shard picks the next source by weight and shuffles through a
+      bounded buffer, so memory is O(shuffle_buffer_size)
+    - The stream is a deterministic function of (seed, shard), so resuming
+      only needs the number of samples consumed: workers fast-forward over
+      raw lines (no JSON decoding or tokenization) to the exact position
+    """
+
+    # Rank sharding is done here; the trainer must not shard again
+    shards_by_rank = True
+
+    def __init__(
+        self,
+        sources: List[StreamSource],
+        tokenizer,
+        max_length: int = 2048,
+        shuffle_buffer_size: int = 1000,
+        seed: int = 42,
+        cycle: bool = True,
+        batch_size: int = 1,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        metadata_formatter: Optional[MetadataHeaderFormatter] = None
+    ):
+        """
+        Initialize dataset
+
+        Args:
+            sources: Sources to mix
+            tokenizer: HuggingFace tokenizer
+            max_length: Maximum sequence length
+            shuffle_buffer_size: Shuffle buffer size per shard (1 = no shuffle)
+            seed: Seed for mixing and shuffling
+            cycle: Restart exhausted sources (infinite stream, needs max_steps)
+            batch_size: Per-device batch size (used to split resume state
+                across dataloader workers, which each yield whole batches)
+            rank: Process rank (defaults to torch.distributed / RANK)
+            world_size: Number of processes (defaults to torch.distributed / WORLD_SIZE)
+            metadata_formatter: Header encoding and budget for metadata
+                sources (None = verbose header)
+        """
+        if not sources:
+            raise ValueError("MixedStreamDataset needs at least one source")
+        for source in sources:
+            if source.weight <= 0:
+                raise ValueError(f"Source weight must be positive: {source.path}")
+            if not Path(source.path).exists():
+                raise FileNotFoundError(f"Stream source not found: {source.path}")
+
+        self.sources = sources
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.shuffle_buffer_size = max(1, shuffle_buffer_size)
+        self.seed = seed
+        self.cycle = cycle
+        self.batch_size = batch_size
+        self.rank, self.world_size = _resolve_rank(rank, world_size)
+        self.metadata_formatter = metadata_formatter
+
+        # Resume position (samples consumed by this rank)
+        self.samples_consumed = 0
+
+        print(f"🌊 Streaming {len(sources)} source(s) (rank {self.rank}/{self.world_size}):")
+        total_weight = sum(s.weight for s in sources)
+        for source in sources:
+            label = source.name or source.path
+            metadata_note = " +metadata" if source.include_metadata else ""
+            print(f"   {label}: {source.weight / total_weight:.0%}{metadata_note}")
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return resumable iteration state"""
+        return {
+            "seed": self.seed,
+            "samples_consumed": self.samples_consumed,
+            "world_size": self.world_size,
+            "sources": [
+                {"path": s.path, "weight": s.weight} for s in self.sources
+            ]
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """
+        Restore iteration state
+
+        Args:
+            state: State from state_dict()
+        """
+        saved_sources = [(s["path"], s["weight"]) for s in state.get("sources", [])]
+        current_sources = [(s.path, s.weight) for s in self.sources]
+        if saved_sources != current_sources or state.get("seed") != self.seed:
+            print("⚠️  Stream sources/seed changed since checkpoint; position is approximate")
+        if state.get("world_size", self.world_size) != self.world_size:
+            print("⚠️  World size changed since checkpoint; position is approximate")
+
+        self.samples_consumed = int(state.get("samples_consumed", 0))
+        print(f"   ⏩ Stream resumes after {self.samples_consumed} samples")
+
+    def save_state(self, output_dir: str, samples_consumed: int):
+        """
+        Write stream state next to a checkpoint
+
+        Args:
+            output_dir: Checkpoint directory
+            samples_consumed: Samples consumed by this rank so far
+        """
+        self.samples_consumed = samples_consumed
+        state_file = Path(output_dir) / _state_file_name(self.rank)
+        state_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(state_file, "w", encoding="utf-8") as f:
+            json.dump(self.state_dict(), f, indent=2)
+
+    def load_state(self, checkpoint_dir: str) -> bool:
+        """
+        Restore stream state from a checkpoint directory
+
+        Args:
+            checkpoint_dir: Checkpoint directory
+
+        Returns:
+            True if state was found
+        """
+        state_file = Path(checkpoint_dir) / _state_file_name(self.rank)
+        if not state_file.exists():
+            return False
+        with open(state_file, "r", encoding="utf-8") as f:
+            self.load_state_dict(json.load(f))
+        return True
+
+    def _shard_info(self) -> Tuple[int, int, int, int]:
+        """Return (shard_id, num_shards, logical_worker_id, num_workers)"""
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info else 0
+        num_workers = worker_info.num_workers if worker_info else 1
+
+        # DataLoader takes whole batches from workers round-robin, starting
+        # at worker 0. After a resume the next batch belongs to a different
+        # logical worker, so rotate roles to keep the exact batch order.
+        batches_consumed = self.samples_consumed // self.batch_size
+        logical_worker_id = (worker_id + batches_consumed) % num_workers
+
+        shard_id = self.rank * num_workers + logical_worker_id
+        num_shards = self.world_size * num_workers
+        return shard_id, num_shards, logical_worker_id, num_workers
+
+    def _samples_to_skip(self, logical_worker_id: int, num_workers: int) -> int:
+        """Samples this logical worker produced before the resume point"""
+        if self.samples_consumed <= 0:
+            return 0
+        if num_workers == 1:
+            return self.samples_consumed
+
+        batches_consumed = self.samples_consumed // self.batch_size
+        worker_batches = batches_consumed // num_workers
+        if logical_worker_id < batches_consumed % num_workers:
+            worker_batches += 1
+        return worker_batches * self.batch_size
+
+    def _iter_source_lines(
+        self,
+        source: StreamSource,
+        shard_id: int,
+        num_shards: int
+    ) -> Iterator[bytes]:
+        """Yield this shard's raw lines of a source (cycling if enabled)"""
+        while True:
+            produced = False
+            with open(source.path, "rb") as f:
+                for line_idx, line in enumerate(f):
+                    if line_idx % num_shards != shard_id or not line.strip():
+                        continue
+                    produced = True
+                    yield line
+
+            # Sources smaller than the shard count may have nothing for us
+            if not self.cycle or not produced:
+                return
+
+    def _iter_mixed(
+        self,
+        rng: random.Random,
+        shard_id: int,
+        num_shards: int
+    ) -> Iterator[Tuple[int, bytes]]:
+        """Yield (source_index, raw_line) picking sources by weight"""
+        streams = {
+            i: self._iter_source_lines(source, shard_id, num_shards)
+            for i, source in enumerate(self.sources)
+        }
+
+        while streams:
+            indices = list(streams)
+            weights = [self.sources[i].weight for i in indices]
+            source_idx = rng.choices(indices, weights=weights)[0]
+
+            line = next(streams[source_idx], None)
+            if line is None:
+                del streams[source_idx]
+                continue
+
+            yield source_idx, line
+
+    def _iter_shuffled(
+        self,
+        items: Iterator[Tuple[int, bytes]],
+        rng: random.Random
+    ) -> Iterator[Tuple[int, bytes]]:
+        """Shuffle through a bounded buffer"""
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = item
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _encode(self, source_idx: int, line: bytes) -> Dict[str, Any]:
+        """Decode and tokenize a raw line"""
+        source = self.sources[source_idx]
+        data = json.loads(line)
+
+        record = HumanEvalRecord(
+            task_id=data["task_id"],
+            prompt=data["prompt"],
+            completion=data["completion"],
+            metadata=data.get("metadata") if source.include_metadata else None
+        )
+        text = record.to_training_text(source.include_metadata, self.metadata_formatter)
+
+        return encode_training_text(
+            self.tokenizer, text, self.max_length, record.task_id
+        )
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        shard_id, num_shards, worker_id, num_workers = self._shard_info()
+
+        # One RNG drives mixing and shuffling so the stream is reproducible
+        rng = random.Random(f"{self.seed}-{shard_id}-{num_shards}")
+
+        stream = self._iter_shuffled(
+            self._iter_mixed(rng, shard_id, num_shards), rng
+        )
+
+        # Fast-forward over raw lines already consumed before a resume
+        skip = self._samples_to_skip(worker_id, num_workers)
+        for source_idx, line in itertools.islice(stream, skip, None):
+            yield self._encode(source_idx, line)
+
+
+def _resolve_rank(
+    rank: Optional[int],
+    world_size: Optional[int]
+) -> Tuple[int, int]:
+    """Resolve (rank, world_size) from torch.distributed or the environment"""
+    if rank is not None and world_size is not None:
+        return rank, world_size
+
+    try:
+        import torch.distributed as dist
+
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+    except ImportError:
+        pass
+
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+def _state_file_name(rank: int) -> str:
+    """Per-rank stream state file name"""
+    if rank == 0:
+        return STREAM_STATE_FILE
+    return f"stream_state_rank{rank}.json"
+
+
+class StreamStateCallback(TrainerCallback):
+    """Save the stream position alongside every Trainer checkpoint"""
+
+    def __init__(self, dataset: MixedStreamDataset):
+        self.dataset = dataset
+
+    def on_save(self, args, state, control, **kwargs):
+        samples_consumed = (
+            state.global_step
+            * args.per_device_train_batch_size
+            * args.gradient_accumulation_steps
+        )
+        checkpoint_dir = Path(args.output_dir) / f"checkpoint-{state.global_step}"
+        self.dataset.save_state(str(checkpoint_dir), samples_consumed)
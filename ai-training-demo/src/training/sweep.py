@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+"""
+Hyperparameter Sweep Runner
+
+Runs many LoRA training trials over one resident base model. The frozen
+base is loaded (and quantized) once; each trial attaches a fresh adapter,
+trains it with a fresh optimizer, records its metrics and unloads the
+adapter again. Results are written as a CSV and a markdown table sorted
+by eval loss.
+
+Overrides use `section.field` keys (section = model, training or data):
+
+    # Grid: every combination (2 x 2 = 4 trials)
+    python sweep.py --stage stage1 --experiment-type experiment \\
+        --grid model.lora_r=8,16 --grid training.learning_rate=1e-4,2e-4
+
+    # Values that are lists need JSON syntax
+    python sweep.py --stage smoke \\
+        --grid 'model.lora_target_modules=[["q_proj","v_proj"],["q_proj","k_proj","v_proj","o_proj"]]'
+
+    # Explicit trial list (JSON file with a list of override dicts)
+    python sweep.py --stage stage4 --trials sweep_trials.json --max-steps 200
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import DistributedConfig
+
+
+# Config sections that trials may override (index into the config tuple)
+OVERRIDE_SECTIONS = {
+    "model": 0,
+    "training": 1,
+    "data": 2,
+}
+
+# Model fields baked into the shared base model (cannot vary per trial)
+BASE_MODEL_FIELDS = (
+    "model_name",
+    "tokenizer_name",
+    "load_in_4bit",
+    "bnb_4bit_compute_dtype",
+    "bnb_4bit_quant_type",
+    "bnb_4bit_use_double_quant",
+    "smoke_test",
+    "prepared_cache_dir",
+)
+
+# Fields that fix the shared base model's vocabulary (metadata header tokens)
+# and the modules saved in full alongside it (cannot vary per trial)
+BASE_VOCAB_KEYS = (
+    "data.metadata_special_tokens",
+    "data.metadata_encoding",
+    "model.lora_modules_to_save",
+)
+
+RESULT_COLUMNS = [
+    "trial",
+    "name",
+    "eval_loss",
+    "best_eval_loss",
+    "train_loss",
+    "trainable_params",
+    "train_runtime",
+    "status",
+]
+
+
+@dataclass
+class TrialResult:
+    """Outcome of one sweep trial"""
+
+    trial: int
+    name: str
+    overrides: Dict[str, Any]
+    eval_loss: Optional[float] = None
+    best_eval_loss: Optional[float] = None
+    train_loss: Optional[float] = None
+    trainable_params: int = 0
+    train_runtime: float = 0.0
+    status: str = "ok"
+    output_dir: str = ""
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    def to_row(self) -> Dict[str, Any]:
+        """Flat row for the results table (extra fields and overrides become columns)"""
+        row = {column: getattr(self, column) for column in RESULT_COLUMNS}
+        row.update(self.extra)
+        row.update(self.overrides)
+        return row
+
+
+def parse_values(text: str) -> List[Any]:
+    """
+    Parse a grid value list
+
+    Accepts a JSON list (`[8, 16]`) or comma-separated values (`8,16`);
+    each comma-separated value is read as JSON if possible, else as a string.
+
+    Args:
+        text: Value list text
+
+    Returns:
+        List of values
+    """
+    try:
+        values = json.loads(text)
+        if isinstance(values, list):
+            return values
+        return [values]
+    except json.JSONDecodeError:
+        pass
+
+    values = []
+    for item in text.split(","):
+        item = item.strip()
+        try:
+            values.append(json.loads(item))
+        except json.JSONDecodeError:
+            values.append(item)
+    return values
+
+
+def parse_grid(specs: List[str]) -> Dict[str, List[Any]]:
+    """
+    Parse `--grid section.field=VALUES` arguments
+
+    Args:
+        specs: Raw grid arguments
+
+    Returns:
+        Dict of override key -> candidate values
+    """
+    grid = {}
+    for spec in specs:
+        if "=" not in spec:
+            raise ValueError(f"Grid entry must be KEY=VALUES: {spec}")
+        key, text = spec.split("=", 1)
+        grid[key.strip()] = parse_values(text)
+    return grid
+
+
+def expand_grid(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    Expand a grid into the list of all combinations
+
+    Args:
+        grid: Override key -> candidate values
+
+    Returns:
+        List of override dicts (one per trial)
+    """
+    if not grid:
+        return []
+    keys = list(grid)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*(grid[k] for k in keys))]
+
+
+def validate_overrides(overrides: Dict[str, Any], configs: Tuple) -> None:
+    """
+    Check that override keys name real config fields that may vary per trial
+
+    Args:
+        overrides: Override dict
+        configs: (model, training, data, experiment) config tuple
+
+    Raises:
+        ValueError: On unknown sections/fields or shared base-model fields
+    """
+    for key in overrides:
+        section, _, name = key.partition(".")
+        if section not in OVERRIDE_SECTIONS or not name:
+            raise ValueError(f"Override key must be one of {list(OVERRIDE_SECTIONS)}.<field>: {key}")
+
+        config = configs[OVERRIDE_SECTIONS[section]]
+        if name not in {f.name for f in fields(config)}:
+            raise ValueError(f"Unknown {section} config field: {name}")
+
+        if (section == "model" and name in BASE_MODEL_FIELDS) or key in BASE_VOCAB_KEYS:
+            raise ValueError(f"{key} is part of the shared base model and cannot vary per trial")
+
+
+def apply_overrides(configs: Tuple, overrides: Dict[str, Any]) -> Tuple:
+    """
+    Copy configs and apply trial overrides
+
+    Args:
+        configs: (model, training, data, experiment) config tuple
+        overrides: Override dict
+
+    Returns:
+        New config tuple (inputs are not modified)
+    """
+    import copy
+
+    configs = copy.deepcopy(configs)
+    for key, value in overrides.items():
+        section, _, name = key.partition(".")
+        setattr(configs[OVERRIDE_SECTIONS[section]], name, value)
+    return configs
+
+
+def trial_configs(configs: Tuple, trial: int, overrides: Dict[str, Any], sweep_dir: Path) -> Tuple:
+    """
+    Configs for one trial: overrides applied, outputs under sweep_dir/trial-NNN
+
+    Args:
+        configs: Baseline (model, training, data, experiment) configs
+        trial: Trial index
+        overrides: Override dict for this trial
+        sweep_dir: Sweep output directory
+
+    Returns:
+        New config tuple
+    """
+    configs = apply_overrides(configs, overrides)
+    experiment_config = configs[3]
+
+    trial_dir = Path(sweep_dir) / f"trial-{trial:03d}"
+    experiment_config.output_dir = str(trial_dir)
+    experiment_config.logging_dir = str(trial_dir / "logs")
+    experiment_config.experiment_name = f"{experiment_config.experiment_name}-trial{trial:03d}"
+    experiment_config.run_name = experiment_config.experiment_name
+    return configs
+
+
+def trial_name(overrides: Dict[str, Any]) -> str:
+    """Short human-readable trial name from its overrides"""
+    parts = []
+    for key, value in overrides.items():
+        name = key.partition(".")[2]
+        if isinstance(value, list):
+            value = "+".join(str(v) for v in value)
+        parts.append(f"{name}={value}")
+    return ",".join(parts) or "baseline"
+
+
+def rank_key(result: TrialResult) -> Tuple:
+    """Sort key: lowest eval loss first, trials without one last"""
+    return (result.eval_loss is None, result.eval_loss if result.eval_loss is not None else 0.0)
+
+
+def write_results(
+    results: List[TrialResult],
+    output_dir: Path,
+    sort_key=rank_key,
+    title: str = "Sweep Results"
+) -> Tuple[Path, Path]:
+    """
+    Write sweep results as CSV and a markdown table (best first)
+
+    Args:
+        results: Trial results
+        output_dir: Sweep directory
+        sort_key: Ranking key (default: eval loss)
+        title: Markdown heading
+
+    Returns:
+        Tuple of (csv_path, markdown_path)
+    """
+    ranked = sorted(results, key=sort_key)
+    rows = [r.to_row() for r in ranked]
+
+    columns = list(RESULT_COLUMNS)
+    for row in rows:
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    csv_path = output_dir / "sweep_results.csv"
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: json.dumps(v) if isinstance(v, list) else v for k, v in row.items()})
+
+    def fmt(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.4g}"
+        if isinstance(value, list):
+            return ", ".join(str(v) for v in value)
+        return str(value)
+
+    md_path = output_dir / "sweep_results.md"
+    with open(md_path, "w", encoding="utf-8") as f:
+        f.write(f"# {title}\n\n")
+        f.write(f"{len(results)} trials, best first (eval loss, lower is better)\n\n")
+        f.write("| " + " | ".join(columns) + " |\n")
+        f.write("|" + "|".join("---" for _ in columns) + "|\n")
+        for row in rows:
+            f.write("| " + " | ".join(fmt(row.get(c)) for c in columns) + " |\n")
+
+    return csv_path, md_path
+
+
+def run_trial(
+    base_model,
+    tokenizer,
+    trial: int,
+    overrides: Dict[str, Any],
+    configs: Tuple,
+    experiment_type: str,
+    sweep_dir: Path,
+    dist_ctx
+) -> Tuple[Any, TrialResult]:
+    """
+    Train one adapter on the shared base model
+
+    Args:
+        base_model: Prepared base model (no adapter attached)
+        tokenizer: Tokenizer
+        trial: Trial index
+        overrides: Override dict for this trial
+        configs: Baseline (model, training, data, experiment) configs
+        experiment_type: "control" or "experiment"
+        sweep_dir: Sweep output directory
+        dist_ctx: Distributed context
+
+    Returns:
+        Tuple of (base model with the adapter unloaded again, TrialResult)
+    """
+    import gc
+
+    import torch
+    from transformers import set_seed
+
+    from callbacks import TargetLossCallback
+    from train import apply_lora, build_trainer, run_trainer
+
+    model_config, training_config, data_config, experiment_config = trial_configs(
+        configs, trial, overrides, sweep_dir
+    )
+    name = trial_name(overrides)
+    trial_dir = Path(experiment_config.output_dir)
+
+    print("=" * 60)
+    print(f"🧪 TRIAL {trial}: {name}")
+    print("=" * 60)
+
+    result = TrialResult(trial=trial, name=name, overrides=overrides, output_dir=str(trial_dir))
+
+    # Same adapter init for every trial, independent of the trials before it
+    set_seed(experiment_config.seed)
+    model = apply_lora(base_model, model_config)
+    result.trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    print()
+
+    trainer = None
+    try:
+        trainer = build_trainer(
+            model, tokenizer, experiment_type,
+            model_config, training_config, data_config, experiment_config, dist_ctx
+        )
+
+        start = time.perf_counter()
+        final_model_path = run_trainer(trainer, tokenizer, experiment_config, dist_ctx)
+        result.train_runtime = time.perf_counter() - start
+        if final_model_path is None:
+            # Preempted: the trial checkpointed, the sweep stops after it
+            result.status = "preempted"
+        else:
+            metrics = trainer.evaluate()
+            result.eval_loss = metrics.get("eval_loss")
+            result.best_eval_loss = trainer.state.best_metric
+            train_losses = [log["train_loss"] for log in trainer.state.log_history if "train_loss" in log]
+            result.train_loss = train_losses[-1] if train_losses else None
+            for callback in trainer.callback_handler.callbacks:
+                if isinstance(callback, TargetLossCallback):
+                    result.extra["steps_to_target"] = callback.reached_step
+                    result.extra["seconds_to_target"] = callback.reached_seconds
+
+    except Exception as e:
+        # One diverging or OOM-ing trial should not end the sweep
+        print(f"❌ Trial {trial} failed: {e}")
+        result.status = f"failed: {type(e).__name__}"
+
+    # Restore the plain base model for the next trial and free optimizer state
+    base_model = model.unload()
+    del trainer, model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    print(f"   eval_loss: {result.eval_loss}")
+    print()
+    return base_model, result
+
+
+def run_sweep(
+    stage: str,
+    experiment_type: str,
+    trials: List[Dict[str, Any]],
+    output_dir: Optional[str] = None,
+    max_steps: Optional[int] = None,
+    distributed_config: Optional[DistributedConfig] = None,
+    model_cache_dir: Optional[str] = None
+) -> List[TrialResult]:
+    """
+    Run all trials over one resident base model
+
+    Args:
+        stage: "smoke", "stage1" or "stage4"
+        experiment_type: "control" or "experiment"
+        trials: Override dict per trial
+        output_dir: Sweep directory (default: <stage output dir>/sweep)
+        max_steps: Override number of optimizer steps for every trial
+        distributed_config: Device / data-parallel settings (torchrun launch)
+        model_cache_dir: Prepared base-model cache directory
+
+    Returns:
+        List of TrialResult
+    """
+    from distributed import cleanup_distributed
+    from train import (
+        PREEMPTED_EXIT_CODE,
+        load_base_model,
+        metadata_tokens,
+        prepare_run_config,
+        save_smoke_base,
+        setup_tokenizer,
+        start_run,
+    )
+
+    print("=" * 60)
+    print(f"🔬 HYPERPARAMETER SWEEP: {len(trials)} trials")
+    print("=" * 60)
+    print(f"   Stage: {stage}")
+    print(f"   Experiment: {experiment_type}")
+    print()
+
+    sweep_start = time.perf_counter()
+    dist_ctx = start_run(stage, distributed_config)
+
+    configs = prepare_run_config(
+        stage, experiment_type, dist_ctx, max_steps=max_steps, model_cache_dir=model_cache_dir
+    )
+    for overrides in trials:
+        validate_overrides(overrides, configs)
+
+    sweep_dir = Path(output_dir or Path(configs[3].output_dir) / "sweep")
+
+    try:
+        tokenizer = setup_tokenizer(configs[0], metadata_tokens(configs[2], experiment_type))
+        print()
+        base_model = load_base_model(configs[0], dist_ctx, tokenizer)
+        print()
+
+        if configs[0].smoke_test and dist_ctx.is_main_process:
+            save_smoke_base(base_model, tokenizer, configs[3])
+
+        results = []
+        for trial, overrides in enumerate(trials):
+            base_model, result = run_trial(
+                base_model, tokenizer, trial, overrides, configs,
+                experiment_type, sweep_dir, dist_ctx
+            )
+            results.append(result)
+
+            # Rewrite after every trial so a long sweep can be inspected early
+            if dist_ctx.is_main_process:
+                write_results(results, sweep_dir)
+            if result.status == "preempted":
+                print("⚠️  Sweep preempted: remaining trials skipped")
+                sys.exit(PREEMPTED_EXIT_CODE)
+
+    finally:
+        cleanup_distributed()
+
+    if dist_ctx.is_main_process:
+        csv_path, md_path = write_results(results, sweep_dir)
+        ranked = sorted((r for r in results if r.eval_loss is not None), key=lambda r: r.eval_loss)
+
+        print("=" * 60)
+        print("✅ SWEEP COMPLETE")
+        print("=" * 60)
+        print(f"   Trials: {len(results)} in {time.perf_counter() - sweep_start:.1f}s")
+        if ranked:
+            print(f"   Best: trial {ranked[0].trial} ({ranked[0].name}) eval_loss={ranked[0].eval_loss:.4f}")
+            print(f"   Adapter: {ranked[0].output_dir}/final_model")
+        print(f"   Results: {csv_path}")
+        print(f"            {md_path}")
+
+    return results
+
+
+def main():
+    """Parse arguments and run the sweep"""
+    parser = argparse.ArgumentParser(description="LoRA hyperparameter sweep over one resident base model")
+
+    parser.add_argument(
+        "--stage",
+        type=str,
+        default="stage1",
+        choices=["smoke", "stage1", "stage4"],
+        help="Baseline stage config"
+    )
+
+    parser.add_argument(
+        "--experiment-type",
+        type=str,
+        default="control",
+        choices=["control", "experiment"],
+        help="Experiment type (control=no metadata, experiment=with metadata)"
+    )
+
+    parser.add_argument(
+        "--grid",
+        type=str,
+        action="append",
+        default=[],
+        metavar="SECTION.FIELD=VALUES",
+        help="Grid axis, e.g. model.lora_r=8,16 (repeatable; all combinations are run)"
+    )
+
+    parser.add_argument(
+        "--trials",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="JSON file with a list of override dicts (run in addition to --grid)"
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=None,
+        help="Sweep directory (default: <stage output dir>/sweep)"
+    )
+
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=None,
+        help="Number of optimizer steps per trial (overrides epochs)"
+    )
+
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Train on CPU"
+    )
+
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Prepared base-model cache directory"
+    )
+
+    args = parser.parse_args()
+
+    trials = expand_grid(parse_grid(args.grid))
+    if args.trials:
+        with open(args.trials, "r", encoding="utf-8") as f:
+            trials.extend(json.load(f))
+    if not trials:
+        parser.error("No trials: pass --grid and/or --trials")
+
+    run_sweep(
+        stage=args.stage,
+        experiment_type=args.experiment_type,
+        trials=trials,
+        output_dir=args.output_dir,
+        max_steps=args.max_steps,
+        distributed_config=DistributedConfig(use_cpu=args.cpu),
+        model_cache_dir=args.model_cache
+    )
+
+
+if __name__ == "__main__":
+    main()
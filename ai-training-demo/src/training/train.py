@@ -5,6 +5,9 @@ QLoRA Fine-tuning for HumanEval
 Trains Llama-3 8B with 4-bit quantization on HumanEval dataset.
 
 Usage:
+    # Smoke test (tiny random model on CPU, < 1 min, no downloads)
+    python train.py --stage smoke --experiment-type experiment
+
     # Stage 1 validation (5 samples, 30 min)
     python train.py --stage stage1 --experiment-type control
 
@@ -12,6 +15,33 @@ Usage:
     python train.py --stage stage4 --experiment-type control
     python train.py --stage stage4 --experiment-type experiment
 
+    # Both adapters in one process over a single base-model load
+    python train.py --stage stage4 --experiment-type paired
+
+    # Data-parallel (one process per GPU, or --cpu for gloo on CPU)
+    torchrun --nproc_per_node 4 train.py --stage stage1 --cpu
+
+    # Adapter-only checkpoints written in the background (no save stalls)
+    python train.py --stage stage4 --checkpoint-mode async_adapter
+
+    # Compile the model forward (kept only if it speeds up steps)
+    python train.py --stage smoke --torch-compile
+
+    # Merge the adapter into the base model for inference (writes <output_dir>/merged-float16)
+    python train.py --stage stage4 --experiment-type control --export-merged
+
+    # Register the metadata header tags as tokens (experiment; trains embeddings too)
+    python train.py --stage stage4 --experiment-type experiment --metadata-tokens
+
+    # Pick micro-batch, accumulation and precision for this machine
+    python train.py --stage stage4 --experiment-type control --auto-tune
+
+    # Reuse the prepared base model across runs (skips load + quantization)
+    python train.py --stage stage4 --model-cache ~/.cache/humaneval-prepared
+
+    # Continue after a preemption (SIGTERM/SIGINT writes a checkpoint and exits 143)
+    python train.py --stage stage4 --experiment-type control --resume-from-checkpoint latest
+
     # Custom configuration
     python train.py --config custom_config.json
 """
@@ -19,18 +49,14 @@ Usage:
 import argparse
 import os
 import sys
+import time
 from pathlib import Path
 from datetime import datetime
+from typing import TYPE_CHECKING, List, Optional
 
-import torch
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    TrainingArguments,
-    Trainer,
-    BitsAndBytesConfig
-)
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+# Heavy libraries (torch, transformers, peft) and the modules that depend
+# on them are imported inside the functions that use them, so --help and
+# argument validation start instantly (see src/tools/check_startup.py)
 
 # Import our modules
 from config import (
@@ -38,29 +64,49 @@ from config import (
     TrainingConfig,
     DataConfig,
     ExperimentConfig,
-    get_stage1_config,
-    get_stage4_config,
+    DistributedConfig,
+    get_stage_config,
     validate_gpu
 )
-from dataset import load_humaneval_dataset, get_dataset_stats
 
+if TYPE_CHECKING:
+    from transformers import TrainingArguments
+    from distributed import DistributedContext
+    from streaming_dataset import MixedStreamDataset
+
+
+# Exit status after a preemption checkpoint (128 + SIGTERM), so schedulers requeue the job
+PREEMPTED_EXIT_CODE = 143
 
-def setup_tokenizer(model_config: ModelConfig):
+# Adapters trained over one shared base model by train_paired (in order)
+PAIRED_EXPERIMENT_TYPES = ("control", "experiment")
+
+
+def setup_tokenizer(model_config: ModelConfig, added_tokens: Optional[List[str]] = None):
     """
     Load and configure tokenizer
 
     Args:
         model_config: Model configuration
+        added_tokens: Extra vocabulary, e.g. from metadata_tokens (the
+            model's embeddings are resized to match in load_base_model)
 
     Returns:
         Configured tokenizer
     """
     print("📝 Loading tokenizer...")
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_config.tokenizer_name,
-        trust_remote_code=True
-    )
+    if model_config.smoke_test:
+        from smoke import build_tiny_tokenizer
+
+        tokenizer = build_tiny_tokenizer()
+    else:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_config.tokenizer_name,
+            trust_remote_code=True
+        )
 
     # Add padding token if missing
     if tokenizer.pad_token is None:
@@ -68,44 +114,203 @@ def setup_tokenizer(model_config: ModelConfig):
         tokenizer.pad_token_id = tokenizer.eos_token_id
 
     print(f"   ✅ Tokenizer loaded: {model_config.tokenizer_name}")
+    if added_tokens:
+        added = tokenizer.add_tokens(added_tokens)
+        print(f"   Added tokens: {added} (metadata vocabulary)")
     print(f"   Vocab size: {len(tokenizer)}")
     print(f"   PAD token: {tokenizer.pad_token}")
 
     return tokenizer
 
 
-def setup_model(model_config: ModelConfig):
+def metadata_tokens(data_config: DataConfig, experiment_type: str) -> Optional[List[str]]:
     """
-    Load model with 4-bit quantization and LoRA
+    Metadata vocabulary for the tokenizer (None = base vocabulary)
+
+    Args:
+        data_config: Data configuration (metadata_special_tokens, encoding)
+        experiment_type: "control" or "experiment"
+
+    Returns:
+        Token strings, or None for control runs or when disabled
+    """
+    if experiment_type != "experiment" or not data_config.metadata_special_tokens:
+        return None
+
+    from dataset import metadata_special_tokens
+
+    return metadata_special_tokens(data_config.metadata_encoding)
+
+
+def resize_embeddings(model, tokenizer):
+    """
+    Grow the input/output embeddings to cover added tokens
+
+    New rows start at the mean of the existing embeddings, which keeps the
+    initial loss close to the base model's.
+
+    Args:
+        model: Base model
+        tokenizer: Tokenizer (possibly with added tokens)
+
+    Returns:
+        The model (resized in place)
+    """
+    import torch
+
+    old_size = model.get_input_embeddings().weight.shape[0]
+    if tokenizer is None or len(tokenizer) <= old_size:
+        return model
+
+    model.resize_token_embeddings(len(tokenizer))
+    with torch.no_grad():
+        embeddings = [model.get_input_embeddings()]
+        if model.get_output_embeddings() is not None:
+            embeddings.append(model.get_output_embeddings())
+        for embedding in embeddings:
+            weight = embedding.weight
+            weight[old_size:] = weight[:old_size].float().mean(dim=0).to(weight.dtype)
+
+    # The input embedding module was replaced: re-register the input-grad hook
+    model.enable_input_require_grads()
+    print(f"   Embeddings resized: {old_size} -> {len(tokenizer)} tokens")
+    return model
+
+
+def load_base_model(
+    model_config: ModelConfig,
+    dist_ctx: Optional["DistributedContext"] = None,
+    tokenizer=None
+):
+    """
+    Load the frozen base model, prepared for LoRA training
+
+    With model_config.prepared_cache_dir set, the prepared model is
+    snapshotted on the first run and memory-mapped on later runs (see
+    model_cache.py).
 
     Args:
         model_config: Model configuration
+        dist_ctx: Distributed context (None = single process)
+        tokenizer: Tokenizer (required for smoke_test models)
 
     Returns:
-        PEFT model ready for training
+        Base model (quantized and prepared when load_in_4bit)
     """
-    print("🤖 Loading base model with 4-bit quantization...")
+    from distributed import DistributedContext
 
-    # 4-bit quantization config
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=model_config.load_in_4bit,
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_quant_type=model_config.bnb_4bit_quant_type,
-        bnb_4bit_use_double_quant=model_config.bnb_4bit_use_double_quant
-    )
+    dist_ctx = dist_ctx or DistributedContext()
+    start = time.perf_counter()
+
+    if dist_ctx.use_cpu:
+        # Trainer places the model; each rank holds a full replica
+        device_map = None
+    elif dist_ctx.is_distributed:
+        # One replica per GPU (device_map="auto" would split across GPUs)
+        device_map = {"": dist_ctx.local_rank}
+    else:
+        device_map = "auto"
+
+    cache_path = None
+    if model_config.prepared_cache_dir:
+        from model_cache import has_prepared_model, load_prepared_model, prepared_model_path
+
+        cache_path = prepared_model_path(model_config.prepared_cache_dir, model_config)
+        if has_prepared_model(cache_path):
+            print(f"🤖 Loading prepared base model from cache: {cache_path}")
+            model = load_prepared_model(cache_path, device_map)
+            # Gradient checkpointing and input-grad hooks are not serialized
+            model = _prepare_base_model(model, model_config)
+            model = resize_embeddings(model, tokenizer)
+            print(f"   ✅ Base model ready in {time.perf_counter() - start:.1f}s (cache hit)")
+            return model
+
+    model = _build_base_model(model_config, device_map, tokenizer)
+    model = _prepare_base_model(model, model_config)
+
+    if cache_path is not None and dist_ctx.is_main_process:
+        from model_cache import save_prepared_model
+
+        save_prepared_model(model, cache_path, model_config)
+
+    # After the snapshot, so it stays valid for any added vocabulary
+    model = resize_embeddings(model, tokenizer)
+
+    status = "cache miss" if cache_path is not None else "no cache"
+    print(f"   ✅ Base model ready in {time.perf_counter() - start:.1f}s ({status})")
+    return model
+
+
+def _build_base_model(model_config: ModelConfig, device_map, tokenizer=None):
+    """Build or download (and quantize) the base model"""
+    import torch
+    from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+    if model_config.smoke_test:
+        from smoke import build_tiny_model
+
+        print("🤖 Building tiny random-init Llama (smoke test)...")
+        model = build_tiny_model(tokenizer)
+        print(f"   ✅ Base model built: {model_config.model_name}")
+        return model
+
+    if model_config.load_in_4bit:
+        print("🤖 Loading base model with 4-bit quantization...")
+
+        # 4-bit quantization config
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=getattr(torch, model_config.bnb_4bit_compute_dtype),
+            bnb_4bit_quant_type=model_config.bnb_4bit_quant_type,
+            bnb_4bit_use_double_quant=model_config.bnb_4bit_use_double_quant
+        )
+    else:
+        print("🤖 Loading base model (no quantization)...")
+        bnb_config = None
 
     # Load base model
     model = AutoModelForCausalLM.from_pretrained(
         model_config.model_name,
         quantization_config=bnb_config,
-        device_map="auto",
+        device_map=device_map,
         trust_remote_code=True
     )
 
     print(f"   ✅ Base model loaded: {model_config.model_name}")
+    return model
+
+
+def _prepare_base_model(model, model_config: ModelConfig):
+    """Prepare a loaded base model for LoRA training (idempotent)"""
+    from peft import prepare_model_for_kbit_training
+
+    if model_config.load_in_4bit:
+        # Prepare for k-bit training
+        model = prepare_model_for_kbit_training(model)
+    else:
+        # Frozen embeddings: gradient checkpointing needs grads on inputs
+        model.enable_input_require_grads()
+
+    return model
+
+
+def apply_lora(model, model_config: ModelConfig, adapter_name: str = "default"):
+    """
+    Attach a LoRA adapter to the base model
 
-    # Prepare for k-bit training
-    model = prepare_model_for_kbit_training(model)
+    Calling it again on the returned PEFT model adds another named adapter
+    over the same frozen base; the new adapter becomes the active (and only
+    trainable) one.
+
+    Args:
+        model: Base model from load_base_model, or a PEFT model
+        model_config: Model configuration
+        adapter_name: Adapter name ("default" for single-adapter runs)
+
+    Returns:
+        PEFT model ready for training
+    """
+    from peft import LoraConfig, PeftModel, get_peft_model
 
     # LoRA configuration
     lora_config = LoraConfig(
@@ -113,17 +318,25 @@ def setup_model(model_config: ModelConfig):
         lora_alpha=model_config.lora_alpha,
         target_modules=model_config.lora_target_modules,
         lora_dropout=model_config.lora_dropout,
+        modules_to_save=list(model_config.lora_modules_to_save) or None,
         bias="none",
         task_type="CAUSAL_LM"
     )
 
     # Apply LoRA
-    model = get_peft_model(model, lora_config)
+    if isinstance(model, PeftModel):
+        model.add_adapter(adapter_name, lora_config)
+        # Freezes every other adapter
+        model.set_adapter(adapter_name)
+    else:
+        model = get_peft_model(model, lora_config, adapter_name=adapter_name)
 
-    print("   ✅ LoRA applied")
+    print(f"   ✅ LoRA applied{'' if adapter_name == 'default' else f' (adapter: {adapter_name})'}")
     print(f"   LoRA rank: {model_config.lora_r}")
     print(f"   LoRA alpha: {model_config.lora_alpha}")
     print(f"   Target modules: {len(model_config.lora_target_modules)}")
+    if model_config.lora_modules_to_save:
+        print(f"   Fully trained: {', '.join(model_config.lora_modules_to_save)}")
 
     # Print trainable parameters
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -138,11 +351,92 @@ def setup_model(model_config: ModelConfig):
     return model
 
 
+def setup_model(
+    model_config: ModelConfig,
+    dist_ctx: Optional["DistributedContext"] = None,
+    tokenizer=None
+):
+    """
+    Load model with 4-bit quantization and LoRA
+
+    Args:
+        model_config: Model configuration
+        dist_ctx: Distributed context (None = single process)
+        tokenizer: Tokenizer (required for smoke_test models)
+
+    Returns:
+        PEFT model ready for training
+    """
+    model = load_base_model(model_config, dist_ctx, tokenizer)
+    return apply_lora(model, model_config)
+
+
+def setup_stream_dataset(
+    data_config: DataConfig,
+    tokenizer,
+    model_config: ModelConfig,
+    training_config: TrainingConfig,
+    experiment_config: ExperimentConfig,
+    include_metadata: bool,
+    metadata_formatter=None
+) -> "MixedStreamDataset":
+    """
+    Build the multi-source streaming train dataset
+
+    Args:
+        data_config: Data configuration
+        tokenizer: Tokenizer
+        model_config: Model configuration
+        training_config: Training configuration
+        experiment_config: Experiment configuration
+        include_metadata: Default metadata setting for sources
+        metadata_formatter: Metadata header encoding and budget
+
+    Returns:
+        MixedStreamDataset instance
+    """
+    from streaming_dataset import MixedStreamDataset, StreamSource
+
+    if training_config.max_steps <= 0:
+        raise ValueError("Streaming requires training_config.max_steps > 0")
+
+    # Fall back to the single train file when no mix is configured
+    source_specs = data_config.train_sources or [{"path": data_config.train_file}]
+    sources = [
+        spec if isinstance(spec, StreamSource) else StreamSource(
+            path=spec["path"],
+            weight=spec.get("weight", 1.0),
+            include_metadata=spec.get("include_metadata", include_metadata),
+            name=spec.get("name")
+        )
+        for spec in source_specs
+    ]
+
+    train_dataset = MixedStreamDataset(
+        sources=sources,
+        tokenizer=tokenizer,
+        max_length=model_config.max_seq_length,
+        shuffle_buffer_size=data_config.shuffle_buffer_size,
+        seed=experiment_config.seed,
+        batch_size=training_config.per_device_train_batch_size,
+        metadata_formatter=metadata_formatter
+    )
+
+    # Continue the stream exactly where the checkpoint stopped
+    if experiment_config.resume_from_checkpoint:
+        if not train_dataset.load_state(experiment_config.resume_from_checkpoint):
+            print("   ⚠️  No stream state in checkpoint; stream restarts from the beginning")
+
+    return train_dataset
+
+
 def setup_datasets(
     data_config: DataConfig,
     tokenizer,
     model_config: ModelConfig,
-    experiment_type: str
+    experiment_type: str,
+    training_config: Optional[TrainingConfig] = None,
+    experiment_config: Optional[ExperimentConfig] = None
 ):
     """
     Load training and validation datasets
@@ -152,31 +446,80 @@ def setup_datasets(
         tokenizer: Tokenizer
         model_config: Model configuration
         experiment_type: "control" or "experiment"
+        training_config: Training configuration (required for streaming)
+        experiment_config: Experiment configuration (required for streaming)
 
     Returns:
         Tuple of (train_dataset, val_dataset)
     """
+    from dataset import (
+        MetadataHeaderFormatter,
+        get_dataset_stats,
+        load_humaneval_dataset,
+        metadata_header_report,
+        pretokenize_dataset,
+    )
+
+    def pretokenized(dataset):
+        # Tokenize once in parallel instead of in every __getitem__
+        if not data_config.pretokenize:
+            return dataset
+        return pretokenize_dataset(
+            dataset,
+            num_workers=data_config.preprocessing_num_workers,
+            cache_dir=data_config.tokenized_cache_dir
+        )
+
     print()
     print("📂 Loading datasets...")
 
     # Determine if we should include metadata
     include_metadata = (experiment_type == "experiment")
+    metadata_formatter = MetadataHeaderFormatter(
+        encoding=data_config.metadata_encoding,
+        drop_evident=data_config.metadata_drop_evident,
+        token_budget=data_config.metadata_token_budget,
+        tokenizer=tokenizer
+    )
+
+    if data_config.streaming:
+        train_dataset = setup_stream_dataset(
+            data_config, tokenizer, model_config,
+            training_config, experiment_config, include_metadata, metadata_formatter
+        )
+        val_dataset = pretokenized(load_humaneval_dataset(
+            data_file=data_config.val_file,
+            tokenizer=tokenizer,
+            max_length=model_config.max_seq_length,
+            include_metadata=include_metadata,
+            lazy=data_config.lazy_loading,
+            metadata_formatter=metadata_formatter
+        ))
+
+        # Statistics would require a full pass over every source
+        print()
+        print(f"📊 Val samples: {len(val_dataset)} (train is streamed)")
+        return train_dataset, val_dataset
 
     # Load train dataset
-    train_dataset = load_humaneval_dataset(
+    train_dataset = pretokenized(load_humaneval_dataset(
         data_file=data_config.train_file,
         tokenizer=tokenizer,
         max_length=model_config.max_seq_length,
-        include_metadata=include_metadata
-    )
+        include_metadata=include_metadata,
+        lazy=data_config.lazy_loading,
+        metadata_formatter=metadata_formatter
+    ))
 
     # Load validation dataset
-    val_dataset = load_humaneval_dataset(
+    val_dataset = pretokenized(load_humaneval_dataset(
         data_file=data_config.val_file,
         tokenizer=tokenizer,
         max_length=model_config.max_seq_length,
-        include_metadata=include_metadata
-    )
+        include_metadata=include_metadata,
+        lazy=data_config.lazy_loading,
+        metadata_formatter=metadata_formatter
+    ))
 
     # Print statistics
     print()
@@ -187,37 +530,85 @@ def setup_datasets(
     print(f"   Avg token length: {train_stats['avg_token_length']:.0f}")
     print(f"   Max token length: {train_stats['max_token_length']}")
 
+    if include_metadata:
+        # Header tokens are extra cost per sample compared to control
+        report = metadata_header_report(train_dataset)
+        print()
+        print(f"📏 Metadata header cost (tokens per sample, {metadata_formatter.describe()}):")
+        for name, row in report.items():
+            marker = "  ← active" if name == data_config.metadata_encoding else ""
+            print(f"   {name:<19} mean {row['mean']:5.1f}  p95 {row['p95']:3d}  max {row['max']:3d}  "
+                  f"{row['share']:5.1%} of tokens  {row['truncated']} truncated{marker}")
+
     if train_stats['samples_exceeding_max_length'] > 0:
         print(f"   ⚠️  {train_stats['samples_exceeding_max_length']} samples exceed max length (will be truncated)")
 
     return train_dataset, val_dataset
 
 
+def apply_cpu_overrides(
+    model_config: ModelConfig,
+    training_config: TrainingConfig
+):
+    """
+    Disable GPU-only features for CPU training
+
+    bitsandbytes quantization, paged 8-bit optimizers and fp16 autocast
+    all require CUDA.
+
+    Args:
+        model_config: Model configuration (modified in place)
+        training_config: Training configuration (modified in place)
+    """
+    print("🖥️  CPU mode: disabling 4-bit quantization, fp16 and 8-bit optimizer")
+    model_config.load_in_4bit = False
+    training_config.fp16 = False
+    training_config.bf16 = False
+    if "8bit" in training_config.optim:
+        training_config.optim = "adamw_torch"
+
+
 def setup_training_args(
     training_config: TrainingConfig,
-    experiment_config: ExperimentConfig
-) -> TrainingArguments:
+    experiment_config: ExperimentConfig,
+    data_config: Optional[DataConfig] = None,
+    dist_ctx: Optional["DistributedContext"] = None
+) -> "TrainingArguments":
     """
     Create HuggingFace TrainingArguments
 
     Args:
         training_config: Training configuration
         experiment_config: Experiment configuration
+        data_config: Data configuration
+        dist_ctx: Distributed context (None = single process)
 
     Returns:
         TrainingArguments instance
     """
+    from transformers import TrainingArguments
+
+    from distributed import DistributedContext
+
     # Generate run name if not provided
     run_name = experiment_config.run_name
     if run_name is None:
         run_name = f"{experiment_config.experiment_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
 
+    # Streams fast-forward themselves on resume (see MixedStreamDataset)
+    streaming = data_config is not None and data_config.streaming
+    data_config = data_config or DataConfig()
+    num_workers = data_config.num_workers
+
+    dist_ctx = dist_ctx or DistributedContext()
+
     return TrainingArguments(
         output_dir=experiment_config.output_dir,
         run_name=run_name,
 
         # Training regime
         num_train_epochs=training_config.num_epochs,
+        max_steps=training_config.max_steps,
         per_device_train_batch_size=training_config.per_device_train_batch_size,
         per_device_eval_batch_size=training_config.per_device_eval_batch_size,
         gradient_accumulation_steps=training_config.gradient_accumulation_steps,
@@ -255,9 +646,25 @@ def setup_training_args(
 
         # Memory optimization
         gradient_checkpointing=training_config.gradient_checkpointing,
+        gradient_checkpointing_kwargs={"use_reentrant": False} if dist_ctx.is_distributed else None,
+
+        # Devices / data parallelism
+        use_cpu=dist_ctx.use_cpu,
+        ddp_backend=dist_ctx.backend,
+        ddp_find_unused_parameters=False if dist_ctx.is_distributed else None,
+
+        # Token budget (PlateauStoppingCallback)
+        include_num_input_tokens_seen=training_config.max_train_tokens is not None,
+
+        # Data loading (pinned memory only helps host-to-GPU copies)
+        dataloader_num_workers=num_workers,
+        dataloader_pin_memory=data_config.pin_memory and not dist_ctx.use_cpu,
+        dataloader_prefetch_factor=data_config.prefetch_factor if num_workers > 0 else None,
+        dataloader_persistent_workers=data_config.persistent_workers and num_workers > 0,
 
         # Reproducibility
         seed=experiment_config.seed,
+        ignore_data_skip=streaming,
 
         # Disable features we don't need
         push_to_hub=False,
@@ -265,104 +672,558 @@ def setup_training_args(
     )
 
 
-def train(
-    stage: str = "stage1",
-    experiment_type: str = "control"
-):
+def resolve_resume_checkpoint(spec: str, output_dir: str) -> Optional[str]:
     """
-    Run training
+    Resolve a --resume-from-checkpoint value
+
+    Only checkpoints with optimizer state are resume points. The Trainer
+    would load an async adapter-only checkpoint without complaint, but
+    with fresh Adam moments, a restarted LR schedule and unseeded RNG.
 
     Args:
-        stage: "stage1" or "stage4"
-        experiment_type: "control" or "experiment"
+        spec: Checkpoint directory, or "latest"
+        output_dir: Run output directory searched for "latest"
+
+    Returns:
+        Checkpoint directory, or None to start fresh (no checkpoint yet)
+
+    Raises:
+        FileNotFoundError: The checkpoint directory does not exist
+        ValueError: The checkpoint (or every checkpoint, for "latest") has
+            no optimizer state
     """
-    print("=" * 60)
-    print("🚀 HUMANEVAL QLORA TRAINING")
-    print("=" * 60)
-    print(f"   Stage: {stage}")
-    print(f"   Experiment: {experiment_type}")
-    print()
+    from trainer import is_full_checkpoint
+
+    if spec != "latest":
+        if not Path(spec).is_dir():
+            raise FileNotFoundError(f"Checkpoint not found: {spec}")
+        if not is_full_checkpoint(spec):
+            raise ValueError(
+                f"{spec} is not a full checkpoint (adapter only, or incomplete): "
+                f"resume from one with optimizer.pt and trainer_state.json"
+            )
+        return spec
+
+    # trainer_state.json is written last, so a checkpoint without it is incomplete
+    checkpoints = sorted(
+        (
+            path for path in Path(output_dir).glob("checkpoint-*")
+            if path.name.split("-")[-1].isdigit() and (path / "trainer_state.json").exists()
+        ),
+        key=lambda path: int(path.name.split("-")[-1])
+    ) if Path(output_dir).is_dir() else []
+    if not checkpoints:
+        print(f"   No checkpoint in {output_dir}, starting fresh")
+        return None
+
+    full = [path for path in checkpoints if is_full_checkpoint(str(path))]
+    if not full:
+        raise ValueError(
+            f"No checkpoint in {output_dir} has optimizer state ({len(checkpoints)} adapter-only); "
+            f"remove them to start fresh"
+        )
+
+    latest = full[-1]
+    skipped = len(checkpoints) - checkpoints.index(latest) - 1
+    if skipped:
+        print(f"   Skipping {skipped} newer adapter-only checkpoint(s)")
+    print(f"   Resuming from {latest}")
+    return str(latest)
+
+
+def prepare_run_config(
+    stage: str,
+    experiment_type: str,
+    dist_ctx: "DistributedContext",
+    train_sources: Optional[List[str]] = None,
+    max_steps: Optional[int] = None,
+    model_cache_dir: Optional[str] = None,
+    profile_steps: Optional[str] = None,
+    checkpoint_mode: Optional[str] = None,
+    resume_from_checkpoint: Optional[str] = None,
+    auto_tune: bool = False,
+    torch_compile: bool = False,
+    export_merged: bool = False,
+    metadata_special_tokens: bool = False,
+    metrics_stream_port: Optional[int] = None,
+    probe_steps: Optional[int] = None
+):
+    """
+    Load the stage configuration and apply command-line overrides
 
-    # Validate GPU
-    print("🔍 Validating GPU...")
-    if not validate_gpu():
-        print("❌ GPU validation failed. Aborting.")
-        sys.exit(1)
-    print()
+    Args:
+        stage: "smoke", "stage1" or "stage4"
+        experiment_type: "control" or "experiment"
+        dist_ctx: Distributed context
+        train_sources: "path[:weight]" specs to stream and mix (enables streaming)
+        max_steps: Override number of optimizer steps
+        model_cache_dir: Prepared base-model cache directory
+        profile_steps: "START-END" optimizer steps to profile
+        checkpoint_mode: "full" or "async_adapter" (None = stage default)
+        resume_from_checkpoint: Checkpoint dir, or "latest" for the newest
+            complete checkpoint in the output dir
+        auto_tune: Probe the device for micro-batch, accumulation and precision
+        torch_compile: Compile the model forward with torch.compile
+        export_merged: Merge the final adapter into the base model and save it
+        metadata_special_tokens: Add the metadata header tags to the tokenizer
+        metrics_stream_port: Serve live metrics as SSE on this port (None = off)
+        probe_steps: Greedy pass@1 probe on a val subset every N steps
 
-    # Load configuration
-    print(f"⚙️  Loading configuration for {stage}...")
-    if stage == "stage1":
-        model_config, training_config, data_config, experiment_config = get_stage1_config()
-    elif stage == "stage4":
-        model_config, training_config, data_config, experiment_config = get_stage4_config(experiment_type)
-    else:
-        raise ValueError(f"Unknown stage: {stage}")
+    Returns:
+        Tuple of (model_config, training_config, data_config, experiment_config)
+    """
+    from streaming_dataset import StreamSource
+    from smoke import write_smoke_datasets
+
+    print(f"⚙️  Loading configuration for {stage} ({experiment_type})...")
+    model_config, training_config, data_config, experiment_config = get_stage_config(stage, experiment_type)
+
+    # Apply command-line overrides
+    if max_steps is not None:
+        training_config.max_steps = max_steps
+    if model_cache_dir:
+        model_config.prepared_cache_dir = model_cache_dir
+    if profile_steps:
+        training_config.profile_steps = profile_steps
+    if checkpoint_mode:
+        training_config.checkpoint_mode = checkpoint_mode
+    if auto_tune:
+        training_config.auto_tune = True
+    if torch_compile:
+        training_config.torch_compile = True
+    if export_merged:
+        experiment_config.export_merged = True
+    if metadata_special_tokens:
+        data_config.metadata_special_tokens = True
+    if metrics_stream_port is not None:
+        training_config.metrics_stream_port = metrics_stream_port
+    if probe_steps is not None:
+        training_config.probe_steps = probe_steps
+    if train_sources:
+        include_metadata = (experiment_type == "experiment")
+        data_config.streaming = True
+        data_config.train_sources = [
+            StreamSource.parse(spec, include_metadata=include_metadata)
+            for spec in train_sources
+        ]
+
+    if metadata_tokens(data_config, experiment_type) and not model_config.lora_modules_to_save:
+        # New token rows are only learned if the embeddings train too
+        model_config.lora_modules_to_save = ["embed_tokens", "lm_head"]
+
+    if dist_ctx.use_cpu:
+        apply_cpu_overrides(model_config, training_config)
+
+    if model_config.smoke_test:
+        smoke_files = write_smoke_datasets(str(Path(experiment_config.output_dir).parent / "data"))
+        data_config.train_file = smoke_files["train_file"]
+        data_config.val_file = smoke_files["val_file"]
+        data_config.test_file = smoke_files["test_file"]
+
+    if resume_from_checkpoint:
+        experiment_config.resume_from_checkpoint = resolve_resume_checkpoint(
+            resume_from_checkpoint, experiment_config.output_dir
+        )
 
     # Update experiment name
     experiment_config.experiment_name = f"{stage}-{experiment_type}"
     print(f"   Experiment: {experiment_config.experiment_name}")
     print()
 
-    # Setup tokenizer
-    tokenizer = setup_tokenizer(model_config)
-    print()
+    return model_config, training_config, data_config, experiment_config
 
-    # Setup model
-    model = setup_model(model_config)
-    print()
+
+def build_trainer(
+    model,
+    tokenizer,
+    experiment_type: str,
+    model_config: ModelConfig,
+    training_config: TrainingConfig,
+    data_config: DataConfig,
+    experiment_config: ExperimentConfig,
+    dist_ctx: "DistributedContext",
+    adapter_name: Optional[str] = None
+):
+    """
+    Load datasets and create the Trainer for one adapter
+
+    Args:
+        model: PEFT model
+        tokenizer: Tokenizer
+        experiment_type: "control" or "experiment"
+        model_config: Model configuration
+        training_config: Training configuration
+        data_config: Data configuration
+        experiment_config: Experiment configuration
+        dist_ctx: Distributed context
+        adapter_name: Named adapter to train and save (None = default adapter)
+
+    Returns:
+        HumanEvalTrainer instance
+    """
+    from dataset import collate_batch
+    from streaming_dataset import MixedStreamDataset, StreamStateCallback
+    from trainer import HumanEvalTrainer
 
     # Load datasets
     train_dataset, val_dataset = setup_datasets(
-        data_config, tokenizer, model_config, experiment_type
+        data_config, tokenizer, model_config, experiment_type,
+        training_config, experiment_config
     )
     print()
 
     # Setup training arguments
     print("⚙️  Configuring trainer...")
-    training_args = setup_training_args(training_config, experiment_config)
+    training_args = setup_training_args(
+        training_config, experiment_config, data_config, dist_ctx
+    )
     print(f"   Output dir: {experiment_config.output_dir}")
-    print(f"   Epochs: {training_config.num_epochs}")
+    if training_config.max_steps > 0:
+        print(f"   Max steps: {training_config.max_steps}")
+    else:
+        print(f"   Epochs: {training_config.num_epochs}")
     print(f"   Batch size: {training_config.per_device_train_batch_size}")
     print(f"   Gradient accumulation: {training_config.gradient_accumulation_steps}")
-    print(f"   Effective batch size: {training_config.per_device_train_batch_size * training_config.gradient_accumulation_steps}")
+    print(f"   Processes: {dist_ctx.world_size}")
+    print(f"   Dataloader workers: {training_args.dataloader_num_workers}"
+          + (f" (prefetch {training_args.dataloader_prefetch_factor}/worker)" if training_args.dataloader_num_workers else "")
+          + (", pinned memory" if training_args.dataloader_pin_memory else ""))
+    print(f"   Effective batch size: {training_config.per_device_train_batch_size * training_config.gradient_accumulation_steps * dist_ctx.world_size}")
     print()
 
+    if training_config.torch_compile:
+        from compilation import compile_for_training
+
+        compile_for_training(model, model_config, training_config, dist_ctx)
+
+    # Checkpoint the stream position together with the model
+    callbacks = []
+    if isinstance(train_dataset, MixedStreamDataset):
+        callbacks.append(StreamStateCallback(train_dataset))
+
+    # Throughput and memory metrics per logging step
+    if training_config.throughput_metrics:
+        from callbacks import ThroughputCallback
+
+        callbacks.append(ThroughputCallback(dist_ctx))
+
+    # torch.profiler window (no callback at all unless requested)
+    if training_config.profile_steps:
+        from callbacks import ProfilerCallback, parse_step_range
+
+        start_step, end_step = parse_step_range(training_config.profile_steps)
+        callbacks.append(ProfilerCallback(start_step, end_step))
+        print(f"🔬 Profiling steps {start_step}-{end_step} -> {experiment_config.logging_dir}/profile")
+        print()
+
+    # Checkpoint the current step on SIGTERM/SIGINT (spot/preemptible machines)
+    if training_config.preemption_checkpoint:
+        from callbacks import PreemptionCallback
+
+        callbacks.append(PreemptionCallback())
+
+    # Favor high-loss samples; losses come from the training forward
+    train_sampler = None
+    if training_config.loss_aware_sampling:
+        if isinstance(train_dataset, MixedStreamDataset):
+            print("⚠️  Loss-aware sampling needs a map-style dataset; the stream keeps its mix")
+        else:
+            from sampling import LossAwareSampler, LossAwareSamplingCallback, dataset_task_ids
+
+            train_sampler = LossAwareSampler(
+                dataset_task_ids(train_dataset),
+                floor=training_config.loss_sampling_floor,
+                temperature=training_config.loss_sampling_temperature,
+                ema=training_config.loss_sampling_ema,
+                seed=experiment_config.seed,
+                device=dist_ctx.device
+            )
+            print(f"🎯 Loss-aware sampling: floor={training_config.loss_sampling_floor}, "
+                  f"temperature={training_config.loss_sampling_temperature}, "
+                  f"ema={training_config.loss_sampling_ema}")
+            if experiment_config.resume_from_checkpoint:
+                train_sampler.load_state(experiment_config.resume_from_checkpoint)
+            callbacks.append(LossAwareSamplingCallback(train_sampler))
+        print()
+
+    if training_config.target_eval_loss is not None:
+        from callbacks import TargetLossCallback
+
+        callbacks.append(TargetLossCallback(
+            training_config.target_eval_loss,
+            sampling="loss_aware" if train_sampler is not None else "uniform"
+        ))
+
+    # Stop on eval plateaus and per-stage budgets
+    budgeted = training_config.max_train_minutes is not None or training_config.max_train_tokens is not None
+    if training_config.early_stopping or budgeted:
+        from callbacks import PlateauStoppingCallback
+
+        callbacks.append(PlateauStoppingCallback(
+            patience=training_config.early_stopping_patience,
+            min_delta=training_config.early_stopping_min_delta,
+            max_minutes=training_config.max_train_minutes,
+            max_tokens=training_config.max_train_tokens,
+            metric=training_config.metric_for_best_model,
+            greater_is_better=training_config.greater_is_better,
+            plateau=training_config.early_stopping
+        ))
+        print(f"⏹️  Early stopping: patience={training_config.early_stopping_patience}, "
+              f"min_delta={training_config.early_stopping_min_delta}, "
+              f"time budget={training_config.max_train_minutes or '-'} min, "
+              f"token budget={training_config.max_train_tokens or '-'}")
+        print()
+
+    # Greedy pass@1 on a fixed val subset; the tests run in a background process pool
+    if training_config.probe_steps > 0:
+        from callbacks import PassAtOneProbeCallback
+        from probe import select_probe_samples
+
+        probe_samples = select_probe_samples(data_config.val_file, training_config.probe_samples)
+        callbacks.append(PassAtOneProbeCallback(
+            probe_samples, tokenizer, training_config.probe_steps,
+            batch_size=training_config.probe_batch_size,
+            max_new_tokens=training_config.probe_max_new_tokens,
+            timeout=training_config.probe_timeout,
+            workers=training_config.probe_workers,
+            patience=training_config.probe_patience
+        ))
+        print(f"🧪 pass@1 probe: {len(probe_samples)} val samples every {training_config.probe_steps} steps"
+              + (f", patience {training_config.probe_patience}" if training_config.probe_patience else ""))
+        print()
+
+    # Live metrics for the dashboard (last, so it sees fields other callbacks add to logs)
+    if training_config.metrics_stream_port is not None and dist_ctx.is_main_process:
+        from metrics_stream import MetricsStreamCallback, get_metrics_stream
+
+        stream = get_metrics_stream(
+            training_config.metrics_stream_host,
+            training_config.metrics_stream_port,
+            training_config.metrics_stream_queue
+        )
+        callbacks.append(MetricsStreamCallback(stream, experiment_config.run_name or experiment_type))
+        print()
+
     # Create trainer
-    trainer = Trainer(
+    return HumanEvalTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
-        tokenizer=tokenizer
+        tokenizer=tokenizer,
+        data_collator=collate_batch,
+        callbacks=callbacks,
+        adapter_name=adapter_name,
+        async_checkpoints=training_config.checkpoint_mode == "async_adapter",
+        optimizer_save_interval=training_config.optimizer_save_interval,
+        train_sampler=train_sampler
     )
 
+
+def run_trainer(
+    trainer,
+    tokenizer,
+    experiment_config: ExperimentConfig,
+    dist_ctx: "DistributedContext"
+) -> Path:
+    """
+    Train and save the final adapter
+
+    Args:
+        trainer: Trainer from build_trainer
+        tokenizer: Tokenizer (saved next to the adapter)
+        experiment_config: Experiment configuration
+        dist_ctx: Distributed context
+
+    Returns:
+        Final model path, or None if training was preempted
+    """
+    from distributed import barrier
+
     # Train!
     print("=" * 60)
-    print("🏋️  STARTING TRAINING")
+    print(f"🏋️  STARTING TRAINING: {experiment_config.experiment_name}")
     print("=" * 60)
     print()
 
-    try:
-        trainer.train(resume_from_checkpoint=experiment_config.resume_from_checkpoint)
+    trainer.train(resume_from_checkpoint=experiment_config.resume_from_checkpoint)
 
+    if trainer.preemption_requested():
+        # Not finished: leave final_model alone and resume from the checkpoint
         print()
-        print("=" * 60)
-        print("✅ TRAINING COMPLETE!")
-        print("=" * 60)
-        print()
+        print("⚠️  Training preempted")
+        print(f"   Resume with: --resume-from-checkpoint latest (output dir {experiment_config.output_dir})")
+        return None
 
-        # Save final model
-        final_model_path = Path(experiment_config.output_dir) / "final_model"
-        print(f"💾 Saving final model to {final_model_path}...")
-        trainer.save_model(str(final_model_path))
+    print()
+    print("=" * 60)
+    print("✅ TRAINING COMPLETE!")
+    print("=" * 60)
+    print()
+
+    # Save final model (Trainer only writes on rank 0)
+    final_model_path = Path(experiment_config.output_dir) / "final_model"
+    print(f"💾 Saving final model to {final_model_path}...")
+    trainer.save_model(str(final_model_path))
+    if dist_ctx.is_main_process:
         tokenizer.save_pretrained(str(final_model_path))
+    barrier(dist_ctx)
 
+    print()
+    print("✅ Model saved successfully!")
+    print()
+    print(f"📊 View training logs:")
+    print(f"   tensorboard --logdir {experiment_config.logging_dir}")
+
+    return final_model_path
+
+
+def start_run(stage: str, distributed_config: Optional[DistributedConfig] = None) -> "DistributedContext":
+    """
+    Join the process group (when launched by torchrun) and validate devices
+
+    Args:
+        stage: Training stage (smoke always runs on CPU)
+        distributed_config: Device / data-parallel settings
+
+    Returns:
+        DistributedContext
+    """
+    from distributed import init_distributed, configure_cpu_threads
+
+    distributed_config = distributed_config or DistributedConfig()
+    if stage == "smoke":
+        distributed_config.use_cpu = True
+    dist_ctx = init_distributed(
+        backend=distributed_config.backend,
+        use_cpu=distributed_config.use_cpu,
+        timeout_minutes=distributed_config.timeout_minutes
+    )
+
+    # Validate GPU
+    if not dist_ctx.use_cpu:
+        print("🔍 Validating GPU...")
+        if not validate_gpu():
+            print("❌ GPU validation failed. Aborting.")
+            sys.exit(1)
         print()
-        print("✅ Model saved successfully!")
-        print()
-        print(f"📊 View training logs:")
-        print(f"   tensorboard --logdir {experiment_config.logging_dir}")
+    else:
+        configure_cpu_threads(dist_ctx)
+
+    return dist_ctx
+
+
+def save_smoke_base(base_model, tokenizer, experiment_config: ExperimentConfig):
+    """Smoke runs have no hub model: keep the base next to the adapter for the evaluator"""
+    smoke_base_path = Path(experiment_config.output_dir) / "smoke_base"
+    # LoRA layers are injected in place: drop adapter weights, restore base names
+    state_dict = {
+        key.replace(".base_layer", "").replace(".original_module", ""): value
+        for key, value in base_model.state_dict().items()
+        if "lora_" not in key and ".modules_to_save." not in key
+    }
+    base_model.save_pretrained(str(smoke_base_path), state_dict=state_dict)
+    tokenizer.save_pretrained(str(smoke_base_path))
+
+
+def check_smoke_budget(start_time: float):
+    """Fail smoke runs that exceed their wall-clock budget"""
+    from smoke import SMOKE_TIME_BUDGET_SECONDS
+
+    elapsed = time.perf_counter() - start_time
+    print()
+    print(f"⏱️  Smoke run: {elapsed:.1f}s (budget {SMOKE_TIME_BUDGET_SECONDS}s)")
+    if elapsed > SMOKE_TIME_BUDGET_SECONDS:
+        print("❌ Smoke run exceeded its time budget")
+        sys.exit(1)
+
+
+def train(
+    stage: str = "stage1",
+    experiment_type: str = "control",
+    train_sources: Optional[List[str]] = None,
+    max_steps: Optional[int] = None,
+    distributed_config: Optional[DistributedConfig] = None,
+    model_cache_dir: Optional[str] = None,
+    profile_steps: Optional[str] = None,
+    checkpoint_mode: Optional[str] = None,
+    resume_from_checkpoint: Optional[str] = None,
+    auto_tune: bool = False,
+    torch_compile: bool = False,
+    export_merged: bool = False,
+    metadata_special_tokens: bool = False,
+    metrics_stream_port: Optional[int] = None,
+    probe_steps: Optional[int] = None
+):
+    """
+    Run training
+
+    Args:
+        stage: "smoke", "stage1" or "stage4"
+        experiment_type: "control" or "experiment"
+        train_sources: "path[:weight]" specs to stream and mix (enables streaming)
+        max_steps: Override number of optimizer steps
+        distributed_config: Device / data-parallel settings (torchrun launch)
+        model_cache_dir: Prepared base-model cache directory (None = no cache)
+        profile_steps: "START-END" optimizer steps to profile (None = off)
+        checkpoint_mode: "full" or "async_adapter" (None = stage default)
+        resume_from_checkpoint: Checkpoint dir, or "latest" for the newest
+            complete checkpoint in the output dir
+        auto_tune: Probe the device for micro-batch, accumulation and precision
+        torch_compile: Compile the model forward with torch.compile
+        export_merged: Merge the final adapter into the base model and save it
+        metadata_special_tokens: Add the metadata header tags to the tokenizer
+        metrics_stream_port: Serve live metrics as SSE on this port (None = off)
+        probe_steps: Greedy pass@1 probe on a val subset every N steps
+    """
+    from distributed import cleanup_distributed
+
+    print("=" * 60)
+    print("🚀 HUMANEVAL QLORA TRAINING")
+    print("=" * 60)
+    print(f"   Stage: {stage}")
+    print(f"   Experiment: {experiment_type}")
+    print()
+
+    start_time = time.perf_counter()
+    dist_ctx = start_run(stage, distributed_config)
+
+    model_config, training_config, data_config, experiment_config = prepare_run_config(
+        stage, experiment_type, dist_ctx, train_sources, max_steps, model_cache_dir,
+        profile_steps, checkpoint_mode, resume_from_checkpoint, auto_tune, torch_compile,
+        export_merged, metadata_special_tokens, metrics_stream_port, probe_steps
+    )
+
+    # Setup tokenizer
+    tokenizer = setup_tokenizer(model_config, metadata_tokens(data_config, experiment_type))
+    print()
+
+    # Setup model
+    model = setup_model(model_config, dist_ctx, tokenizer)
+    print()
+
+    if training_config.auto_tune:
+        from autotune import tune_run
+
+        tune_run(model, (model_config, training_config, data_config, experiment_config), dist_ctx)
+
+    if model_config.smoke_test and dist_ctx.is_main_process:
+        save_smoke_base(model.get_base_model(), tokenizer, experiment_config)
+
+    trainer = build_trainer(
+        model, tokenizer, experiment_type,
+        model_config, training_config, data_config, experiment_config, dist_ctx
+    )
+
+    final_model_path = None
+    try:
+        final_model_path = run_trainer(trainer, tokenizer, experiment_config, dist_ctx)
+        if final_model_path is None:
+            sys.exit(PREEMPTED_EXIT_CODE)
+
+        # Compile time is not part of the smoke budget
+        if model_config.smoke_test and not training_config.torch_compile:
+            check_smoke_budget(start_time)
 
     except KeyboardInterrupt:
         print()
@@ -376,6 +1237,189 @@ def train(
         print(f"❌ Training failed: {e}")
         raise
 
+    finally:
+        cleanup_distributed()
+
+    if final_model_path is not None and experiment_config.export_merged and dist_ctx.is_main_process:
+        # Free the training copy before loading the base for merging
+        del trainer, model
+        export_final_models([(final_model_path, model_config, experiment_config)])
+
+
+def export_final_models(exports: list):
+    """
+    Merge trained adapters into their base model (see export.py)
+
+    Args:
+        exports: (final_model_path, model_config, experiment_config) tuples
+    """
+    import gc
+
+    import torch
+
+    from export import export_run
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    print()
+    for final_model_path, model_config, experiment_config in exports:
+        export_run(str(final_model_path), model_config, experiment_config)
+
+
+def train_paired(
+    stage: str = "stage1",
+    train_sources: Optional[List[str]] = None,
+    max_steps: Optional[int] = None,
+    distributed_config: Optional[DistributedConfig] = None,
+    model_cache_dir: Optional[str] = None,
+    profile_steps: Optional[str] = None,
+    checkpoint_mode: Optional[str] = None,
+    resume_from_checkpoint: Optional[str] = None,
+    auto_tune: bool = False,
+    torch_compile: bool = False,
+    export_merged: bool = False,
+    metadata_special_tokens: bool = False,
+    metrics_stream_port: Optional[int] = None,
+    probe_steps: Optional[int] = None
+):
+    """
+    Train the control and experiment adapters over one shared base model
+
+    The frozen base is loaded (and quantized) once. Each experiment type
+    gets its own named LoRA adapter, dataset, optimizer and output dir,
+    and the adapters are trained one after another. A finished adapter is
+    deleted from the model once saved, so only one set of adapter weights
+    and optimizer state is resident at a time.
+
+    Args:
+        stage: "smoke", "stage1" or "stage4"
+        train_sources: "path[:weight]" specs to stream and mix (enables streaming)
+        max_steps: Override number of optimizer steps
+        distributed_config: Device / data-parallel settings (torchrun launch)
+        model_cache_dir: Prepared base-model cache directory (None = no cache)
+        profile_steps: "START-END" optimizer steps to profile (None = off)
+        checkpoint_mode: "full" or "async_adapter" (None = stage default)
+        resume_from_checkpoint: Checkpoint dir, or "latest" for the newest
+            complete checkpoint in the output dir
+        auto_tune: Probe the device for micro-batch, accumulation and precision
+        torch_compile: Compile the model forward with torch.compile
+        export_merged: Merge the final adapter into the base model and save it
+        metadata_special_tokens: Add the metadata header tags to the tokenizer
+        metrics_stream_port: Serve live metrics as SSE on this port (None = off)
+        probe_steps: Greedy pass@1 probe on a val subset every N steps
+    """
+    import gc
+
+    from peft import PeftModel
+
+    from distributed import cleanup_distributed
+
+    print("=" * 60)
+    print("🚀 HUMANEVAL QLORA TRAINING (PAIRED)")
+    print("=" * 60)
+    print(f"   Stage: {stage}")
+    print(f"   Adapters: {', '.join(PAIRED_EXPERIMENT_TYPES)}")
+    print()
+
+    start_time = time.perf_counter()
+    dist_ctx = start_run(stage, distributed_config)
+
+    run_configs = {
+        experiment_type: prepare_run_config(
+            stage, experiment_type, dist_ctx, train_sources, max_steps, model_cache_dir,
+            profile_steps, checkpoint_mode, resume_from_checkpoint, auto_tune, torch_compile,
+            export_merged, metadata_special_tokens, metrics_stream_port, probe_steps
+        )
+        for experiment_type in PAIRED_EXPERIMENT_TYPES
+    }
+
+    # Both adapters must sit on the same base model
+    base_config = run_configs[PAIRED_EXPERIMENT_TYPES[0]][0]
+    for experiment_type, (model_config, _, _, _) in run_configs.items():
+        if (model_config.model_name, model_config.tokenizer_name, model_config.load_in_4bit) != \
+                (base_config.model_name, base_config.tokenizer_name, base_config.load_in_4bit):
+            raise ValueError(f"Paired training needs one base model; {experiment_type} config differs")
+
+    # Control keeps the base vocabulary; the model is sized for the larger one
+    tokenizers = {}
+    for experiment_type, (_, _, data_config, _) in run_configs.items():
+        tokenizers[experiment_type] = setup_tokenizer(base_config, metadata_tokens(data_config, experiment_type))
+        print()
+
+    model = load_base_model(base_config, dist_ctx, max(tokenizers.values(), key=len))
+    print()
+
+    if base_config.smoke_test and dist_ctx.is_main_process:
+        for experiment_type, (_, _, _, experiment_config) in run_configs.items():
+            save_smoke_base(model, tokenizers[experiment_type], experiment_config)
+
+    tuned = None
+    final_model_paths = {}
+    try:
+        for experiment_type in PAIRED_EXPERIMENT_TYPES:
+            model_config, training_config, data_config, experiment_config = run_configs[experiment_type]
+
+            previous_adapter = model.active_adapter if isinstance(model, PeftModel) else None
+            model = apply_lora(model, model_config, adapter_name=experiment_type)
+            if previous_adapter is not None:
+                # Saved already; free its weights before training the next one
+                model.base_model.delete_adapter(previous_adapter)
+            print()
+
+            if training_config.auto_tune:
+                from autotune import tune_run
+
+                # Same base model and device: tune once, apply to both adapters
+                tuned = tune_run(model, run_configs[experiment_type], dist_ctx, result=tuned)
+
+            trainer = build_trainer(
+                model, tokenizers[experiment_type], experiment_type,
+                model_config, training_config, data_config, experiment_config, dist_ctx,
+                adapter_name=experiment_type
+            )
+            final_model_path = run_trainer(trainer, tokenizers[experiment_type], experiment_config, dist_ctx)
+            if final_model_path is None:
+                # Finished adapters resume instantly from their last checkpoint
+                sys.exit(PREEMPTED_EXIT_CODE)
+            final_model_paths[experiment_type] = final_model_path
+            print()
+
+            # Drop the optimizer state before the next adapter
+            del trainer
+            gc.collect()
+
+        elapsed = time.perf_counter() - start_time
+        print(f"⏱️  Paired run: {elapsed:.1f}s")
+        for experiment_type in PAIRED_EXPERIMENT_TYPES:
+            print(f"   {experiment_type}: {run_configs[experiment_type][3].output_dir}/final_model")
+
+        if base_config.smoke_test and not training_config.torch_compile:
+            check_smoke_budget(start_time)
+
+    except KeyboardInterrupt:
+        print()
+        print("⚠️  Training interrupted by user")
+        print("   Checkpoints are in each adapter's output dir")
+
+    except Exception as e:
+        print()
+        print(f"❌ Training failed: {e}")
+        raise
+
+    finally:
+        cleanup_distributed()
+
+    exports = []
+    for experiment_type, final_model_path in final_model_paths.items():
+        model_config, _, _, experiment_config = run_configs[experiment_type]
+        if experiment_config.export_merged:
+            exports.append((final_model_path, model_config, experiment_config))
+    if exports and dist_ctx.is_main_process:
+        del model
+        export_final_models(exports)
+
 
 def main():
     """Parse arguments and run training"""
@@ -385,21 +1429,175 @@ def main():
         "--stage",
         type=str,
         default="stage1",
-        choices=["stage1", "stage4"],
-        help="Training stage (stage1=5 samples, stage4=164 samples)"
+        choices=["smoke", "stage1", "stage4"],
+        help="Training stage (smoke=tiny CPU model, stage1=5 samples, stage4=164 samples)"
     )
 
     parser.add_argument(
         "--experiment-type",
         type=str,
         default="control",
-        choices=["control", "experiment"],
-        help="Experiment type (control=no metadata, experiment=with metadata)"
+        choices=["control", "experiment", "paired"],
+        help="Experiment type (control=no metadata, experiment=with metadata, "
+             "paired=both adapters over one shared base model)"
+    )
+
+    parser.add_argument(
+        "--train-source",
+        type=str,
+        action="append",
+        dest="train_sources",
+        metavar="PATH[:WEIGHT]",
+        help="Stream and mix this JSONL source (repeatable, requires --max-steps)"
+    )
+
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=None,
+        help="Number of optimizer steps (overrides epochs)"
+    )
+
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Train on CPU (gloo backend when launched with torchrun)"
+    )
+
+    parser.add_argument(
+        "--ddp-backend",
+        type=str,
+        default=None,
+        choices=["gloo", "nccl"],
+        help="torch.distributed backend (default: nccl on GPU, gloo on CPU)"
+    )
+
+    parser.add_argument(
+        "--model-cache",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Cache the prepared (quantized) base model here and reuse it on later runs"
+    )
+
+    parser.add_argument(
+        "--profile-steps",
+        type=str,
+        default=None,
+        metavar="START-END",
+        help="Profile these optimizer steps with torch.profiler (Chrome trace + op tables in logging_dir/profile)"
+    )
+
+    parser.add_argument(
+        "--resume-from-checkpoint",
+        type=str,
+        default=None,
+        metavar="PATH|latest",
+        help="Resume from a checkpoint dir, or the newest complete one in the output dir "
+             "(paired runs: latest only)"
+    )
+
+    parser.add_argument(
+        "--checkpoint-mode",
+        type=str,
+        default=None,
+        choices=["full", "async_adapter"],
+        help="full=synchronous Trainer checkpoints, async_adapter=adapter-only "
+             "checkpoints written in the background (default: stage setting)"
+    )
+
+    parser.add_argument(
+        "--auto-tune",
+        action="store_true",
+        help="Probe the device for the largest micro-batch and fastest precision, keep the "
+             "effective batch via accumulation, and write run_config.json to the output dir"
+    )
+
+    parser.add_argument(
+        "--torch-compile",
+        action="store_true",
+        help="Compile the model forward with torch.compile; falls back to eager if unsupported "
+             "or not faster (prints compile time vs step speedup)"
+    )
+
+    parser.add_argument(
+        "--export-merged",
+        action="store_true",
+        help="After training, merge the adapter into the base model and save it as a standalone "
+             "safetensors checkpoint (<output_dir>/merged-float16; more variants via export.py)"
+    )
+
+    parser.add_argument(
+        "--metadata-tokens",
+        action="store_true",
+        help="Experiment runs: add the metadata header tags to the tokenizer as single tokens "
+             "(resizes the embeddings and trains embed_tokens/lm_head with the adapter)"
+    )
+
+    parser.add_argument(
+        "--metrics-stream",
+        type=int,
+        default=None,
+        metavar="PORT",
+        help="Serve live step metrics as Server-Sent Events on this port (GET /events?runs=control,experiment); "
+             "a second run on the same host relays to the first"
+    )
+
+    parser.add_argument(
+        "--probe-steps",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Every N steps, greedy pass@1 on a fixed val subset; tests run in a background "
+             "process pool (training.probe_patience stops runs that stop improving)"
     )
 
     args = parser.parse_args()
 
-    train(stage=args.stage, experiment_type=args.experiment_type)
+    if args.experiment_type == "paired" and args.resume_from_checkpoint not in (None, "latest"):
+        parser.error("paired runs have one checkpoint dir per adapter: use --resume-from-checkpoint latest")
+
+    distributed_config = DistributedConfig(
+        backend=args.ddp_backend,
+        use_cpu=args.cpu
+    )
+
+    if args.experiment_type == "paired":
+        train_paired(
+            stage=args.stage,
+            train_sources=args.train_sources,
+            max_steps=args.max_steps,
+            distributed_config=distributed_config,
+            model_cache_dir=args.model_cache,
+            profile_steps=args.profile_steps,
+            checkpoint_mode=args.checkpoint_mode,
+            resume_from_checkpoint=args.resume_from_checkpoint,
+            auto_tune=args.auto_tune,
+            torch_compile=args.torch_compile,
+            export_merged=args.export_merged,
+            metadata_special_tokens=args.metadata_tokens,
+            metrics_stream_port=args.metrics_stream,
+            probe_steps=args.probe_steps
+        )
+        return
+
+    train(
+        stage=args.stage,
+        experiment_type=args.experiment_type,
+        train_sources=args.train_sources,
+        max_steps=args.max_steps,
+        distributed_config=distributed_config,
+        model_cache_dir=args.model_cache,
+        profile_steps=args.profile_steps,
+        checkpoint_mode=args.checkpoint_mode,
+        resume_from_checkpoint=args.resume_from_checkpoint,
+        auto_tune=args.auto_tune,
+        torch_compile=args.torch_compile,
+        export_merged=args.export_merged,
+        metadata_special_tokens=args.metadata_tokens,
+        metrics_stream_port=args.metrics_stream,
+        probe_steps=args.probe_steps
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,427 @@
+"""
+HumanEval Trainer
+
+Thin HuggingFace Trainer subclass for our datasets:
+- Strips non-model fields (task_id) before the forward pass
+- Optionally draws training samples with a LossAwareSampler, fed with
+  per-sample losses from the training forward (see sampling.py)
+- Feeds rank-sharded streaming datasets to a plain DataLoader, so
+  accelerate does not shard (or dispatch) them a second time
+- Saves one named adapter as a standalone adapter dir when several
+  adapters share a base model (paired training)
+- Resumes from checkpoints under torch >= 2.6 (weights_only torch.load),
+  including CPU data-parallel runs
+- Optionally writes adapter-only checkpoints on a background thread
+  (checkpoint_mode="async_adapter"), so training does not stall on disk
+- Writes a full-state checkpoint when preempted (see PreemptionCallback)
+"""
+
+import contextlib
+import dataclasses
+import json
+import os
+import random
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import Trainer
+from transformers.trainer import (
+    OPTIMIZER_NAME,
+    SCHEDULER_NAME,
+    TRAINER_STATE_NAME,
+    TRAINING_ARGS_NAME
+)
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+
+# Batch fields that are bookkeeping only and never reach the model
+NON_MODEL_FIELDS = ("task_id",)
+
+
+def save_adapter(model, adapter_name: str, output_dir: str):
+    """
+    Save one named LoRA adapter in the standard single-adapter layout
+
+    PeftModel.save_pretrained puts non-default adapters in subdirectories;
+    this writes adapter_model.safetensors and adapter_config.json at the
+    root, so PeftModel.from_pretrained (and the evaluator) load it as-is.
+
+    Args:
+        model: PEFT model holding the adapter
+        adapter_name: Adapter to save
+        output_dir: Target directory
+    """
+    from peft import get_peft_model_state_dict
+    from safetensors.torch import save_file
+
+    os.makedirs(output_dir, exist_ok=True)
+    state_dict = get_peft_model_state_dict(model, adapter_name=adapter_name)
+    save_file(
+        {k: v.detach().contiguous().cpu() for k, v in state_dict.items()},
+        os.path.join(output_dir, "adapter_model.safetensors"),
+        metadata={"format": "pt"}
+    )
+    model.peft_config[adapter_name].save_pretrained(output_dir)
+
+
+def _to_host(obj: Any) -> Any:
+    """Deep-copy every tensor in a (nested) state dict to host memory"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(v) for v in obj)
+    return obj
+
+
+def _atomic_write(path: str, write_fn: Callable[[str], None]):
+    """Write a file through a temporary name, so readers never see half of it"""
+    tmp_path = f"{path}.tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def is_full_checkpoint(checkpoint_dir: str) -> bool:
+    """
+    True if a checkpoint is a complete resume point
+
+    Async adapter-only checkpoints have no optimizer.pt, and a checkpoint
+    without trainer_state.json is still being written.
+    """
+    return all(
+        os.path.isfile(os.path.join(checkpoint_dir, name))
+        for name in (OPTIMIZER_NAME, TRAINER_STATE_NAME)
+    )
+
+
+def _rng_state_globals():
+    """
+    Allow the numpy RNG state stored in checkpoint rng_state.pth
+
+    torch >= 2.6 loads with weights_only=True by default, which rejects
+    the numpy arrays older transformers versions pickle into that file.
+    """
+    if not hasattr(torch.serialization, "safe_globals"):
+        return contextlib.nullcontext()
+
+    import numpy as np
+
+    return torch.serialization.safe_globals([
+        np.core.multiarray._reconstruct,
+        np.ndarray,
+        np.dtype,
+        type(np.dtype(np.uint32)),
+    ])
+
+
+class HumanEvalTrainer(Trainer):
+    """Trainer for HumanEval datasets"""
+
+    def __init__(
+        self,
+        *args,
+        adapter_name: Optional[str] = None,
+        async_checkpoints: bool = False,
+        optimizer_save_interval: int = 5,
+        train_sampler=None,
+        **kwargs
+    ):
+        """
+        Args:
+            adapter_name: Named adapter this trainer trains and saves
+                (None = save the whole PEFT model as usual)
+            async_checkpoints: Write adapter-only checkpoints on a
+                background thread instead of full synchronous checkpoints
+            optimizer_save_interval: With async_checkpoints, also save
+                optimizer, scheduler and RNG state every N checkpoints
+                (0 = never)
+            train_sampler: LossAwareSampler for the train set (None = the
+                Trainer's uniform shuffle)
+        """
+        super().__init__(*args, **kwargs)
+        self.adapter_name = adapter_name
+        self.async_checkpoints = async_checkpoints
+        self.optimizer_save_interval = optimizer_save_interval
+        self.train_sampler = train_sampler
+        self.checkpoint_stall_seconds = 0.0
+        self._checkpoints_saved = 0
+        self._checkpoint_executor: Optional[ThreadPoolExecutor] = None
+        self._pending_checkpoints: List[Future] = []
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        task_ids = inputs.get("task_id")
+        for field_name in NON_MODEL_FIELDS:
+            inputs.pop(field_name, None)
+        if self.train_sampler is None or not model.training or task_ids is None:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
+
+        # Per-sample losses from this forward's logits (no extra pass)
+        from sampling import per_sample_loss
+
+        loss, outputs = super().compute_loss(model, inputs, return_outputs=True, **kwargs)
+        self.train_sampler.update(task_ids, per_sample_loss(outputs.logits, inputs["labels"]))
+        return (loss, outputs) if return_outputs else loss
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_sampler is not None:
+            return self.train_sampler
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def get_train_dataloader(self) -> DataLoader:
+        dataset = self.train_dataset
+        if not getattr(dataset, "shards_by_rank", False) or self.args.world_size <= 1:
+            return super().get_train_dataloader()
+
+        # Dataset already yields only this rank's shard
+        num_workers = self.args.dataloader_num_workers
+        return DataLoader(
+            dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            prefetch_factor=self.args.dataloader_prefetch_factor if num_workers > 0 else None,
+            persistent_workers=self.args.dataloader_persistent_workers and num_workers > 0
+        )
+
+    def _load_rng_state(self, checkpoint):
+        with _rng_state_globals():
+            return super()._load_rng_state(checkpoint)
+
+    def _load_optimizer_and_scheduler(self, checkpoint):
+        cpu_data_parallel = self.args.world_size > 1 and self.args.device.type == "cpu"
+        if checkpoint is None or not cpu_data_parallel or self.is_deepspeed_enabled or self.is_fsdp_enabled:
+            return super()._load_optimizer_and_scheduler(checkpoint)
+
+        # Trainer maps to args.device ("cpu:<rank>") on data-parallel runs,
+        # which torch.load rejects; CPU state loads as plain "cpu"
+        optimizer_file = os.path.join(checkpoint, OPTIMIZER_NAME)
+        scheduler_file = os.path.join(checkpoint, SCHEDULER_NAME)
+        if os.path.isfile(optimizer_file) and os.path.isfile(scheduler_file):
+            self.optimizer.load_state_dict(torch.load(optimizer_file, map_location="cpu"))
+            self.lr_scheduler.load_state_dict(torch.load(scheduler_file))
+
+    def _save(self, output_dir: Optional[str] = None, state_dict=None):
+        if self.adapter_name is None:
+            return super()._save(output_dir, state_dict=state_dict)
+
+        # Checkpoints and the final model hold only this trainer's adapter
+        output_dir = output_dir if output_dir is not None else self.args.output_dir
+        save_adapter(self.accelerator.unwrap_model(self.model), self.adapter_name, output_dir)
+        if self.tokenizer is not None:
+            self.tokenizer.save_pretrained(output_dir)
+        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+
+    def preemption_requested(self) -> bool:
+        """True once a PreemptionCallback has received SIGTERM/SIGINT"""
+        return any(
+            getattr(callback, "signal_received", None) is not None
+            for callback in self.callback_handler.callbacks
+        )
+
+    # ------------------------------------------------------------------
+    # Asynchronous adapter-only checkpoints
+    # ------------------------------------------------------------------
+
+    def _checkpoint_adapter_name(self, model) -> Optional[str]:
+        """Adapter to checkpoint, or None if the model is not a PEFT model"""
+        from peft import PeftModel
+
+        if not isinstance(model, PeftModel):
+            return None
+        return self.adapter_name or model.active_adapter
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        if not self.async_checkpoints or self.is_deepspeed_enabled or self.is_fsdp_enabled:
+            return super()._save_checkpoint(model, trial, metrics=metrics)
+
+        unwrapped = self.accelerator.unwrap_model(self.model)
+        adapter_name = self._checkpoint_adapter_name(unwrapped)
+        if adapter_name is None:
+            return super()._save_checkpoint(model, trial, metrics=metrics)
+
+        start = time.perf_counter()
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        self._checkpoints_saved += 1
+        # A preemption checkpoint is the resume point, so it carries full state
+        save_optimizer = self.preemption_requested() or (
+            self.optimizer_save_interval > 0
+            and self._checkpoints_saved % self.optimizer_save_interval == 0
+        )
+
+        self._update_best_checkpoint(metrics, output_dir)
+        if not self.args.should_save:
+            # Other ranks only contribute their RNG state (a few KB)
+            if save_optimizer:
+                os.makedirs(output_dir, exist_ok=True)
+                torch.save(self._rng_snapshot(), os.path.join(output_dir, self._rng_file_name()))
+            self.checkpoint_stall_seconds += time.perf_counter() - start
+            return
+
+        # Snapshot on the training thread; everything after runs in the background
+        from peft import get_peft_model_state_dict
+
+        snapshot = {
+            "adapter": _to_host(get_peft_model_state_dict(unwrapped, adapter_name=adapter_name)),
+            "optimizer": None,
+        }
+        if save_optimizer:
+            snapshot["optimizer"] = _to_host(self.optimizer.state_dict())
+            snapshot["scheduler"] = self.lr_scheduler.state_dict()
+            snapshot["rng"] = self._rng_snapshot()
+        self.state.stateful_callbacks["TrainerControl"] = self.control.state()
+        # Same serialization as TrainerState.save_to_json
+        snapshot["trainer_state"] = json.dumps(dataclasses.asdict(self.state), indent=2, sort_keys=True) + "\n"
+
+        # The directory exists before on_save, so callbacks can add files to it
+        os.makedirs(output_dir, exist_ok=True)
+        self._submit_checkpoint(
+            self._write_checkpoint, output_dir, run_dir,
+            unwrapped.peft_config[adapter_name], snapshot
+        )
+        self.checkpoint_stall_seconds += time.perf_counter() - start
+
+    def _update_best_checkpoint(self, metrics: Optional[Dict[str, float]], output_dir: str):
+        """Track the best checkpoint like Trainer._save_checkpoint does"""
+        if metrics is None or self.args.metric_for_best_model is None:
+            return
+
+        metric_to_check = self.args.metric_for_best_model
+        if not metric_to_check.startswith("eval_"):
+            metric_to_check = f"eval_{metric_to_check}"
+        metric_value = metrics[metric_to_check]
+
+        operator = np.greater if self.args.greater_is_better else np.less
+        if (
+            self.state.best_metric is None
+            or self.state.best_model_checkpoint is None
+            or operator(metric_value, self.state.best_metric)
+        ):
+            self.state.best_metric = metric_value
+            self.state.best_model_checkpoint = output_dir
+
+    def _rng_snapshot(self) -> Dict[str, Any]:
+        """RNG states in the layout Trainer._load_rng_state expects"""
+        rng_states = {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "cpu": torch.random.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            if self.args.world_size > 1:
+                rng_states["cuda"] = torch.cuda.random.get_rng_state_all()
+            else:
+                rng_states["cuda"] = torch.cuda.random.get_rng_state()
+        return rng_states
+
+    def _rng_file_name(self) -> str:
+        """Per-process RNG file name used by Trainer._load_rng_state"""
+        if self.args.world_size <= 1:
+            return "rng_state.pth"
+        return f"rng_state_{self.args.process_index}.pth"
+
+    def _submit_checkpoint(self, fn: Callable, *args):
+        """Queue a checkpoint write (at most one write waits behind the running one)"""
+        if self._checkpoint_executor is None:
+            self._checkpoint_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="checkpoint-writer"
+            )
+
+        # Bound host memory held by snapshots if the disk falls behind
+        while len(self._pending_checkpoints) > 1:
+            self._pending_checkpoints.pop(0).result()
+        self._pending_checkpoints = [f for f in self._pending_checkpoints if not self._check_done(f)]
+        self._pending_checkpoints.append(self._checkpoint_executor.submit(fn, *args))
+
+    @staticmethod
+    def _check_done(future: Future) -> bool:
+        """True if a write has finished; re-raises its error"""
+        if not future.done():
+            return False
+        future.result()
+        return True
+
+    def wait_for_checkpoints(self):
+        """Block until all background checkpoint writes are on disk"""
+        while self._pending_checkpoints:
+            self._pending_checkpoints.pop(0).result()
+
+    def _write_checkpoint(self, output_dir: str, run_dir: str, peft_config, snapshot: Dict[str, Any]):
+        """
+        Write a host-side checkpoint snapshot (runs on the writer thread)
+
+        trainer_state.json is written last, so a checkpoint without it is
+        incomplete and resume code can skip it.
+        """
+        from safetensors.torch import save_file
+
+        _atomic_write(
+            os.path.join(output_dir, "adapter_model.safetensors"),
+            lambda path: save_file(snapshot["adapter"], path, metadata={"format": "pt"})
+        )
+        peft_config.save_pretrained(output_dir)
+        if self.tokenizer is not None:
+            self.tokenizer.save_pretrained(output_dir)
+        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+
+        if snapshot["optimizer"] is not None:
+            _atomic_write(
+                os.path.join(output_dir, OPTIMIZER_NAME),
+                lambda path: torch.save(snapshot["optimizer"], path)
+            )
+            torch.save(snapshot["scheduler"], os.path.join(output_dir, SCHEDULER_NAME))
+            torch.save(snapshot["rng"], os.path.join(output_dir, self._rng_file_name()))
+
+        def write_state(path: str):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(snapshot["trainer_state"])
+
+        _atomic_write(os.path.join(output_dir, TRAINER_STATE_NAME), write_state)
+        self._rotate_async_checkpoints(run_dir)
+
+    def _rotate_async_checkpoints(self, run_dir: str):
+        """
+        Apply save_total_limit to async checkpoints
+
+        Like Trainer._rotate_checkpoints, but the newest checkpoint whose
+        optimizer state is already on disk is kept as well, so a full
+        resume point always survives rotation. A full checkpoint still
+        queued behind this write does not count yet.
+        """
+        limit = self.args.save_total_limit
+        if limit is None or limit <= 0:
+            return
+
+        checkpoints = self._sorted_checkpoints(use_mtime=False, output_dir=run_dir)
+        if self.state.best_model_checkpoint is not None and limit == 1 \
+                and checkpoints and checkpoints[-1] != self.state.best_model_checkpoint:
+            limit = 2
+
+        full = [checkpoint for checkpoint in checkpoints if is_full_checkpoint(checkpoint)]
+        keep = {full[-1] if full else None, self.state.best_model_checkpoint}
+        for checkpoint in checkpoints[:max(0, len(checkpoints) - limit)]:
+            if checkpoint not in keep:
+                shutil.rmtree(checkpoint, ignore_errors=True)
+
+    def _load_best_model(self):
+        self.wait_for_checkpoints()
+        return super()._load_best_model()
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            self.wait_for_checkpoints()
+            if self.async_checkpoints and self._checkpoints_saved:
+                print(f"💾 Async checkpoints: {self._checkpoints_saved} saved, "
+                      f"{self.checkpoint_stall_seconds:.2f}s training stall in total")